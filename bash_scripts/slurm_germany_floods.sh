@@ -3,7 +3,7 @@
 
 #SBATCH --nodes=1
 #SBATCH --constraint="cascadelake"
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=32
 #SBATCH --mem=64GB
 #SBATCH --output=/storage/vast-gfz-hpc-01/home/abuch/Feature_Selection_Pipeline/feature-selection-pipeline/log/%x_%A.log
 #SBATCH --error=/storage/vast-gfz-hpc-01/home/abuch/Feature_Selection_Pipeline/feature-selection-pipeline/log/%x_%A.log
@@ -20,7 +20,7 @@ module load $python_version
 source $venv_dir
 
 cd $project_basedir/scripts
-srun python -u feature_selection_regression_germany_commercial_floods.py ${aoi_and_floodtype} ${year}
+srun python -u feature_selection_regression_germany_commercial_floods.py ${aoi_and_floodtype} ${year} --n-jobs ${SLURM_CPUS_PER_TASK}
 
 echo "Finished run"
 
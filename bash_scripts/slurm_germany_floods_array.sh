@@ -0,0 +1,30 @@
+#!/bin/bash
+### process feature extraction for households in Germany, one model job per array task
+### submit via ./submit_germany_floods.sh to get the array size and the dependent reduction job
+
+#SBATCH --nodes=1
+#SBATCH --constraint="cascadelake"
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=64GB
+#SBATCH --output=/storage/vast-gfz-hpc-01/home/abuch/Feature_Selection_Pipeline/feature-selection-pipeline/log/%x_%A_%a.log
+#SBATCH --error=/storage/vast-gfz-hpc-01/home/abuch/Feature_Selection_Pipeline/feature-selection-pipeline/log/%x_%A_%a.log
+#SBATCH --time=00-04:00:00
+#SBATCH --requeue  # preempted or requeued jobs resume from checkpoints of finished outer folds
+
+
+aoi_and_floodtype=$1
+year=$2
+mode=${3:-fit}  # fit: one job per SLURM_ARRAY_TASK_ID, reduce: performance tables and plots per target
+
+
+source ./variables_shellscript.sh
+
+module load $python_version
+source $venv_dir
+
+cd $project_basedir/scripts
+srun python -u feature_selection_regression.py ${aoi_and_floodtype} ${year} --mode ${mode} --n-jobs ${SLURM_CPUS_PER_TASK}
+
+echo "Finished run"
+
+deactivate
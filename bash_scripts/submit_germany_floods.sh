@@ -0,0 +1,25 @@
+#!/bin/bash
+### submit all model jobs of one dataset as SLURM job array, followed by the reduction step
+### usage: ./submit_germany_floods.sh german_fluvial 2021
+
+aoi_and_floodtype=$1
+year=$2
+
+
+source ./variables_shellscript.sh
+
+module load $python_version
+source $venv_dir
+
+## parse input csv files once into column stores, shared by all array tasks
+(cd $project_basedir/scripts && python feature_selection_regression.py ${aoi_and_floodtype} ${year} --mode convert)
+
+## number of (target, pipeline) jobs
+n_jobs=$(cd $project_basedir/scripts && python feature_selection_regression.py ${aoi_and_floodtype} ${year} --mode count)
+
+array_id=$(sbatch --parsable --array=0-$((n_jobs - 1)) slurm_germany_floods_array.sh ${aoi_and_floodtype} ${year} fit)
+sbatch --dependency=afterok:${array_id} slurm_germany_floods_array.sh ${aoi_and_floodtype} ${year} reduce
+
+echo "Submitted ${n_jobs} model jobs (${array_id}) and reduction step"
+
+deactivate
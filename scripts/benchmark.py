@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the feature selection workflow on synthetic flood-loss datasets"""
+
+# Times the stages of the workflow (nested cv fitting and evaluation, permutation importance, partial dependence,
+# VIF and weighted feature importance) and records their scaling with the number of records, predictors and cores.
+# Results are appended to one csv file together with the git commit, so that runs of different commits can be compared:
+#
+#   python benchmark.py                       # default scaling curves
+#   python benchmark.py --baseline <commit>   # compare with a previous run of another commit
+
+import sys
+import socket
+import argparse
+import datetime
+import subprocess
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from sklearn.model_selection import RepeatedKFold
+from sklearn.metrics import make_scorer, mean_absolute_error
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.insert(0, "../")
+import utils.feature_selection as fs
+import utils.training as t
+import utils.evaluation as e
+import utils.evaluation_metrics as em
+import utils.settings as s
+import utils.pipelines as p
+import utils.parallel as par
+import utils.preprocessing as pp
+import utils.profiling as prof
+import utils.synthetic as syn
+
+import warnings
+warnings.filterwarnings('ignore')
+
+s.init()
+seed = s.seed
+
+target = "rloss_b"
+kfolds_and_repeats = 2, 2
+cv = RepeatedKFold(n_splits=kfolds_and_repeats[0], n_repeats=kfolds_and_repeats[1], random_state=seed)
+score_metrics = {
+    "MAE": make_scorer(mean_absolute_error, greater_is_better=False),
+    "RMSE": make_scorer(em.root_mean_squared_error, greater_is_better=False),
+    "MBE": make_scorer(em.mean_bias_error, greater_is_better=False),
+    "R2": "r2",
+    "SMAPE": make_scorer(em.symmetric_mean_absolute_percentage_error, greater_is_better=False)
+}
+
+## fixed hyperparameter spaces, results stay comparable when the hyperparameter sets of the study change
+param_spaces = {
+    "en": {"model__alpha": [0.001, 0.01, 0.1, 1.0], "model__l1_ratio": [0.1, 0.5, 0.9]},
+    "rf": {"model__n_estimators": [50, 100], "model__max_depth": [3, 5, None], "model__max_features": [0.5, 1.0]},
+    "xgb": {"model__n_estimators": [50, 100], "model__max_depth": [2, 4], "model__learning_rate": [0.05, 0.1, 0.3]},
+}
+n_pdp_features = 5
+
+
+def git_commit():
+    """ return: short hash of current commit, marked with + if the working tree has uncommitted changes """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def scaling_grid(rows, features, n_jobs, default_rows, default_features):
+    """
+    One-dimensional sweeps along records, predictors and cores, the other two settings are kept at their defaults
+    return: list of (sweep, n_rows, n_features, n_jobs)
+    """
+    grid = [("rows", n, default_features, 1) for n in rows]
+    grid += [("features", default_rows, n, 1) for n in features]
+    grid += [("cores", default_rows, default_features, n) for n in n_jobs]
+    return grid
+
+
+def benchmark_model(model_name, df_Xy, n_jobs, search_method="random"):
+    """
+    Run all stages of one model job on a synthetic dataset, the stages are profiled by the decorated functions
+    return: pd.Series with permutation feature importances
+    """
+    complete_cases = model_name in ("en", "rf")
+    data = pp.PreparedDataset(df_Xy, target, complete_cases=complete_cases)
+    pipe = joblib.load(f"./pipelines/pipe_{model_name}.pkl")
+
+    mf = t.ModelFitting(
+        model=pipe, Xy=data, target_name=target, param_space=param_spaces[model_name],
+        tuning_score="neg_mean_absolute_error", cv=cv, kfolds_and_repeats=kfolds_and_repeats, seed=seed, n_jobs=n_jobs,
+        search_method=search_method,
+    )
+    models_trained_ncv = mf.model_fit_ncv()
+    me = e.ModelEvaluation(
+        models_trained_ncv=models_trained_ncv, Xy=data, target_name=target, score_metrics=score_metrics,
+        cv=cv, kfolds=kfolds_and_repeats[0], seed=seed, n_jobs=n_jobs,
+    )
+    results = me.model_evaluate_ncv()
+
+    best_idx = int(np.argmax(results["test_MAE"]))
+    final_model = results["estimator"][best_idx].best_estimator_
+
+    importances = me.permutation_feature_importance(final_model, repeats=5)
+    importances = pd.Series(importances[0], index=data.X_names, name=f"{model_name}_importances")
+
+    X_pdp = df_Xy.dropna()[data.X_names]
+    e.partial_dependences(final_model, X_pdp, features=importances.sort_values(ascending=False).index[:n_pdp_features])
+    return importances, np.abs(results["test_MAE"].mean())
+
+
+def benchmark_dataset(models, n_rows, n_features, n_jobs, data_settings, search_method="random"):
+    """ run all model jobs and the dataset-level stages (VIF, weighted importance) on one synthetic dataset """
+    df_Xy = syn.make_flood_loss_data(n_rows=n_rows, n_features=n_features, seed=seed, target_name=target, **data_settings)
+
+    df_feature_importances = pd.DataFrame(index=df_Xy.columns.drop(target))
+    model_weights = {}
+    for model_name in models:
+        with prof.labels(model=model_name):
+            importances, mae = benchmark_model(model_name, df_Xy, n_jobs, search_method)
+        df_feature_importances = df_feature_importances.join(importances)
+        model_weights[importances.name] = mae
+
+    X = df_Xy.drop(target, axis=1).dropna()
+    with prof.stage("vif_score"):
+        fs.vif_score(pd.DataFrame(MinMaxScaler().fit_transform(X), columns=X.columns))
+    with prof.stage("calc_weighted_sum_feature_importances"):
+        fs.calc_weighted_sum_feature_importances(df_feature_importances, model_weights)
+
+
+def compare(df_results, baseline, commit):
+    """
+    Ratio of the wall times of the current run and a baseline commit, per stage and setting
+    return: pd.DataFrame, values below 1 are speed-ups
+    """
+    keys = ["sweep", "n_rows", "n_features", "n_jobs", "model", "stage"]
+    df_wall = df_results[df_results["commit"].isin([baseline, commit])]
+    df_wall = df_wall.pivot_table(index=keys, columns="commit", values="wall_time_s", aggfunc="median")
+    return (df_wall[commit] / df_wall[baseline]).rename("wall_time_ratio").dropna().reset_index()
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[250, 500, 1000], help="number of records, sweep along records")
+    parser.add_argument("--features", type=int, nargs="+", default=[10, 20, 40], help="number of predictors, sweep along predictors")
+    parser.add_argument("--n-jobs", type=int, nargs="+", default=[1, 2, 4], help="number of cores, sweep along cores")
+    parser.add_argument("--default-rows", type=int, default=500, help="records of the sweeps along predictors and cores")
+    parser.add_argument("--default-features", type=int, default=20, help="predictors of the sweeps along records and cores")
+    parser.add_argument("--models", nargs="+", default=["en", "rf", "xgb"], choices=["en", "rf", "xgb"])
+    parser.add_argument("--search", nargs="+", default=["random"], choices=t.SEARCH_METHODS, help="inner hyperparameter search, see feature_selection_regression.py")
+    parser.add_argument("--nan-rate", type=float, default=0.05)
+    parser.add_argument("--zero-loss-fraction", type=float, default=0.3)
+    parser.add_argument("--correlation", type=float, default=0.5)
+    parser.add_argument("--repeats", type=int, default=1, help="repetitions of each setting, the median is used for comparisons")
+    parser.add_argument("--outfile", default="../benchmarks/benchmark_results.csv", help="csv file, results of each run are appended")
+    parser.add_argument("--baseline", default=None, help="commit of a previous run in outfile to compare with")
+    args = parser.parse_args()
+
+    Path("./pipelines").mkdir(exist_ok=True)
+    p.main()  # create/update model settings
+    data_settings = {"nan_rate": args.nan_rate, "zero_loss_fraction": args.zero_loss_fraction, "correlation": args.correlation}
+    n_jobs_available = par.available_cores()
+    grid = scaling_grid(
+        args.rows, args.features, [n for n in args.n_jobs if n <= n_jobs_available],
+        args.default_rows, args.default_features,
+    )
+
+    commit = git_commit()
+    run_info = {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": socket.gethostname(),
+        "available_cores": n_jobs_available,
+        "search": " ".join(args.search),
+        **data_settings,
+    }
+
+    for repeat in range(args.repeats):
+        for sweep, n_rows, n_features, n_jobs in grid:
+            print(f"Benchmark {sweep}: {n_rows} records, {n_features} predictors, {n_jobs} cores (repeat {repeat})")
+            with prof.labels(sweep=sweep, n_rows=n_rows, n_features=n_features, n_jobs=n_jobs, repeat=repeat, model="all"):
+                with prof.stage("total") as record:
+                    benchmark_dataset(args.models, n_rows, n_features, n_jobs, data_settings, args.search)
+            print(f".. took {record['wall_time_s']} s")
+
+    df_run = pd.DataFrame(prof.PROFILER.records).assign(**run_info)
+    outfile = Path(args.outfile)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    df_results = pd.concat([pd.read_csv(outfile), df_run]) if outfile.exists() else df_run
+    df_results.to_csv(outfile, index=False)
+    print(f"Results of commit {commit} saved to {outfile}")
+
+    print(
+        "\nWall time [s] per stage:\n",
+        df_run.pivot_table(index=["sweep", "n_rows", "n_features", "n_jobs"], columns="stage", values="wall_time_s", aggfunc="median").round(2)
+    )
+    if args.baseline is not None:
+        df_ratio = compare(df_results, args.baseline, commit)
+        print(f"\nWall time of {commit} relative to {args.baseline}:\n", df_ratio.round(2).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
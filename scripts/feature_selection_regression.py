@@ -1,4 +1,3 @@
-
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Data preprocessing for HCMC survey dataset"""
@@ -17,24 +16,28 @@ __email__ = "a.buch@stud.uni-heidelberg.de"
 # - eXtreme Gradient Boosting
 # - Random Forest
 # 
+# Each combination of (aoi, year, target, pipeline) is an independent job (model fitting, evaluation and feature importance),
+# the jobs are either run on a process pool or as SLURM job array. After all pipelines of a target are finished,
+# a reduction step derives the performance table, the weighted feature importances and the plots for this target.
 
 import sys
 from pathlib import Path
 import argparse
+import functools
 import joblib
 import numpy as np
 import pandas as pd
-import itertools
 
-from sklearn.preprocessing import MinMaxScaler
 from sklearn.model_selection import RepeatedKFold
 from sklearn.metrics import make_scorer, mean_absolute_error, mean_absolute_error
 
+import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 sys.path.insert(0, "../")
 import utils.feature_selection as fs
+import utils.aggregation as agg
 import utils.training as t
 import utils.evaluation as e
 import utils.evaluation_metrics as em
@@ -42,41 +45,28 @@ import utils.figures as f
 import utils.settings as s
 import utils.pipelines as p
 import utils.preprocessing as pp
+import utils.scheduler as sched
+import utils.parallel as par
+import utils.cache as c
+import utils.streaming as st
+import utils.profiling as prof
 
-p.main()  # create/update model settings
 #s.init()
 seed = s.seed
 
 pd.set_option('display.max_columns', None)
-plt.figure(figsize=(20, 10))
 
 import contextlib
 import warnings
 warnings.filterwarnings('ignore')
 
 
-## user-input -- settings for entire script
-parser = argparse.ArgumentParser()
-parser.add_argument("aoi_and_floodtype") # eg. "german_flash", "german_fluvial" 
-parser.add_argument("year")  # string e.g "2002", "2021", "combi"
-args = parser.parse_args()
-aoi_and_floodtype = args.aoi_and_floodtype
-years = [args.year]
-
 targets = ["rloss_b", "rloss_e", "rloss_gs"]
 ## settings for cv
 kfolds_and_repeats = 2, 2  # <k-folds, repeats> for nested cv
 cv = RepeatedKFold(n_splits=kfolds_and_repeats[0], n_repeats=kfolds_and_repeats[1], random_state=seed)
 
 
-## save models and their evaluation in following folders:
-Path(f"../models_trained/commercial/nested_cv_models/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
-Path(f"../models_trained/commercial/final_models/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
-Path(f"../models_evaluation/commercial/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
-Path(f"../selected_features/commercial/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
-
-
-
 ## Fit model 
 score_metrics = {
     "MAE": make_scorer(mean_absolute_error, greater_is_better=False),
@@ -89,185 +79,402 @@ score_metrics = {
 
 ## iterate over piplines. Each pipline contains a scaler and regressor (and optionally a bagging method) 
 pipelines = ["pipe_en", "pipe_rf", "pipe_xgb"]  
-
-
-for year, target in itertools.product(years, targets): # iterate over years/combined and targets
-
-    print("\n ##########  Starting model processing for ", year, target, "##############")
-    
-    df_candidates = pd.read_csv(f"../input/{aoi_and_floodtype}/df_{year}_{target}_commercial_{aoi_and_floodtype.split('_')[-1]}.csv")
+## names of the models in plots, models without entry are shown by their abbreviation
+model_names_plot = {"en": "Elastic Net", "rf": "Random Forest", "xgb": "XGBoost"}
+
+## number of most important features shown in partial dependence plots, 
+## partial dependences of further features can be derived later by e.LazyPartialDependences.from_file(<final model>, X)
+n_pdp_features = 10
+
+
+def create_output_dirs(aoi_and_floodtype):
+    """ save models and their evaluation in following folders """
+    Path(f"../models_trained/commercial/nested_cv_models/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+    Path(f"../models_trained/commercial/final_models/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+    Path(f"../models_trained/commercial/job_results/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+    Path(f"../models_trained/commercial/checkpoints/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+    Path(f"../models_evaluation/commercial/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+    Path(f"../selected_features/commercial/{aoi_and_floodtype}").mkdir(parents=True, exist_ok=True)
+
+
+def convert_candidates(aoi_and_floodtype, year, target, chunksize=None):
+    """ 
+    convert csv of one dataset once into a binary column store, which all jobs of this dataset open zero-copy
+    chunksize (int): parse csv in chunks of this many records, for datasets which do not fit into memory
+    return: path of column store
+    """
+    filename = f"df_{year}_{target}_commercial_{aoi_and_floodtype.split('_')[-1]}"
+    csv_file = f"../input/{aoi_and_floodtype}/{filename}.csv"
+    store_dir = f"../input/{aoi_and_floodtype}/column_store/{filename}"
+    if not pp.column_store_is_current(csv_file, store_dir):
+        Path(store_dir).parent.mkdir(parents=True, exist_ok=True)
+        print(f"Converting {csv_file} to column store {store_dir}")
+        pp.csv_to_column_store(csv_file, store_dir, dtype="float32", chunksize=chunksize)
+    return store_dir
+
+
+def load_candidates(aoi_and_floodtype, year, target):
+    """ load candidate predictors and target of one dataset, memory-mapped from its column store """
+    return pp.load_column_store(convert_candidates(aoi_and_floodtype, year, target))
+
+
+def job_result_file(aoi_and_floodtype, year, target, model_name):
+    """ location of the stored results of one model job, read by the reduction step """
+    return f"../models_trained/commercial/job_results/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib"
+
+
+def profile_file(aoi_and_floodtype, year, name):
+    """ location of the timing and memory profile of one job, merged into the run profile at the end of the run """
+    return f"../models_evaluation/commercial/{aoi_and_floodtype}/run_profile/{name}_{year}_{aoi_and_floodtype}.json"
+
+
+def profiled_fit(fit_func, job, **kwargs):
+    """
+    Run fit function of one job and store wall time, CPU time and peak memory of all its stages
+    fit_func (callable): fit_pipeline() or fit_pipeline_streaming()
+    return: result of fit_func
+    """
+    with prof.labels(aoi_and_floodtype=job.aoi_and_floodtype, year=job.year, target=job.target, model=job.model_name):
+        with prof.stage(fit_func.__name__) as record:
+            result = fit_func(job, **kwargs)
+    prof.PROFILER.dump(profile_file(job.aoi_and_floodtype, job.year, f"{job.model_name}_{job.target}"))
+    print(f"{job.model_name} for target {job.target} took {record['wall_time_s']} s, peak memory {record['peak_rss_mb']} MB")
+    return result
+
+
+def profiled_reduce(aoi_and_floodtype, year, target):
+    """ run reduction step of one target and store wall time, CPU time and peak memory of all its stages """
+    with prof.labels(aoi_and_floodtype=aoi_and_floodtype, year=year, target=target, model=None):
+        with prof.stage("reduce_target") as record:
+            reduce_target(aoi_and_floodtype, year, target)
+    prof.PROFILER.dump(profile_file(aoi_and_floodtype, year, f"reduce_{target}"))
+    print(f"Reduction step for target {target} took {record['wall_time_s']} s, peak memory {record['peak_rss_mb']} MB")
+
+
+def write_run_profile(aoi_and_floodtype, year):
+    """
+    Merge the profiles of all jobs into one run profile (json and csv)
+    return: pd.DataFrame with wall time, CPU time and peak memory per stage, model and target
+    """
+    infiles = Path(f"../models_evaluation/commercial/{aoi_and_floodtype}/run_profile").glob(f"*_{year}_{aoi_and_floodtype}.json")
+    outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/run_profile_{year}_{aoi_and_floodtype}.json"
+    df_profile = prof.merge_profiles(list(infiles), outfile)
+    if not df_profile.empty:
+        print(
+            "Wall time [s] per model and target:\n", 
+            df_profile[df_profile["parent"].isna()].pivot_table(index="target", columns="stage", values="wall_time_s", aggfunc="sum"),
+            f"\n.. run profile saved to {outfile}"
+        )
+    return df_profile
+
+
+def fit_pipeline(job, n_jobs=1, search_settings=None, cache_settings=None, checkpoints=True):
+    """
+    Fit, evaluate and derive feature importances for one pipeline on one target
+    job (sched.Job): aoi_and_floodtype, year, target and pipeline name
+    n_jobs (int): number of cores for this job
+    search_settings (dict): search_method, halving_resource and early_stopping_rounds of the inner hyperparameter search
+    cache_settings (dict): cache_dir and max_size_gb of the cache for outer cv results, None == without cache
+    checkpoints (bool): checkpoint each finished outer fold and resume from it on restart
+    return: path to the stored job results
+    """
+    aoi_and_floodtype, year, target, pipe_name = job.aoi_and_floodtype, job.year, job.target, job.pipe_name
+    model_name = job.model_name
+    print( f"\nApplying {model_name} on {target} and {year}")
+
+    df_candidates = load_candidates(aoi_and_floodtype, year, target)
     print(df_candidates.shape)
 
-    eval_sets = {}
-    models_trained = {}
-    final_models_trained = {}
-    models_coef = {}
-    predicted_values = {}
-    df_feature_importances = pd.DataFrame(index=df_candidates.drop(target, axis=1).columns.to_list())
-    models_scores = {}
-
     ## Load set of hyperparamters
     hyperparams_set = pp.load_config("../utils/hyperparameter_sets.json")
 
+    # ## remove zero-loss records only for combined dataset
+    # if target == "combi":
+    #     print(f"Removing {df_Xy.loc[df_Xy[target]==0.0,:].shape[0]} zero loss records")
+    #     df_Xy = df_Xy.loc[df_Xy[target]!=0.0,:]
+    #     print(f"Keeping {df_Xy.shape} damage cases for model training and evaluation")
+
+
+    ## prepared once and shared by fitting, evaluation and feature importance, without copies or scaling:
+    ## samples where target is nan are dropped, Elastic Net and Random Forest: samples where any value is nan are dropped
+    data = pp.PreparedDataset(df_candidates, target, complete_cases=model_name in ("en", "rf"))
+    X_names = data.X_names
+    X, y = data.X, data.y
+    print(f"Dropping {data.n_dropped} records from entire dataset due to nan values")
+
+    print(
+        "Using ",
+        data.shape[0],
+        " records, from those are ",
+        {(y == 0.0).sum()},
+        " cases with zero-loss or zero-reduction",
+    )
 
-    for pipe_name in pipelines:
+    ## load model pipelines and hyperparameter space
+    pipe = joblib.load(f'./pipelines/{pipe_name}.pkl')
+    param_space = hyperparams_set[f"{model_name}_hyperparameters"]
 
-        model_name = pipe_name.split('_')[1]
-        print( f"\nApplying {model_name} on {target} and {year}")
+    ## if bagging is used
+    if "bag" in pipe_name.split("_"):
+        print(f"Testing {model_name} with bagging")
+        param_space = { k.replace('model', 'bagging__estimator') : v for (k, v) in param_space.items()}
 
-        df_Xy = df_candidates
-        X_names = df_Xy.drop(target, axis=1).columns.to_list()
+    ## fit model for unbiased model evaluation and for final model used for Feature importance, Partial Dependence etc.
+    mf = t.ModelFitting(
+        model=pipe, 
+        Xy=data,
+        target_name=target,
+        param_space=hyperparams_set[f"{model_name}_hyperparameters"],
+        tuning_score="neg_mean_absolute_error",
+        cv=cv,
+        kfolds_and_repeats=kfolds_and_repeats,
+        seed=seed,
+        n_jobs=n_jobs,
+        **(search_settings or {}),
+    )
+    models_trained_ncv = mf.model_fit_ncv()
+    print(f"Splitting {mf.n_jobs} cores into", mf.budget)
 
-        # ## remove zero-loss records only for combined dataset
-        # if target == "combi":
-        #     print(f"Removing {df_Xy.loc[df_Xy[target]==0.0,:].shape[0]} zero loss records")
-        #     df_Xy = df_Xy.loc[df_Xy[target]!=0.0,:]
-        #     print(f"Keeping {df_Xy.shape} damage cases for model training and evaluation")
+    # save models from nested cv and final model on entire ds
+    with prof.stage("joblib.dump"):
+        joblib.dump(models_trained_ncv, f"../models_trained/commercial/nested_cv_models/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib")
+        
+    ## evaluate model    
+    me = e.ModelEvaluation(
+        models_trained_ncv=models_trained_ncv, 
+        Xy=data,
+        target_name=target,
+        score_metrics=score_metrics,
+        cv=cv,
+        kfolds=kfolds_and_repeats[0],
+        seed=seed,
+        n_jobs=n_jobs,
+        cache=c.ResultCache(**cache_settings) if cache_settings else None,
+        checkpoint_dir=f"../models_trained/commercial/checkpoints/{aoi_and_floodtype}/{model_name}_{target}_{year}" if checkpoints else None,
+    )
+    model_evaluation_results = me.model_evaluate_ncv()
 
+    
+     ## visual check if hyperparameter ranges are good or need to be adapted
+    for i in range(len(model_evaluation_results["estimator"])):
+        print(f"{model_name}: ", model_evaluation_results["estimator"][i].best_params_)
 
-        ## drop samples where target is nan
-        print(f"Dropping {df_Xy[f'{target}'].isna().sum()} records from entire dataset due that these values are nan in target variable")
-        df_Xy = df_Xy[ ~df_Xy[f"{target}"].isna()]
 
-        ## Elastic Net and Random Forest: drop samples where any value is nan
-        if (model_name == "en") | (model_name == "rf"):
-            df_Xy.dropna(inplace=True)
+    ## store evaluation results for later 
+    models_scores =  {
+        k: model_evaluation_results[k] for k in tuple("test_" + s for s in list(score_metrics.keys()))
+    } # get evaluation scores, metric names start with "test_<metricname>"
 
-        print(
-            "Using ",
-            df_Xy.shape[0],
-            " records, from those are ",
-            {(df_Xy[target][df_Xy[target] == 0.0]).count()},
-            " cases with zero-loss or zero-reduction",
-        )
 
-        X = df_Xy[X_names]
-        y = df_Xy[target]
-
-        ## load model pipelines and hyperparameter space
-        pipe = joblib.load(f'./pipelines/{pipe_name}.pkl')
-        param_space = hyperparams_set[f"{model_name}_hyperparameters"]
-
-        ## if bagging is used
-        if "bag" in pipe_name.split("_"):
-            print(f"Testing {model_name} with bagging")
-            param_space = { k.replace('model', 'bagging__estimator') : v for (k, v) in param_space.items()}
-
-        ## fit model for unbiased model evaluation and for final model used for Feature importance, Partial Dependence etc.
-        mf = t.ModelFitting(
-            model=pipe, 
-            Xy=df_Xy,
-            target_name=target,
-            param_space=hyperparams_set[f"{model_name}_hyperparameters"],
-            tuning_score="neg_mean_absolute_error",
-            cv=cv,
-            kfolds_and_repeats=kfolds_and_repeats,
-            seed=seed,
-        )
-        models_trained_ncv = mf.model_fit_ncv()
+    ## Final model
 
-        # save models from nested cv and final model on entire ds
-        joblib.dump(models_trained_ncv, f"../models_trained/commercial/nested_cv_models/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib")
-            
-        ## evaluate model    
-        me = e.ModelEvaluation(
-            models_trained_ncv=models_trained_ncv, 
-            Xy=df_Xy,
-            target_name=target,
-            score_metrics=score_metrics,
-            cv=cv,
-            kfolds=kfolds_and_repeats[0],
-            seed=seed,
-        )
-        model_evaluation_results = me.model_evaluate_ncv()
+    ## get final model based on best MAE score during outer cv
+    best_idx = list(models_scores["test_MAE"]).index(max(models_scores["test_MAE"]))
+    final_model = model_evaluation_results["estimator"][best_idx]
+    print("used params for best model:", final_model.best_params_)  # use last model as the best one
+    final_model = final_model.best_estimator_
 
-        
-         ## visual check if hyperparameter ranges are good or need to be adapted
-        for i in range(len(model_evaluation_results["estimator"])):
-            print(f"{model_name}: ", model_evaluation_results["estimator"][i].best_params_)
+    ## predict on entire dataset and save final model
+    y_pred_final = final_model.predict(X) 
+    with prof.stage("joblib.dump"):
+        joblib.dump(final_model, f"../models_trained/commercial/final_models/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib")
 
 
-        ## store fitted models and their evaluation results for later 
-        eval_sets[model_name] = df_Xy
-        models_scores[model_name] =  {
-            k: model_evaluation_results[k] for k in tuple("test_" + s for s in list(score_metrics.keys()))
-        } # get evaluation scores, metric names start with "test_<metricname>"
-        models_trained[f"{model_name}"] = models_trained_ncv
-        predicted_values[model_name] = me.residuals
 
+    ## Feature importance of best model
 
-        ## Final model
+    ## R2 (default score, used for feature selection) and MAE from the same permutations
+    importances = me.permutation_feature_importance(
+        final_model, repeats=5, 
+        score_metrics={"R2": score_metrics["R2"], "MAE": score_metrics["MAE"]},
+    )
 
-        ## get final model based on best MAE score during outer cv
-        best_idx = list(models_scores[model_name]["test_MAE"]).index(max(models_scores[model_name]["test_MAE"]))
-        final_model = model_evaluation_results["estimator"][best_idx]
-        print("used params for best model:", final_model.best_params_)  # use last model as the best one
-        final_model = final_model.best_estimator_
+    print("\nSelect features based on permutation feature importance")
+    df_importance = pd.DataFrame(
+        {
+            f"{model_name}_importances" : importances["R2"][0],   # averaged importnace scores across repeats
+            f"{model_name}_importances_std" : importances["R2"][1],
+            f"{model_name}_importances_MAE" : importances["MAE"][0],
+            f"{model_name}_importances_MAE_std" : importances["MAE"][1],
+        },
+        index=X_names,
+    )
+    ## conditional permutation importance: permute within strata of correlated predictors (Spearman |rho| >= 0.5)
+    importances_conditional = me.conditional_permutation_feature_importance(final_model, repeats=5, threshold=0.5)
+    df_importance[f"{model_name}_importances_conditional"] = importances_conditional[0]
+    df_importance[f"{model_name}_importances_conditional_std"] = importances_conditional[1]
+    outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/permutation_importances_{model_name}_{target}_{year}_{aoi_and_floodtype}.xlsx"
+    with prof.stage("to_excel"):
+        df_importance.round(4).to_excel(outfile, index=True)
+    print("5 most important features:", df_importance.iloc[:5].index.to_list(), f"\n.. saved to {outfile}")
+        
 
-        ## predict on entire dataset and save final model
-        y_pred_final = final_model.predict(X) 
-        final_models_trained[model_name] = final_model 
-        joblib.dump(final_model, f"../models_trained/commercial/final_models/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib")
+    ## regression coefficients and significance of linear models 
+    with contextlib.suppress(Exception): 
+        model_coef = me.calc_regression_coefficients(final_model)
+        outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/regression_coefficients_{model_name}_{target}_{year}_{aoi_and_floodtype}.xlsx"
+        with prof.stage("to_excel"):
+            model_coef.round(3).to_excel(outfile, index=True)
+        print("Regression Coefficients:\n", model_coef.sort_values("probabilities", ascending=False), f"\n.. saved to {outfile}")
 
 
+    ## store fitted models and their evaluation results for the reduction step
+    outfile = job_result_file(aoi_and_floodtype, year, target, model_name)
+    with prof.stage("joblib.dump"):
+        joblib.dump(
+            {
+                "eval_set": data.Xy,
+                "models_scores": models_scores,
+                "predicted_values": me.residuals,
+                "final_model": final_model,
+                "importances": df_importance[f"{model_name}_importances"],   # only use mean FI, drop std of FI
+                "importances_repeats": importances["R2"][2],   # n_features x n_repeats, for confidence intervals of the ranking
+            },
+            outfile
+        )
+    print(f"Finished {model_name} for target {target}, results saved to {outfile}")
+
+    return outfile
+
+
+def fit_pipeline_streaming(job, chunk_size, n_jobs=1, n_iter=5, n_epochs=5, n_eval_samples=100_000):
+    """
+    Out-of-core variant of fit_pipeline() for datasets which do not fit into memory: 
+    the column store is read in chunks, models are trained incrementally (st.fit_incremental), 
+    evaluation and permutation importance run on the streamed out-of-fold chunks
+    job (sched.Job): aoi_and_floodtype, year, target and pipeline name
+    chunk_size (int): number of records read at once, bounds the memory
+    n_iter (int): sampled candidates of the inner hyperparameter search
+    n_epochs (int): passes of SGD over the training data (Elastic Net)
+    n_eval_samples (int): size of the random sample stored for partial dependence and residual plots
+    return: path to the stored job results
+    """
+    aoi_and_floodtype, year, target, model_name = job.aoi_and_floodtype, job.year, job.target, job.model_name
+    print( f"\nApplying {model_name} on {target} and {year} in chunks of {chunk_size} records")
+
+    dataset = st.ChunkedDataset(
+        convert_candidates(aoi_and_floodtype, year, target, chunksize=chunk_size), target, 
+        chunk_size=chunk_size, complete_cases=model_name in ("en", "rf"),
+    )
+    X_names = dataset.X_names
+    hyperparams_set = pp.load_config("../utils/hyperparameter_sets.json")
 
-        ## Feature importance of best model
+    ## nested cv, out-of-fold predictions are kept on disk
+    predictions_file = f"../models_trained/commercial/nested_cv_models/{aoi_and_floodtype}/oof_predictions_{model_name}_{target}_{year}_{aoi_and_floodtype}.npy"
+    results = st.streaming_nested_cv(
+        model_name, dataset, 
+        param_space=hyperparams_set[f"{model_name}_hyperparameters"],
+        kfolds_and_repeats=kfolds_and_repeats, 
+        n_iter=n_iter,
+        seed=seed,
+        predictions_file=predictions_file,
+        n_epochs=n_epochs,
+        n_jobs=n_jobs,
+    )
+    for params in results["best_params"]:
+        print(f"{model_name}: ", params)
+    models_scores = {f"test_{m}": results[f"test_{m}"] for m in score_metrics.keys()}
+
+    ## final model: best outer model based on MAE
+    best_idx = int(np.argmax(models_scores["test_MAE"]))
+    final_model = results["estimator"][best_idx]
+    print("used params for best model:", results["best_params"][best_idx])
+    with prof.stage("joblib.dump"):
+        joblib.dump(final_model, f"../models_trained/commercial/final_models/{aoi_and_floodtype}/{model_name}_{target}_{year}_{aoi_and_floodtype}.joblib")
 
-        importances = me.permutation_feature_importance(final_model, repeats=5)
+    ## permutation importance of the outer models on their out-of-fold chunks
+    importances = st.streaming_permutation_importances(
+        results["estimator"], dataset, kfolds_and_repeats, metrics=("R2", "MAE"), n_repeats=5, seed=seed,
+    )
+    df_importance = pd.DataFrame(
+        {
+            f"{model_name}_importances" : importances["R2"].importances_mean,
+            f"{model_name}_importances_std" : importances["R2"].importances_std,
+            f"{model_name}_importances_MAE" : importances["MAE"].importances_mean,
+            f"{model_name}_importances_MAE_std" : importances["MAE"].importances_std,
+        },
+        index=X_names,
+    )
+    outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/permutation_importances_{model_name}_{target}_{year}_{aoi_and_floodtype}.xlsx"
+    with prof.stage("to_excel"):
+        df_importance.round(4).to_excel(outfile, index=True)
+    print("5 most important features:", df_importance.iloc[:5].index.to_list(), f"\n.. saved to {outfile}")
+
+    ## random sample of records and their out-of-fold predictions for the plots of the reduction step
+    eval_set = dataset.sample(n_eval_samples, seed=seed)
+    y_pred = np.load(predictions_file, mmap_mode="r")[eval_set.index.to_numpy()]
+    predicted_values = pd.DataFrame(
+        {"y_true": eval_set[target], "y_pred": y_pred, "residuals": eval_set[target] - y_pred}, 
+        index=eval_set.index,
+    )
 
-        print("\nSelect features based on permutation feature importance")
-        df_importance = pd.DataFrame(
+    outfile = job_result_file(aoi_and_floodtype, year, target, model_name)
+    with prof.stage("joblib.dump"):
+        joblib.dump(
             {
-                f"{model_name}_importances" : importances[0],   # averaged importnace scores across repeats
-                f"{model_name}_importances_std" : importances[1]
+                "eval_set": eval_set,
+                "models_scores": models_scores,
+                "predicted_values": predicted_values,
+                "final_model": final_model,
+                "importances": df_importance[f"{model_name}_importances"],
+                "importances_repeats": importances["R2"].importances,   # n_features x n_repeats
             },
-            index=X_names,
+            outfile
         )
-        df_feature_importances = df_feature_importances.merge(
-            df_importance[f"{model_name}_importances"],   # only use mean FI, drop std of FI
-            left_index=True, right_index=True, how="outer")
-        print("5 most important features:", df_importance.iloc[:5].index.to_list())
-            
+    print(f"Finished {model_name} for target {target}, results saved to {outfile}")
+
+    return outfile
 
-        ## regression coefficients and significance of linear models 
-        with contextlib.suppress(Exception): 
-            models_coef[model_name] = me.calc_regression_coefficients(final_model)
-            outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/regression_coefficients_{model_name}_{target}_{year}_{aoi_and_floodtype}.xlsx"
-            models_coef[model_name].round(3).to_excel(outfile, index=True)
-            print("Regression Coefficients:\n", models_coef[model_name].sort_values("probabilities", ascending=False), f"\n.. saved to {outfile}")
-    
 
-        ## store fitted models and their evaluation results for later 
-        eval_sets[model_name] = df_Xy
-        models_scores[model_name] =  {
-            k: model_evaluation_results[k] for k in tuple("test_" + s for s in list(score_metrics.keys()))
-        } # get evaluation scores, metric names start with "test_<metricname>"
-        models_trained[f"{model_name}"] = models_trained_ncv
-        predicted_values[model_name] = me.residuals
-        final_models_trained[model_name] = final_model
+def reduce_target(aoi_and_floodtype, year, target):
+    """
+    Reduction step after all pipelines of one target are fitted:
+    performance table, weighted feature importances, selected features and plots
+    """
+    print("\n ##########  Starting reduction for ", year, target, "##############")
+
+    df_candidates = load_candidates(aoi_and_floodtype, year, target)
+    X_names = df_candidates.drop(target, axis=1).columns.to_list()
+
+    eval_sets = {}
+    final_models_trained = {}
+    predicted_values = {}
+    df_feature_importances = pd.DataFrame(index=X_names)
+    importances_repeats = {}
+    models_scores = {}
+
+    ## load stored results of all model jobs of this target
+    for pipe_name in pipelines:
+        model_name = pipe_name.split('_')[1]
+        job_results = joblib.load(job_result_file(aoi_and_floodtype, year, target, model_name))
+
+        eval_sets[model_name] = job_results["eval_set"]
+        models_scores[model_name] = job_results["models_scores"]
+        predicted_values[model_name] = job_results["predicted_values"]
+        final_models_trained[model_name] = job_results["final_model"]
+        df_feature_importances = df_feature_importances.merge(
+            job_results["importances"], 
+            left_index=True, right_index=True, how="outer")
+        importances_repeats[model_name] = pd.DataFrame(job_results["importances_repeats"], index=job_results["importances"].index)
 
 
 
     # ## Evaluation
 
     ## Evaluate models based on performance on outer cross-validation 
-    ## TODO remove overhead
-    xgb_model_evaluation = pd.DataFrame(models_scores["xgb"]).mean(axis=0)  # get mean of outer cv metrics (negative MAE and neg RMSE, pos. R2, pos MBE, posSMAPE)
-    xgb_model_evaluation_std = pd.DataFrame(models_scores["xgb"]).std(axis=0)   # get respective standard deviations
-    rf_model_evaluation = pd.DataFrame(models_scores["rf"]).mean(axis=0)
-    rf_model_evaluation_std = pd.DataFrame(models_scores["rf"]).std(axis=0)
-    en_model_evaluation = pd.DataFrame(models_scores["en"]).mean(axis=0)
-    en_model_evaluation_std = pd.DataFrame(models_scores["en"]).std(axis=0)
-
-    model_evaluation = pd.concat([en_model_evaluation, en_model_evaluation_std, xgb_model_evaluation, xgb_model_evaluation_std, rf_model_evaluation, rf_model_evaluation_std], axis=1)
-    model_evaluation.columns = ["en_score", "en_score_std", "xgb_score", "xgb_score_std", "rf_score", "rf_score_std"]
+    ## mean and standard deviation of outer cv metrics (negative MAE and neg RMSE, pos. R2, pos MBE, posSMAPE) per model
+    model_evaluation = pd.DataFrame()
+    for model_name, scores in models_scores.items():
+        model_evaluation[f"{model_name}_score"] = pd.DataFrame(scores).mean(axis=0)
+        model_evaluation[f"{model_name}_score_std"] = pd.DataFrame(scores).std(axis=0)
 
     model_evaluation.index = model_evaluation.index.str.replace("test_", "")
     model_evaluation.loc["MAE"] = model_evaluation.loc["MAE"].abs()
     model_evaluation.loc["RMSE"] = model_evaluation.loc["RMSE"].abs()
 
     outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/performance_{target}_{year}_{aoi_and_floodtype}.xlsx"
-    model_evaluation.round(3).to_excel(outfile, index=True)
+    with prof.stage("to_excel"):
+        model_evaluation.round(3).to_excel(outfile, index=True)
     print("Outer evaluation scores:\n", model_evaluation.round(3), f"\n.. saved to {outfile}")
 
 
@@ -280,15 +487,21 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
     ## **Overall FI ranking (procedure similar to Rözer et al 2019; Brill 2022)**
 
     ## weight FI scores based on performance ; weigth importances from better performed models stronger
-    model_weights =  {
-    "xgb_importances" : np.abs(models_scores["xgb"]["test_MAE"].mean()),
-    "en_importances" : np.abs(models_scores["en"]["test_MAE"].mean()),
-    "rf_importances" : np.abs(models_scores["rf"]["test_MAE"].mean()),
-    }
+    model_weights = {f"{model_name}_importances": np.abs(np.mean(scores["test_MAE"])) for model_name, scores in models_scores.items()}
 
     df_feature_importances_w = fs.calc_weighted_sum_feature_importances(df_feature_importances, model_weights)
     df_feature_importances_w.head(5)
 
+    ## ranking with bootstrap confidence intervals over the repeats of the permutation importances
+    df_ranking = agg.aggregate_importances(
+        np.stack([importances_repeats[model_name].reindex(X_names).to_numpy() for model_name in models_scores]),
+        [model_weights[f"{model_name}_importances"] for model_name in models_scores],
+        model_names=list(models_scores), feature_names=X_names, random_state=seed,
+    )
+    outfile = f"../models_evaluation/commercial/{aoi_and_floodtype}/feature_ranking_{target}_{year}_{aoi_and_floodtype}.xlsx"
+    with prof.stage("to_excel"):
+        df_ranking.round(3).to_excel(outfile, index=True)
+
 
     ####  Plot Feature importances
 
@@ -300,10 +513,11 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
     ## drop features which dont reduce the loss
     #df_feature_importances_plot = df_feature_importances_plot.loc[df_feature_importances_plot.weighted_sum_importances > 2, : ] 
 
+    model_names = [name.removesuffix("_importances") for name in model_weights]
     f.plot_stacked_feature_importances(
-        df_feature_importances_plot[["rf_importances_weighted", "en_importances_weighted", "xgb_importances_weighted",]],
+        df_feature_importances_plot[[f"{name}_importances_weighted" for name in model_weights]],
         target_name=target,
-        model_names_plot = ("Random Forest", "Elastic Net", "XGBoost"),
+        model_names_plot=[model_names_plot.get(model_name, model_name) for model_name in model_names],
         outfile=f"../models_evaluation/commercial/{aoi_and_floodtype}/feature_importances_{target}_{year}_{aoi_and_floodtype}.jpg"
     )
 
@@ -335,34 +549,22 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
 
 
     ## store partial dependences for each model
-    pdp_features = {a : {} for a in ["en", "xgb", "rf"]}
+    pdp_features = {model_name : {} for model_name in model_names}
+    pdp_scales = {}
 
 
-    ## get partial dependences
-    for model_name in ["xgb", "en", "rf"]:
+    ## partial dependences are computed lazily, only for the features which are plotted
+    for model_name in model_names:
 
         Xy_pdp = eval_sets[model_name].dropna() #  solve bug on sklearn.partial_dependece() which can not deal with NAN values
-        X_pdp, y_pdp = Xy_pdp[Xy_pdp.columns.drop(target)], Xy_pdp[target]
-        X_pdp = pd.DataFrame(
-            MinMaxScaler().fit_transform(X_pdp), # for same scaled pd plots across models
-            columns=X.columns
-            )
-        Xy_pdp = pd.concat([y_pdp, X_pdp], axis=1)
-
-        for predictor_name in X.columns.to_list(): 
-            features_info =  {
-                #"percentiles" : (0.05, .95) # causes NAN for some variables for XGB if (0, 1)
-                "model" : final_models_trained[model_name], 
-                "Xy" : Xy_pdp, 
-                "y_name" : target, 
-                "feature_name" : predictor_name, 
-                "scale"  : True
-            }         
-            if model_name != "crf":   
-                # print(predictor_name)
-                partial_dep = me.get_partial_dependence(**features_info)
+        X_pdp = Xy_pdp[X_names]   # unscaled, the pipelines scale inside
+        pdp_scales[model_name] = (X_pdp.min(), X_pdp.max() - X_pdp.min())   # for same scaled pd plots across models
 
-            pdp_features[model_name][predictor_name] = partial_dep
+        if model_name != "crf":   
+            pdp_features[model_name] = e.LazyPartialDependences(
+                final_models_trained[model_name], X_pdp, 
+                grid_resolution=50, #"percentiles" : (0.05, .95) # causes NAN for some variables for XGB if (0, 1)
+            )
 
 
 
@@ -373,13 +575,18 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
     most_important_features = df_feature_importances_plot.sort_values("weighted_sum_importances", ascending=False).index
 
     categorical = [] # ["flowvelocity", "further_variables .."]
-    ncols = 3
-    nrows = len(most_important_features[:10])
+    ncols = len(model_names)
+    nrows = len(most_important_features[:n_pdp_features])
     idx = 0
 
-    ## create PDP for all three models
-    for feature in most_important_features[:10]:
-        for model_name, color, idx_col in zip(["rf", "en", "xgb"], ["darkblue", "steelblue","grey"], [0, 1, 2]):
+    ## get partial dependences of plotted features in one pass per model
+    for model_name in model_names:
+        pdp_features[model_name].compute(most_important_features[:n_pdp_features])
+
+    ## create PDP for all models
+    colors = ["darkblue", "steelblue", "grey"] + list(mcolors.TABLEAU_COLORS.values())
+    for feature in most_important_features[:n_pdp_features]:
+        for idx_col, (model_name, color) in enumerate(zip(model_names, colors)):
             
             # idx position of subplot
             ax = plt.subplot(nrows, ncols, idx + 1 + idx_col)
@@ -387,6 +594,8 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
 
             # plot
             df_pd_feature = pdp_features[model_name][feature]  
+            x_min, x_range = pdp_scales[model_name][0][feature], pdp_scales[model_name][1][feature]
+            df_pd_feature = df_pd_feature.assign(**{feature: (df_pd_feature[feature] - x_min) / (x_range or 1.0)})
             f.plot_partial_dependence(
                 df_pd_feature, feature_name=feature, partial_dependence_name="yhat", 
                 categorical=[],
@@ -394,7 +603,8 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
                 **feature_info
                 )
 
-        idx = idx + 3
+        idx = idx + ncols
+    plt.close()
 
 
 
@@ -408,11 +618,113 @@ for year, target in itertools.product(years, targets): # iterate over years/comb
     # ### Plot prediction error 
     f.plot_residuals(
         residuals=predicted_values, 
-        model_names_abbreviation=["rf", "en", "xgb"],  
-        model_names_plot=["Random Forest", "Elastic Net", "XGBoost"],
+        model_names_abbreviation=model_names,  
+        model_names_plot=[model_names_plot.get(model_name, model_name) for model_name in model_names],
         outfile=f"../models_evaluation/commercial/{aoi_and_floodtype}/residuals_{target}_{year}_{aoi_and_floodtype}.jpg"
     )
 
 
-    print(f"Finished processing for target {target}")  # TODO add time measure at least for nested cv
+    print(f"Finished processing for target {target}")
+
+
+def main():
+
+    ## user-input -- settings for entire script
+    parser = argparse.ArgumentParser()
+    parser.add_argument("aoi_and_floodtype") # eg. "german_flash", "german_fluvial" 
+    parser.add_argument("year")  # string e.g "2002", "2021", "combi"
+    parser.add_argument(
+        "--mode", default="all", choices=["all", "fit", "reduce", "count", "convert"],
+        help="all: fit all jobs and reduce each target, fit: only fit jobs (single job if run as SLURM job array), "
+             "reduce: only reduction step of already fitted jobs, count: print number of jobs e.g. for sbatch --array, "
+             "convert: only convert csv files to column stores"
+    )
+    parser.add_argument("--n-workers", type=int, default=1, help="number of worker processes for the model jobs")
+    parser.add_argument(
+        "--n-jobs", type=int, default=None, 
+        help=f"total number of cores shared by all workers, -1 for all cores; defaults to env variable {par.N_JOBS_ENV} or SLURM_CPUS_PER_TASK"
+    )
+    parser.add_argument(
+        "--search", nargs="+", default=["random"], choices=t.SEARCH_METHODS, 
+        help="inner hyperparameter search, halving: successive halving, path: regularization path of Elastic Net, quantile: XGBoost on quantized data, "
+             "oob: Random Forest scored out-of-bag instead of inner folds; "
+             "several methods: the first one which applies to each model is used (other models: random)"
+    )
+    parser.add_argument(
+        "--halving-resource", default="n_samples", 
+        help="resource of successive halving: n_samples or a hyperparameter e.g. model__n_estimators (models without it use n_samples)"
+    )
+    parser.add_argument("--early-stopping-rounds", type=int, default=None, help="early stopping of XGBoost on a validation split of each inner fold")
+    parser.add_argument("--cache-dir", default="../models_trained/commercial/cache", help="cache for results of outer cv")
+    parser.add_argument("--cache-size-gb", type=float, default=10.0, help="size limit of cache, least recently used results are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="always refit models")
+    parser.add_argument("--no-checkpoints", action="store_true", help="do not checkpoint finished outer folds")
+    parser.add_argument(
+        "--chunk-size", type=int, default=None, 
+        help="out-of-core mode for datasets larger than memory: read this many records at once and train incrementally"
+    )
+    parser.add_argument("--n-epochs", type=int, default=5, help="passes of SGD over the training data in out-of-core mode (Elastic Net)")
+    parser.add_argument("--task-id", type=int, default=sched.slurm_array_task_id(), help="index of single job to run, defaults to SLURM_ARRAY_TASK_ID")
+    args = parser.parse_args()
+    aoi_and_floodtype = args.aoi_and_floodtype
+    years = [args.year]
+
+    jobs = sched.expand_jobs([aoi_and_floodtype], years, targets, pipelines)
+
+    if args.mode == "count":
+        print(len(jobs))
+        return
+
+    ## parse input csv files and create/update model settings once, all jobs open the same column stores and pipelines
+    ## (array tasks only read them, the convert step of submit_germany_floods.sh writes them before the tasks start)
+    if args.task_id is None or args.mode == "convert":
+        for key in sched.group_jobs(jobs):
+            convert_candidates(*key, chunksize=args.chunk_size)
+        p.main()  # create/update model settings
+        if args.mode == "convert":
+            return
+
+    create_output_dirs(aoi_and_floodtype)
+
+    ## each worker process gets its share of the cores for nested cv and permutation importance
+    n_jobs_per_worker = max(1, par.resolve_n_jobs(args.n_jobs) // args.n_workers)
+    search_settings = {
+        "search_method": args.search,
+        "halving_resource": args.halving_resource,
+        "early_stopping_rounds": args.early_stopping_rounds,
+    }
+    cache_settings = None if args.no_cache else {"cache_dir": args.cache_dir, "max_size_gb": args.cache_size_gb}
+    if args.chunk_size is not None:
+        fit_func = functools.partial(
+            profiled_fit, fit_pipeline_streaming, chunk_size=args.chunk_size, n_jobs=n_jobs_per_worker, n_epochs=args.n_epochs,
+        )
+    else:
+        fit_func = functools.partial(
+            profiled_fit, fit_pipeline, 
+            n_jobs=n_jobs_per_worker, 
+            search_settings=search_settings, 
+            cache_settings=cache_settings,
+            checkpoints=not args.no_checkpoints,
+        )
+
+    if args.mode == "reduce":
+        for key in sched.group_jobs(jobs):
+            profiled_reduce(*key)
+
+    elif args.mode == "fit" and args.task_id is not None:
+        fit_func(jobs[args.task_id])
+
+    elif args.mode == "fit":
+        sched.run_jobs(jobs, fit_func, n_workers=args.n_workers)
+
+    else:
+        sched.run_jobs(jobs, fit_func, reduce_func=profiled_reduce, n_workers=args.n_workers)
+
+    ## single tasks of a job array are merged by the reduction run
+    if args.task_id is None:
+        for year in years:
+            write_run_profile(aoi_and_floodtype, year)
+
 
+if __name__ == "__main__":
+    main()
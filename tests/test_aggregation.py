@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.preprocessing import MinMaxScaler
+
+import utils.aggregation as agg
+import utils.feature_selection as fs
+
+
+### Test weighted sum of feature importances
+# Array-based weighting has to give the same weighted sum as MinMaxScaler and one weighted column per model
+
+def test_weighted_sum_same_as_columnwise():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.random((10, 4)), columns=[f"{m}_importances" for m in ["xgb", "en", "rf", "svr"]], index=list("abcdefghij"))
+    df.iloc[2, 1] = np.nan
+    model_weights = {"xgb_importances": 0.2, "en_importances": 0.3, "rf_importances": 0.25, "svr_importances": 0.4}
+
+    reference = pd.DataFrame(MinMaxScaler(feature_range=(0, 10)).fit_transform(df), index=df.index, columns=df.columns)
+    reference = sum(reference[fi].fillna(0) / weight for fi, weight in model_weights.items())
+
+    df_weighted = fs.calc_weighted_sum_feature_importances(df, model_weights)
+    pd.testing.assert_series_equal(df_weighted["weighted_sum_importances"], reference.sort_values(), check_names=False)
+    assert df_weighted.columns.to_list()[-5:] == [f"{fi}_weighted" for fi in model_weights] + ["weighted_sum_importances"]
+
+
+### Test ranking with bootstrap confidence intervals
+# Ranking follows the weighted sum, confidence intervals enclose the point estimate and are reproducible
+
+def test_aggregate_importances():
+    rng = np.random.default_rng(0)
+    true_importances = np.array([5.0, 3.0, 1.0, 0.5, 0.0])
+    importances = true_importances[None, :, None, None] + rng.normal(scale=0.3, size=(3, 5, 4, 10))  # models x features x folds x repeats
+    feature_names = list("abcde")
+
+    df = agg.aggregate_importances(importances, [0.2, 0.3, 0.25], ["xgb", "en", "rf"], feature_names, n_bootstrap=200, random_state=42)
+    assert df.index.to_list() == feature_names
+    assert df["rank"].to_list() == [1, 2, 3, 4, 5]
+    assert (df["weighted_sum_ci_low"] <= df["weighted_sum_importances"]).all()
+    assert (df["weighted_sum_importances"] <= df["weighted_sum_ci_high"]).all()
+    assert df.loc["a", "rank_ci_high"] == 1
+
+    _, weighted_sum = agg.weighted_importances(importances.mean(axis=(2, 3)), [0.2, 0.3, 0.25])
+    np.testing.assert_allclose(df["weighted_sum_importances"], weighted_sum)
+    pd.testing.assert_frame_equal(
+        df, agg.aggregate_importances(importances, [0.2, 0.3, 0.25], ["xgb", "en", "rf"], feature_names, n_bootstrap=200, random_state=42)
+    )
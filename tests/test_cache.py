@@ -0,0 +1,42 @@
+
+import os
+import numpy as np
+
+import utils.cache as c
+
+
+### Test eviction of least recently used results
+# Cache must stay below its size limit, the result which was loaded most recently is kept
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    result = np.zeros(100_000)  # ~0.8 MB per entry
+    cache = c.ResultCache(tmp_path, max_size_gb=2.5 * result.nbytes / 1024**3)  # space for two entries
+
+    cache.put("a", result)
+    cache.put("b", result)
+    os.utime(tmp_path / "a.joblib", (0, 0))
+    os.utime(tmp_path / "b.joblib", (1, 1))
+    assert cache.get("a") is not None  # "a" becomes most recently used
+    cache.put("c", result)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.get("missing") is None
+
+
+### Test cache hit of an evicted result
+# A result evicted by another process right after loading it is still returned
+
+def test_result_cache_get_after_concurrent_eviction(tmp_path, monkeypatch):
+    cache = c.ResultCache(tmp_path)
+    cache.put("a", np.arange(3))
+
+    load = c.joblib.load
+    def load_and_evict(path):
+        result = load(path)
+        os.unlink(path)   # other process evicts the file
+        return result
+    monkeypatch.setattr(c.joblib, "load", load_and_evict)
+
+    np.testing.assert_array_equal(cache.get("a"), np.arange(3))
@@ -1,9 +1,12 @@
 ## TODO needs to be completed
 
 import numpy as np
+import pandas as pd
 
 from sklearn.preprocessing import MinMaxScaler
-from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import LinearRegression, ElasticNet
+from sklearn.model_selection import RepeatedKFold, RandomizedSearchCV, cross_validate
+from sklearn.metrics import make_scorer, mean_absolute_error
 
 import statsmodels.api as sm
 
@@ -43,3 +46,197 @@ def test_calc_p_values(df_Xy, target_name):
     p_values = e.calc_p_values(ts_b, newX)   
 
     assert (list(np.round(p_values_reference, 3)) == np.round(p_values, 3)).all(), "different calcuation of p values"
+
+
+
+### Test single-pass outer cv
+# Scores of the one-pass evaluation engine have to be the same as from sklearn.cross_validate() on the same outer folds,
+# each sample gets an out-of-fold prediction
+
+def test_nested_cv_predict_and_score():
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(60, 4)), columns=["a", "b", "c", "d"])
+    y = pd.Series(2 * X["a"] + rng.normal(size=60))
+    cv = RepeatedKFold(n_splits=3, n_repeats=2, random_state=42)
+    score_metrics = {"MAE": make_scorer(mean_absolute_error, greater_is_better=False), "R2": "r2"}
+    search = RandomizedSearchCV(
+        ElasticNet(), {"alpha": [0.01, 0.1, 1.0], "l1_ratio": [0.1, 0.9]},
+        cv=cv, n_iter=3, random_state=42,
+    )
+
+    results = e.nested_cv_predict_and_score(search, X, y, cv, score_metrics)
+    reference = cross_validate(search, X, y, cv=cv, scoring=score_metrics)
+
+    assert len(results["estimator"]) == 6
+    for metric in ["test_MAE", "test_R2"]:
+        np.testing.assert_allclose(results[metric], reference[metric])
+    assert results["y_pred"].shape == (60,)
+    assert not np.isnan(results["y_pred"]).any()
+
+
+class _CountingElasticNet(ElasticNet):
+    """ ElasticNet which counts its fits, to find out which outer folds were refitted """
+    n_fits = 0
+
+    def fit(self, X, y, **kwargs):
+        type(self).n_fits += 1
+        return super().fit(X, y, **kwargs)
+
+
+### Test resuming nested cv from checkpoints
+# Finished outer folds are loaded instead of refitted, half written checkpoints (.tmp) are ignored
+
+def test_nested_cv_resumes_from_checkpoints(tmp_path):
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(60, 3)), columns=["a", "b", "c"])
+    y = pd.Series(2 * X["a"] + rng.normal(size=60))
+    cv = RepeatedKFold(n_splits=3, n_repeats=1, random_state=42)
+    score_metrics = {"MAE": make_scorer(mean_absolute_error, greater_is_better=False)}
+    checkpoint_dir = tmp_path / "checkpoints"
+
+    results = e.nested_cv_predict_and_score(_CountingElasticNet(alpha=0.01), X, y, cv, score_metrics, checkpoint_dir=checkpoint_dir)
+    assert _CountingElasticNet.n_fits == 3
+    assert sorted(p.name for p in checkpoint_dir.iterdir()) == ["fold_0.joblib", "fold_1.joblib", "fold_2.joblib"]
+
+    ## job killed while writing the checkpoint of fold 1
+    (checkpoint_dir / "fold_1.joblib").unlink()
+    (checkpoint_dir / "fold_1.0123abcd.tmp").write_bytes(b"half written")
+
+    _CountingElasticNet.n_fits = 0
+    results_resumed = e.nested_cv_predict_and_score(_CountingElasticNet(alpha=0.01), X, y, cv, score_metrics, checkpoint_dir=checkpoint_dir)
+    assert _CountingElasticNet.n_fits == 1   # only fold 1 is refitted
+    np.testing.assert_allclose(results_resumed["test_MAE"], results["test_MAE"])
+    np.testing.assert_allclose(results_resumed["y_pred"], results["y_pred"])
+    assert (checkpoint_dir / "fold_1.joblib").exists()
+
+
+### Test batched partial dependence
+# Partial dependences of the batched engine have to be the same as from sklearn.partial_dependence() on the same grid
+
+def test_partial_dependences_brute():
+    from sklearn.inspection import partial_dependence
+    from sklearn.pipeline import Pipeline
+
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(80, 3)), columns=["a", "b", "c"])
+    X["c"] = rng.integers(0, 3, 80).astype(float)
+    y = 2 * X["a"] + X["c"] + rng.normal(size=80)
+    model = Pipeline([("scaler", MinMaxScaler()), ("model", ElasticNet(alpha=0.01))]).fit(X, y)
+
+    pdps = e.partial_dependences(model, X, grid_resolution=10, max_batch_rows=200)  # several predict batches
+
+    assert pdps["c"]["c"].to_list() == [0.0, 1.0, 2.0]  # unique values of features with few values
+    for feature in ["a", "c"]:
+        reference = partial_dependence(
+            model, X, [feature], custom_values={feature: pdps[feature][feature].values}, kind="average"
+        )
+        np.testing.assert_allclose(pdps[feature]["yhat"], reference.average[0])
+
+
+
+### Test lazy partial dependence
+# Nothing is computed before a feature is requested, values equal partial_dependences(), repeated requests are cached
+
+def test_lazy_partial_dependences(monkeypatch):
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(80, 3)), columns=["a", "b", "c"])
+    y = 2 * X["a"] - X["b"] + rng.normal(size=80)
+    model = ElasticNet(alpha=0.01).fit(X, y)
+    reference = e.partial_dependences(model, X, grid_resolution=10)
+
+    computed = []
+    partial_dependences = e.partial_dependences
+    def counting_partial_dependences(*args, features, **kwargs):
+        computed.append(features)
+        return partial_dependences(*args, features=features, **kwargs)
+    monkeypatch.setattr(e, "partial_dependences", counting_partial_dependences)
+
+    pdps = e.LazyPartialDependences(model, X, grid_resolution=10)
+    assert len(pdps) == 3 and list(pdps) == ["a", "b", "c"]
+    assert computed == [] and pdps.computed_features == []
+
+    pdps.compute(["b", "a"])
+    pd.testing.assert_frame_equal(pdps["a"], reference["a"])
+    pd.testing.assert_frame_equal(pdps["b"], reference["b"])
+    assert computed == [["b", "a"]]   # one pass for both features, no recomputation on access
+    pd.testing.assert_frame_equal(pdps["c"], reference["c"])
+    pdps["c"]
+    assert computed == [["b", "a"], ["c"]] and pdps.computed_features == ["b", "a", "c"]
+
+### Test permutation importance engine
+# Same seed has to give the same importances as sklearn.permutation_importance(), independent of the number of workers
+
+def test_permutation_importances_same_as_sklearn():
+    from sklearn.inspection import permutation_importance
+
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(50, 3)), columns=["a", "b", "c"])
+    y = 2 * X["a"] + rng.normal(size=50)
+    model = ElasticNet(alpha=0.01).fit(X, y)
+    mae = make_scorer(mean_absolute_error, greater_is_better=False)
+
+    reference_r2 = permutation_importance(model, X, y, n_repeats=4, random_state=42)
+    reference_mae = permutation_importance(model, X, y, n_repeats=4, random_state=42, scoring=mae)
+    importances = e.permutation_importances(
+        model, X, y, score_metrics={"R2": "r2", "MAE": mae}, n_repeats=4, random_state=42, n_jobs=2
+    )
+
+    np.testing.assert_allclose(importances["R2"].importances, reference_r2.importances)
+    np.testing.assert_allclose(importances["MAE"].importances_mean, reference_mae.importances_mean)
+
+
+### Test stratified permutation
+# Records are only shuffled within their stratum
+
+def test_stratified_permutation_indices():
+    strata = np.array([0, 1, 0, 1, 2, 2, 0, 1])
+    permutations = e.stratified_permutation_indices(strata, n_repeats=5, random_state=42)
+
+    for permutation in permutations:
+        assert sorted(permutation) == list(range(8))
+        np.testing.assert_array_equal(strata[permutation], strata)
+
+
+
+### Test strata of conditional permutation
+# Codes of many conditioning features do not overflow, records with the same bins of all features share a stratum
+
+def test_conditional_strata_many_features():
+    rng = np.random.default_rng(42)
+    X = pd.DataFrame(rng.normal(size=(200, 40)), columns=[f"f{j}" for j in range(40)])
+    X.iloc[::7, 3] = np.nan
+
+    strata = e.conditional_strata(X, "f0", X.columns.to_list(), n_bins=4)
+    assert strata.min() == 0 and strata.max() < 200
+    assert len(np.unique(strata)) == 200   # 4^39 bins, each record in its own stratum
+
+    strata = e.conditional_strata(X, "f0", ["f1", "f2"], n_bins=4)
+    bins = np.column_stack([pd.qcut(X[col], 4, labels=False) for col in ["f1", "f2"]])
+    _, reference = np.unique(bins, axis=0, return_inverse=True)
+    np.testing.assert_array_equal(strata, reference.reshape(-1))
+
+    ## many correlated predictors: only the most correlated ones are conditioned on, the feature is still permuted
+    X = pd.DataFrame(rng.normal(size=(200, 1)) + 0.5 * rng.normal(size=(200, 12)), columns=[f"f{j}" for j in range(12)])
+    y = X["f0"] + 0.1 * rng.normal(size=200)
+    model = LinearRegression().fit(X, y)
+    importances = e.conditional_permutation_importances(model, X, y, threshold=0.5, n_repeats=3, random_state=42)
+    assert importances["R2"].importances_mean[0] > 0.3   # conditioned on all 11 predictors: almost no record is permuted
+# Coefficients and p-values have to be the same as from scipy spearmanr, pairs with too few records are nan
+
+def test_spearman_correlation_same_as_scipy():
+    from scipy.stats import spearmanr
+
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame(rng.normal(size=(60, 4)), columns=["a", "b", "c", "d"])
+    df["b"] = df["a"] + rng.normal(size=60)
+    df["d"] = rng.integers(0, 4, 60).astype(float)   # ties
+
+    rho, pvalues = e.spearman_correlation(df)
+    rho_reference, pvalues_reference = spearmanr(df)
+    np.testing.assert_allclose(rho.values, rho_reference, atol=1e-12)
+    np.testing.assert_allclose(pvalues.values, pvalues_reference, atol=1e-12)
+
+    df.loc[:50, "c"] = np.nan   # pairs with c have only 9 complete records
+    rho, pvalues = e.spearman_correlation(df, min_periods=10)
+    assert rho["c"].isna().all() and pvalues["c"].isna().all()
+    np.testing.assert_allclose(rho.loc["a", "b"], rho_reference[0, 1])
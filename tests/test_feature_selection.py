@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from sklearn.preprocessing import MinMaxScaler
+import statsmodels.api as sm
+from statsmodels.stats.outliers_influence import variance_inflation_factor
+
+import utils.feature_selection as fs
+import utils.synthetic as syn
+
+
+### Test VIF from the inverted matrix
+# VIFs from one inversion must equal one statsmodels OLS per column (without and with constant), 
+# perfectly collinear columns get inf
+
+def test_vif_values_same_as_statsmodels():
+    df_Xy = syn.make_flood_loss_data(n_rows=500, n_features=8, nan_rate=0.0, correlation=0.7, seed=0)
+    X = MinMaxScaler().fit_transform(df_Xy.drop("rloss_b", axis=1))
+    others = lambda i: np.delete(X, i, axis=1)
+
+    vifs_reference = [1 / (1 - sm.OLS(X[:, i], sm.add_constant(others(i))).fit().rsquared) for i in range(X.shape[1])]
+    np.testing.assert_allclose(fs.vif_values(X), vifs_reference, rtol=1e-6)
+
+    vifs_reference = [1 / (1 - sm.OLS(X[:, i], others(i)).fit().rsquared) for i in range(X.shape[1])]
+    np.testing.assert_allclose(fs.vif_values(X, centered=False), vifs_reference, rtol=1e-6)
+
+    X_collinear = np.column_stack([X, X[:, 0] + X[:, 1]])
+    vifs = fs.vif_values(X_collinear)
+    assert np.isinf(vifs[[0, 1, -1]]).all() and np.isfinite(vifs[2:-1]).all()
+
+
+### Test VIF scores
+# Default VIF scores are the same as statsmodels variance_inflation_factor on the design with constant
+
+def test_vif_score_same_as_statsmodels_with_constant():
+    df_Xy = syn.make_flood_loss_data(n_rows=500, n_features=6, nan_rate=0.0, correlation=0.6, seed=2)
+    X = df_Xy.drop("rloss_b", axis=1)
+    X = pd.DataFrame(MinMaxScaler().fit_transform(X), columns=X.columns)
+
+    design = sm.add_constant(X.values)
+    vifs_reference = pd.Series([variance_inflation_factor(design, i + 1) for i in range(X.shape[1])], index=X.columns)
+    df_vif = fs.vif_score(X).set_index("names")["vif_scores"]
+    np.testing.assert_allclose(df_vif[X.columns], vifs_reference, rtol=1e-6)
+    assert df_vif.is_monotonic_decreasing
+
+
+### Test iterative VIF elimination
+# The downdated inverse must give the same VIFs as a new inversion of the kept features
+
+def test_drop_high_vif_features():
+    df_Xy = syn.make_flood_loss_data(n_rows=500, n_features=12, nan_rate=0.0, correlation=0.9, seed=1)
+    X = df_Xy.drop("rloss_b", axis=1)
+    X = pd.DataFrame(MinMaxScaler().fit_transform(X), columns=X.columns)
+    X["f0_copy"] = X["f0"]
+
+    X_kept, df_dropped = fs.drop_high_vif_features(X, threshold=5)
+    assert "f0_copy" in df_dropped["names"].to_list() or "f0" in df_dropped["names"].to_list()
+    assert len(df_dropped) + X_kept.shape[1] == X.shape[1]
+    assert fs.vif_values(X_kept.values).max() <= 5
+
+    ## each drop is the highest VIF among the remaining features
+    remaining = X.columns.to_list()
+    for name, vif in df_dropped.itertuples(index=False):
+        vifs = fs.vif_values(X[remaining].values)
+        assert remaining[int(np.argmax(vifs))] == name or np.isinf(vif)
+        remaining.remove(name)
+
+
+### Test equal frequency binning
+# Same categories as pd.qcut for all variables at once, duplicated edges are dropped (constant variables are nan), 
+# fitted edges apply to new data
+
+def test_equal_frequency_binning_same_as_qcut():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "a": rng.normal(size=200), 
+        "b": rng.integers(0, 10, 200).astype(float), 
+        "c": np.r_[np.zeros(150), rng.random(50)],   # duplicated edges
+        "d": np.ones(200),   # constant, single edge
+    })
+    df.loc[::17, "a"] = np.nan
+
+    binning = fs.EqualFrequencyBinning(cuts=3, group_labels=["low", "medium", "high"])
+    df_binned = binning.fit_transform(df)
+
+    for col in ["a", "b"]:
+        reference = pd.qcut(df[col], q=3, labels=["low", "medium", "high"])
+        pd.testing.assert_series_equal(df_binned[f"{col}_c"], reference, check_names=False)
+    reference = pd.qcut(df["c"], q=3, duplicates="drop")
+    np.testing.assert_array_equal(df_binned["c_c"].cat.codes, reference.cat.codes)
+    assert df_binned["c_c"].cat.codes.dtype == np.int8
+    reference = pd.qcut(df["d"], q=3, duplicates="drop")
+    np.testing.assert_array_equal(df_binned["d_c"].cat.codes, reference.cat.codes)
+    assert df_binned["d_c"].isna().all()
+
+    df_new = df.iloc[:20]
+    pd.testing.assert_frame_equal(binning.transform(df_new), df_binned.iloc[:20])
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+import utils.parallel as par
+import utils.preprocessing as pp
+
+
+def _worker_view(data):
+    """ values, dtype and file of the memory-mapped array behind the view a worker process gets """
+    values = np.asarray(par.shared(data))
+    memmap = par.backing_memmap(values)
+    return values.copy(), values.dtype, memmap is not None and str(memmap.filename)
+
+
+### Test shared data for worker processes
+# Workers get readonly views onto one memory-mapped file with the dtype of the source, not copies;
+# views onto a column store are not published again
+
+def test_shared_for_workers(tmp_path):
+    df = pd.DataFrame(np.random.default_rng(0).random((100, 3)).astype(np.float32), columns=["a", "b", "c"])
+
+    with par.shared_for_workers(2, df, df["a"]) as (X_workers, y_workers):
+        assert isinstance(X_workers, par.SharedFrame)
+        results = Parallel(n_jobs=2)(delayed(_worker_view)(d) for d in [X_workers, y_workers])
+        for (values, dtype, filename), data, shared in zip(results, [df, df["a"]], [X_workers, y_workers]):
+            np.testing.assert_array_equal(values, data.to_numpy())
+            assert dtype == np.float32
+            assert filename == shared.path   # view onto the published file, not a copy
+    assert not (tmp_path / X_workers.path).exists()
+
+    df.to_csv(tmp_path / "survey.csv", index=False)
+    store = pp.load_column_store(pp.csv_to_column_store(tmp_path / "survey.csv", str(tmp_path / "store")))
+    with par.shared_for_workers(2, store) as (store_workers,):
+        assert store_workers.path is None   # already shared by joblib
+        values, dtype, filename = Parallel(n_jobs=2)(delayed(_worker_view)(store_workers) for _ in range(1))[0]
+    np.testing.assert_array_equal(values, df.to_numpy())
+    assert dtype == np.float32 and filename.endswith("values.npy")
+
+
+### Test core budget
+# The number of cores comes from the flag, FLOOD_LOSS_N_JOBS or SLURM_CPUS_PER_TASK and is never below 1,
+# outer x inner x estimator never exceeds it
+
+def test_resolve_n_jobs(monkeypatch):
+    monkeypatch.delenv(par.N_JOBS_ENV, raising=False)
+    monkeypatch.delenv("SLURM_CPUS_PER_TASK", raising=False)
+    assert par.resolve_n_jobs() == 1
+
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "8")
+    assert par.resolve_n_jobs() == 8
+    monkeypatch.setenv(par.N_JOBS_ENV, "4")   # takes precedence over slurm
+    assert par.resolve_n_jobs() == 4
+    assert par.resolve_n_jobs(2) == 2   # explicit flag takes precedence over env
+
+    assert par.resolve_n_jobs(0) == 1
+    assert par.resolve_n_jobs(-1) == par.available_cores()
+    assert par.resolve_n_jobs(-1000) == 1
+
+
+def test_split_budget():
+    for n_jobs in [1, 2, 3, 7, 16, 64]:
+        for n_outer_folds in [1, 5, 15]:
+            for n_inner_fits in [None, 1, 4, 50]:
+                budget = par.split_budget(n_jobs, n_outer_folds, n_inner_fits)
+                assert min(budget.outer, budget.inner, budget.estimator) >= 1
+                assert budget.total <= n_jobs
+                assert budget.outer <= n_outer_folds
+                assert n_inner_fits is None or budget.inner <= n_inner_fits
+
+    assert par.split_budget(16, 5, 50) == par.ParallelBudget(outer=5, inner=3, estimator=1)
+    assert par.split_budget(16, 4, 2) == par.ParallelBudget(outer=4, inner=2, estimator=2)
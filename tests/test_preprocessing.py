@@ -0,0 +1,150 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.preprocessing as pp
+
+
+### Test prepared dataset
+# X and y are views onto the same float array (target first or last), records with nan in target (or any nan for complete cases) are dropped
+
+def test_prepared_dataset_without_copies():
+    values = np.random.default_rng(0).random((50, 4))
+    values[3, 0] = np.nan   # nan in predictor
+    values[7, 3] = np.nan   # nan in target
+    df_Xy = pd.DataFrame(values, columns=["a", "b", "c", "target"])
+
+    data = pp.PreparedDataset(df_Xy, "target")
+    assert data.shape == (49, 4)
+    assert data.X.columns.to_list() == ["a", "b", "c"]
+    assert np.shares_memory(data.X.to_numpy(), data.values)
+    assert np.shares_memory(data.y.to_numpy(), data.values)
+    pd.testing.assert_series_equal(data.y, df_Xy["target"].dropna())
+
+    ## target first as in the survey extracts, X and y are views onto the array of the dataset
+    df_target_first = pd.DataFrame(np.ascontiguousarray(values[:, [3, 0, 1, 2]]), columns=["target", "a", "b", "c"])
+    df_target_first = df_target_first.dropna(subset=["target"])
+    data = pp.PreparedDataset(df_target_first, "target")
+    assert data.X.columns.to_list() == ["a", "b", "c"]
+    assert np.shares_memory(data.values, df_target_first.to_numpy())
+    assert np.shares_memory(data.X.to_numpy(), data.values) and np.shares_memory(data.y.to_numpy(), data.values)
+    pd.testing.assert_frame_equal(data.Xy, df_target_first)
+
+    data = pp.PreparedDataset(df_Xy[["target", "a", "b", "c"]], "target", complete_cases=True)
+    assert data.n_dropped == 2
+    pd.testing.assert_frame_equal(data.X, df_Xy.dropna()[["a", "b", "c"]])
+    pd.testing.assert_series_equal(data.y, df_Xy.dropna()["target"])
+
+
+### Test indexed fuzzy merge
+# The bigram index must give the same merged DataFrame as comparing each query against all values with difflib
+
+def test_fuzzy_merge_indexed_same_as_difflib():
+    rng = np.random.default_rng(0)
+    letters = list("abcdefghijklmnopqrstuvwxyz ")
+    names = ["".join(rng.choice(letters, size=rng.integers(3, 15))) for _ in range(300)]
+    typos = []
+    for name in names[:150]:
+        chars = list(name)
+        chars[rng.integers(len(chars))] = rng.choice(letters)   # one substituted character
+        typos.append("".join(chars))
+    left = pd.DataFrame({"name": names, "left_id": range(300)})
+    right = pd.DataFrame({"name_right": typos + names[150:200] + ["xyz", "a"], "right_id": range(202)})
+
+    for cutoff in [0.6, 0.8, 0.9]:
+        merged = pp.FuzzyMerge(left, right, "name", "name_right", cutoff=cutoff, indexed=False).main()
+        merged_indexed = pp.FuzzyMerge(left, right, "name", "name_right", cutoff=cutoff, batch_size=50, n_jobs=2).main()
+        pd.testing.assert_frame_equal(merged_indexed, merged)
+
+
+### Test survey cleaning
+# Only columns with strings are cleaned, decimal commas are repaired and mostly numeric columns are converted,
+# chunks give the same result and stats as the entire file
+
+def test_survey_cleaning(tmp_path):
+    df = pd.DataFrame({
+        "area": ["1,5", ",5", " ", "", 3, None, "12"] * 3,
+        "loss": np.arange(21, dtype=float),
+        "comment": ["dry", "wet", "5", "", "wet", None, "dry"] * 3,
+        "damage.specify": ["roof"] * 21,
+    })
+    pd.testing.assert_frame_equal(
+        pp.drop_typos(df), 
+        df.replace({" ": np.nan, "": np.nan}).replace({"^,": "0.", ",": "."}, regex=True),
+    )
+    assert pp.drop_object_columns(df).columns.to_list() == ["area", "loss", "comment"]
+
+    cleaning = pp.SurveyCleaning(min_numeric_share=0.8)
+    df_clean = cleaning.clean(df)
+    np.testing.assert_array_equal(df_clean["area"], [1.5, 0.5, np.nan, np.nan, 3.0, np.nan, 12.0] * 3)
+    assert df_clean["comment"].iloc[0] == "dry"
+    assert cleaning.stats_.loc["area"].to_dict() == {
+        "n_values": 18, "n_empty": 6, "n_comma_repaired": 6, "n_converted": 9, "n_failed": 0, "converted": True
+    }
+    assert not cleaning.stats_.loc["comment", "converted"]
+
+    df.to_csv(tmp_path / "survey.csv", index=False)
+    cleaning_chunks = pp.SurveyCleaning(min_numeric_share=0.8)
+    df_chunks = cleaning_chunks.clean_csv(tmp_path / "survey.csv", chunksize=7, dtype={"area": str, "comment": str})
+    df_all = pp.SurveyCleaning(min_numeric_share=0.8).clean_csv(tmp_path / "survey.csv", dtype={"area": str, "comment": str})
+    pd.testing.assert_frame_equal(df_chunks, df_all)
+    pd.testing.assert_frame_equal(df_chunks["area"].to_frame().reset_index(drop=True), df_clean[["area"]])
+
+
+### Test column store
+# Values, dtype and category codes survive the round trip, chunked conversion gives the same store,
+# typos in numeric columns become nan with a warning, text columns must be categorical and a store is only current for
+# the csv version it was converted from
+
+def test_column_store_round_trip(tmp_path):
+    csv_file = tmp_path / "survey.csv"
+    df = pd.DataFrame({
+        "rloss": [0.1, 0.5, np.nan, 0.9, 0.0, 0.3],
+        "flood_type": ["river", "pluvial", "river", None, "coastal", "pluvial"],
+        "area": ["120", "85", "1o0", "60", "", "95"],   # typo in numeric column
+        "floor": [1, 2, 2, 1, 3, 12],   # numeric codes of a categorical column
+    })
+    df.to_csv(csv_file, index=False)
+
+    stores = {}
+    for chunksize in [None, 2]:
+        with pytest.warns(UserWarning, match="'area': 1"):   # the typo
+            store_dir = pp.csv_to_column_store(
+                str(csv_file), str(tmp_path / f"store_{chunksize}"), categorical=["flood_type", "floor"], chunksize=chunksize
+            )
+        stores[chunksize] = pp.load_column_store(store_dir)
+    for store in stores.values():
+        assert store.columns.to_list() == df.columns.to_list()
+        assert (store.dtypes == np.float32).all()
+        np.testing.assert_allclose(store["rloss"], df["rloss"].astype(np.float32))
+        np.testing.assert_array_equal(store["area"], [120, 85, np.nan, 60, np.nan, 95])
+        np.testing.assert_array_equal(store["flood_type"], [2, 1, 2, np.nan, 0, 1])   # sorted categories
+    pd.testing.assert_frame_equal(stores[None], stores[2])
+
+    store = pp.load_column_store(str(tmp_path / "store_2"), as_categorical=True)
+    assert store["flood_type"].to_list()[:3] == ["river", "pluvial", "river"]
+    assert store["floor"].to_list() == ["1", "2", "2", "1", "3", "12"]
+
+    ## text column which is not listed as categorical: no store of nan values
+    for chunksize in [None, 2]:
+        with pytest.raises(ValueError, match="flood_type"):
+            pp.csv_to_column_store(str(csv_file), str(tmp_path / "store_text"), categorical=["floor"], chunksize=chunksize)
+    assert not any(path.name.startswith("store_text") for path in tmp_path.iterdir())
+
+
+def test_column_store_is_current(tmp_path):
+    csv_file = tmp_path / "survey.csv"
+    store_dir = str(tmp_path / "store")
+    pd.DataFrame({"a": [1.0, 2.0]}).to_csv(csv_file, index=False)
+    assert not pp.column_store_is_current(str(csv_file), store_dir)
+
+    pp.csv_to_column_store(str(csv_file), store_dir)
+    assert pp.column_store_is_current(str(csv_file), store_dir)
+
+    pd.DataFrame({"a": [1.0, 2.0, 3.0]}).to_csv(csv_file, index=False)
+    os.utime(csv_file, (0, 0))
+    assert not pp.column_store_is_current(str(csv_file), store_dir)
+    pp.csv_to_column_store(str(csv_file), store_dir)   # replaces the existing store
+    assert pp.load_column_store(store_dir).shape == (3, 1)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["store", "survey.csv"]   # no temporary folders left
@@ -0,0 +1,32 @@
+import json
+
+import numpy as np
+
+import utils.profiling as prof
+
+
+### Test nested stages
+# Records carry the labels and parent stage, the peak memory of a stage includes the peaks of its nested stages
+
+def test_nested_stages(tmp_path):
+    profiler = prof.Profiler()
+
+    with profiler.labels(model="en", target="rloss_b"):
+        with profiler.stage("outer"):
+            with profiler.stage("allocate"):
+                np.ones(20_000_000).sum()  # ~150 MB
+            with profiler.stage("small", step=2):
+                pass
+
+    records = {record["stage"]: record for record in profiler.records}
+    assert list(records) == ["allocate", "small", "outer"]  # in order of completion
+    assert records["allocate"]["parent"] == "outer" and records["outer"]["parent"] is None
+    assert records["small"]["model"] == "en" and records["small"]["step"] == 2
+    assert records["outer"]["peak_rss_mb"] >= records["allocate"]["peak_rss_mb"]
+    assert records["outer"]["wall_time_s"] >= records["allocate"]["wall_time_s"]
+
+    outfile = profiler.dump(str(tmp_path / "profile.json"))
+    assert profiler.records == []
+    df_profile = prof.merge_profiles([outfile], str(tmp_path / "run_profile.json"))
+    assert df_profile.shape[0] == 3
+    assert len(json.load(open(tmp_path / "run_profile.json"))) == 3
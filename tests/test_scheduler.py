@@ -0,0 +1,42 @@
+import time
+
+import utils.scheduler as sched
+
+
+def _fit(job):
+    """ job which finishes at different times, returns its finishing time """
+    time.sleep(0.05 * (hash(job.pipe_name) % 3))
+    return time.time()
+
+
+### Test job array mapping
+# Each SLURM array task id selects exactly one job, all jobs are covered by the task ids 0 .. n_jobs - 1
+
+def test_slurm_array_task_maps_to_one_job(monkeypatch):
+    jobs = sched.expand_jobs(["aoi"], ["2013", "2016"], ["rloss", "bloss"], ["pipe_en", "pipe_xgb", "pipe_rf"])
+    assert len(jobs) == len(set(jobs)) == 12
+
+    selected = []
+    for task_id in range(len(jobs)):
+        monkeypatch.setenv("SLURM_ARRAY_TASK_ID", str(task_id))
+        selected.append(jobs[sched.slurm_array_task_id()])
+    assert selected == jobs
+
+    monkeypatch.delenv("SLURM_ARRAY_TASK_ID")
+    assert sched.slurm_array_task_id() is None
+
+
+### Test reduction per target
+# The reduction of each target runs once, after all its model jobs finished, sequentially and on a process pool
+
+def test_reduction_runs_once_after_all_jobs_of_target():
+    jobs = sched.expand_jobs(["aoi"], ["2013"], ["rloss", "bloss", "closs"], ["pipe_en", "pipe_xgb", "pipe_rf"])
+
+    for n_workers in [1, 3]:
+        reductions = []
+        results = sched.run_jobs(jobs, _fit, reduce_func=lambda *key: reductions.append((key, time.time())), n_workers=n_workers)
+
+        assert set(results) == set(jobs)
+        assert sorted(key for key, _ in reductions) == sorted(sched.group_jobs(jobs))   # once per target
+        for key, reduce_time in reductions:
+            assert all(results[job] <= reduce_time for job in sched.group_jobs(jobs)[key])
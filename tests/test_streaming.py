@@ -0,0 +1,80 @@
+import warnings
+
+import numpy as np
+from sklearn.metrics import mean_absolute_error, r2_score
+
+import utils.streaming as st
+import utils.evaluation_metrics as em
+import utils.preprocessing as pp
+import utils.synthetic as syn
+
+
+### Test metrics accumulated over chunks
+# Must be equal to the metrics calculated on the entire dataset, signed like sklearn scorers
+
+def test_streaming_scores_same_as_in_memory():
+    rng = np.random.default_rng(0)
+    y_true, y_pred = rng.random(1000), rng.random(1000)
+
+    scores = st.StreamingScores()
+    for chunk in np.array_split(np.arange(1000), 7):
+        scores.update(y_true[chunk], y_pred[chunk])
+    scores = scores.scores()
+
+    np.testing.assert_allclose(scores["MAE"], -mean_absolute_error(y_true, y_pred))
+    np.testing.assert_allclose(scores["RMSE"], -em.root_mean_squared_error(y_true, y_pred))
+    np.testing.assert_allclose(scores["MBE"], -em.mean_bias_error(y_true, y_pred))
+    np.testing.assert_allclose(scores["R2"], r2_score(y_true, y_pred))
+    np.testing.assert_allclose(scores["SMAPE"], -em.symmetric_mean_absolute_percentage_error(y_true, y_pred))
+
+
+### Test fold assignment
+# Folds are reproduced in each pass over the data, independent of how the rows are chunked
+
+def test_fold_ids_independent_of_chunks():
+    rows = np.arange(10_000)
+    folds = st.fold_ids(rows, 2, 42, 0)
+    chunked = np.concatenate([st.fold_ids(chunk, 2, 42, 0) for chunk in np.array_split(rows, 13)])
+
+    np.testing.assert_array_equal(folds, chunked)
+    assert abs(folds.mean() - 0.5) < 0.02
+    assert not np.array_equal(folds, st.fold_ids(rows, 2, 42, 1))  # next repeat is split differently
+
+
+### Test out-of-core nested cv
+# Each model kind is trained incrementally on the streamed folds, scored on all out-of-fold records
+# and its permutation importances rank an informative predictor above a noise predictor
+
+def test_streaming_nested_cv_end_to_end(tmp_path):
+    df_Xy = syn.make_flood_loss_data(n_rows=600, n_features=6, n_informative=2, nan_rate=0.02, seed=0)
+    df_Xy.to_csv(tmp_path / "survey.csv", index=False)
+    store_dir = pp.csv_to_column_store(tmp_path / "survey.csv", str(tmp_path / "store"))
+    param_spaces = {
+        "en": {"model__alpha": [0.0001, 0.001], "model__l1_ratio": [0.5]},
+        "rf": {"model__n_estimators": [7], "model__max_depth": [4, None]},
+        "xgb": {"model__n_estimators": [20], "model__max_depth": [2, 3]},
+    }
+
+    for model_name, param_space in param_spaces.items():
+        dataset = st.ChunkedDataset(store_dir, "rloss_b", chunk_size=64, complete_cases=model_name != "xgb")
+        predictions_file = str(tmp_path / f"predictions_{model_name}.npy")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", UserWarning)   # e.g. missing external memory cache of XGBoost
+            results = st.streaming_nested_cv(
+                model_name, dataset, param_space, kfolds_and_repeats=(2, 2), n_iter=2, seed=42, 
+                predictions_file=predictions_file, n_epochs=2,
+            )
+
+        assert len(results["estimator"]) == len(results["best_params"]) == 4
+        assert np.isfinite(results["test_MAE"]).all() and (results["test_MAE"] < 0).all()
+        if model_name == "rf":
+            assert all(len(model[-1].estimators_) == 7 for model in results["estimator"])   # more chunks than trees
+
+        predictions = np.load(predictions_file)
+        valid = np.concatenate([rows for rows, _, _ in dataset.chunks()])
+        assert np.isfinite(predictions[valid]).all()
+        assert np.isnan(np.delete(predictions, valid)).all()
+
+        importances = st.streaming_permutation_importances(results["estimator"], dataset, kfolds_and_repeats=(2, 2), n_repeats=3, seed=42)
+        assert importances["R2"].importances.shape == (6, 3)
+        assert importances["R2"].importances_mean[0] > importances["R2"].importances_mean[5]   # f0 drives the loss, f5 is noise
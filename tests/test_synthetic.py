@@ -0,0 +1,24 @@
+import numpy as np
+
+import utils.synthetic as syn
+
+
+### Test synthetic flood-loss dataset
+# Settings for missing values, zero-loss records and correlation structure must be reflected in the data
+
+def test_make_flood_loss_data():
+    df_Xy = syn.make_flood_loss_data(
+        n_rows=5000, n_features=8, nan_rate=0.1, zero_loss_fraction=0.3, correlation=0.6, group_size=4,
+        ordinal_fraction=0.25, seed=0,
+    )
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"]
+
+    assert df_Xy.columns[0] == "rloss_b" and X.shape == (5000, 8)
+    assert y.notna().all() and y.between(0, 1).all()
+    np.testing.assert_allclose((y == 0).mean(), 0.3, atol=0.01)
+    np.testing.assert_allclose(X.isna().mean().mean(), 0.1, atol=0.01)
+    assert set(X["f7"].dropna().unique()) == {1, 2, 3, 4, 5}   # ordinal answers
+
+    corr = X.iloc[:, :4].corr().to_numpy()
+    np.testing.assert_allclose(corr[np.triu_indices(4, 1)], 0.6, atol=0.05)   # same group
+    assert abs(X["f0"].corr(X["f4"])) < 0.1   # different groups
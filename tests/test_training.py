@@ -0,0 +1,136 @@
+import numpy as np
+
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import ElasticNet
+from sklearn.model_selection import RepeatedKFold, RandomizedSearchCV
+from xgboost import XGBRegressor
+
+import utils.training as t
+import utils.synthetic as syn
+
+
+### Test Elastic Net path search
+# Regularization path on shared Gram matrices must select the same hyperparameters as refitting each candidate
+
+def test_elastic_net_path_search_same_as_random_search():
+    df_Xy = syn.make_flood_loss_data(n_rows=400, n_features=10, nan_rate=0.0, seed=0)
+    df_Xy["f1"] = df_Xy["f1"] * 1000 + 5000  # unscaled predictor, e.g. building area
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"]
+
+    pipe = Pipeline([("scaler", MinMaxScaler()), ("model", ElasticNet(random_state=42))])
+    param_space = {"model__alpha": [0.0001, 0.001, 0.01, 0.1], "model__l1_ratio": [0.1, 0.5, 1.0]}
+    cv = RepeatedKFold(n_splits=2, n_repeats=2, random_state=42)
+
+    random_search = RandomizedSearchCV(pipe, param_space, n_iter=12, cv=cv, scoring="neg_mean_absolute_error", random_state=42).fit(X, y)
+    path_search = t.ElasticNetPathSearchCV(pipe, param_space, cv=cv, scoring="neg_mean_absolute_error", random_state=42).fit(X, y)
+
+    assert path_search.best_params_ == random_search.best_params_
+    np.testing.assert_allclose(path_search.best_score_, random_search.best_score_, rtol=1e-4)
+    np.testing.assert_allclose(path_search.best_estimator_.predict(X), random_search.best_estimator_.predict(X))
+
+
+
+def test_elastic_net_path_search_without_intercept():
+    df_Xy = syn.make_flood_loss_data(n_rows=300, n_features=6, nan_rate=0.0, seed=1)
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"] + 5   # intercept far from 0
+    cv = RepeatedKFold(n_splits=3, n_repeats=1, random_state=42)
+
+    for scaler in [MinMaxScaler(), "passthrough"]:
+        pipe = Pipeline([("scaler", scaler), ("model", ElasticNet(fit_intercept=False, random_state=42))])
+        param_space = {"model__alpha": [0.01], "model__l1_ratio": [0.5]}
+        path_search = t.ElasticNetPathSearchCV(pipe, param_space, cv=cv, scoring="neg_mean_absolute_error").fit(X, y)
+
+        train, test = next(cv.split(X, y))
+        model = clone(pipe).set_params(model__alpha=0.01, model__l1_ratio=0.5).fit(X.iloc[train], y.iloc[train])
+        np.testing.assert_allclose(path_search.cv_results_["split0_test_score"][0], -np.abs(model.predict(X.iloc[test]) - y.iloc[test]).mean(), rtol=1e-4)
+        assert path_search.best_estimator_.named_steps["model"].intercept_ == 0
+
+### Test XGBoost search on quantized data
+# Inner folds binned with the cuts of the training set must rank candidates like refitting each pipeline
+
+def test_xgboost_quantile_search_same_as_random_search():
+    df_Xy = syn.make_flood_loss_data(n_rows=1000, n_features=10, nan_rate=0.05, seed=0)
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"]
+
+    pipe = Pipeline([("scaler", MinMaxScaler()), ("model", XGBRegressor(random_state=42, n_jobs=1))])
+    param_space = {"model__n_estimators": [50, 100], "model__max_depth": [2, 4], "model__learning_rate": [0.05, 0.3]}
+    cv = RepeatedKFold(n_splits=2, n_repeats=2, random_state=42)
+
+    random_search = RandomizedSearchCV(pipe, param_space, n_iter=8, cv=cv, scoring="neg_mean_absolute_error", random_state=42).fit(X, y)
+    quantile_search = t.XGBoostQuantileSearchCV(pipe, param_space, n_iter=8, cv=cv, scoring="neg_mean_absolute_error", random_state=42).fit(X, y)
+
+    assert quantile_search.cv_results_["params"] == random_search.cv_results_["params"]   # same sampled candidates
+    np.testing.assert_allclose(random_search.cv_results_["mean_test_score"][quantile_search.best_index_], random_search.best_score_, rtol=0.02)
+    np.testing.assert_allclose(quantile_search.cv_results_["mean_test_score"], random_search.cv_results_["mean_test_score"], rtol=0.05)
+    best_params = {k.split("__")[1]: v for k, v in quantile_search.best_params_.items()}
+    np.testing.assert_allclose(
+        quantile_search.best_estimator_.predict(X), XGBRegressor(random_state=42, n_jobs=1, **best_params).fit(X, y).predict(X)
+    )
+
+
+### Test Random Forest out-of-bag search
+# Warm-started forests of one group must give the same out-of-bag scores and best model as fitting each candidate,
+# records which are in the bootstrap samples of all trees of small forests are not scored
+
+def test_random_forest_oob_search_same_as_single_fits():
+    df_Xy = syn.make_flood_loss_data(n_rows=300, n_features=8, nan_rate=0.0, seed=0)
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"]
+
+    pipe = Pipeline([("scaler", MinMaxScaler()), ("model", RandomForestRegressor(random_state=42, n_jobs=1))])
+    param_space = {"model__n_estimators": [3, 40], "model__max_depth": [3, None], "model__max_features": [0.5, 1.0]}
+    oob_search = t.RandomForestOOBSearchCV(pipe, param_space, n_iter=8, scoring="neg_mean_absolute_error", random_state=42).fit(X, y)
+
+    for params, score in zip(oob_search.cv_results_["params"], oob_search.cv_results_["mean_test_score"]):
+        forest = clone(pipe).set_params(**params, model__oob_score=True).fit(X, y).named_steps["model"]
+        n_drawn = sum(np.bincount(drawn, minlength=len(y)) > 0 for drawn in forest.estimators_samples_)
+        oob = n_drawn < forest.n_estimators
+        if forest.n_estimators == 3:
+            assert not oob.all()   # some records were drawn by all trees
+        np.testing.assert_array_equal(t.oob_mask(forest, len(y)), oob)
+        np.testing.assert_allclose(score, -np.abs(forest.oob_prediction_[oob] - y[oob]).mean())
+
+    best_model = clone(pipe).set_params(**oob_search.best_params_).fit(X, y)
+    np.testing.assert_allclose(oob_search.best_estimator_.predict(X), best_model.predict(X))
+
+
+### Test XGBoost early stopping
+# Early stopping settings survive clone() (as in searches and cross-validation) and fitting holds out a validation set
+
+def test_early_stopping_xgboost_in_pipeline():
+    df_Xy = syn.make_flood_loss_data(n_rows=300, n_features=6, nan_rate=0.0, seed=0)
+    X, y = df_Xy.drop("rloss_b", axis=1), df_Xy["rloss_b"]
+    pipe = Pipeline([("scaler", MinMaxScaler()), ("model", XGBRegressor(n_estimators=500, learning_rate=0.3, random_state=42, n_jobs=1))])
+
+    pipe_early_stopping = clone(t.with_early_stopping(pipe, early_stopping_rounds=5, validation_fraction=0.3))
+    xgb = pipe_early_stopping.named_steps["model"]
+    assert isinstance(xgb, t.EarlyStoppingXGBRegressor)
+    assert xgb.early_stopping_rounds == 5 and xgb.validation_fraction == 0.3 and xgb.n_estimators == 500
+
+    xgb = pipe_early_stopping.fit(X, y).named_steps["model"]
+    assert 0 <= xgb.best_iteration < 499
+    assert t.with_early_stopping(Pipeline([("model", ElasticNet())]), 5).named_steps["model"].get_params() == ElasticNet().get_params()
+
+
+### Test successive halving over n_estimators
+# The resource is not sampled as hyperparameter, the refitted best model uses the maximum resource
+
+def test_halving_search_over_n_estimators():
+    df_Xy = syn.make_flood_loss_data(n_rows=300, n_features=6, nan_rate=0.0, seed=0)
+    pipe = Pipeline([("scaler", MinMaxScaler()), ("model", RandomForestRegressor(random_state=42, n_jobs=1))])
+    param_space = {"model__n_estimators": [10, 30, 90], "model__max_depth": [2, 4, None], "model__max_features": [0.5, 1.0]}
+
+    model_fitting = t.ModelFitting(
+        pipe, df_Xy, "rloss_b", param_space, "neg_mean_absolute_error", RepeatedKFold(n_splits=3, n_repeats=1, random_state=42),
+        kfolds_and_repeats=(3, 1), seed=42, search_method="halving", halving_resource="model__n_estimators",
+    )
+    search = model_fitting.model_fit_ncv()
+    assert "model__n_estimators" not in search.param_distributions
+    assert search.max_resources == 90 and "model__n_estimators" in param_space   # param space of the caller is unchanged
+
+    search.fit(model_fitting.X, model_fitting.y)
+    assert set(search.best_params_) >= {"model__max_depth", "model__max_features"}
+    best = clone(pipe).set_params(**search.best_params_).fit(model_fitting.X, model_fitting.y)
+    np.testing.assert_allclose(search.best_estimator_.predict(model_fitting.X), best.predict(model_fitting.X))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Aggregation of feature importances of several models into one ranking"""
+
+import numpy as np
+import pandas as pd
+
+from sklearn.utils import check_random_state
+
+
+def minmax_scale(importances, scale_range=(0, 10)):
+    """
+    Scale the importances of each model to the same range (as MinMaxScaler per model), nan values are ignored
+    importances (np.array): shape (..., n_features)
+    scale_range (tuple): range of scale (min, max)
+    return: np.array of same shape, constant importances are set to the lower bound
+    """
+    importances = np.asarray(importances, dtype=float)
+    with np.errstate(invalid="ignore"):   # models without any importance
+        low = np.nanmin(importances, axis=-1, keepdims=True)
+        span = np.nanmax(importances, axis=-1, keepdims=True) - low
+    span = np.where(span == 0, 1.0, span)
+    return scale_range[0] + (importances - low) / span * (scale_range[1] - scale_range[0])
+
+
+def weighted_importances(importances, model_errors, scale_range=(0, 10)):
+    """
+    Normalize the importances of each model and weight them by the model performance, better models are weighted stronger
+    importances (np.array): shape (..., n_models, n_features)
+    model_errors (np.array): error of each model, e.g. mean MAE of the outer folds, shape (..., n_models)
+    return: weighted importances (..., n_models, n_features) and their sum across models (..., n_features),
+        nan importances count as 0 in the sum
+    """
+    weighted = minmax_scale(importances, scale_range) / np.asarray(model_errors, dtype=float)[..., None]
+    return weighted, np.nansum(weighted, axis=-2)
+
+
+def rank_features(scores):
+    """ ranks along the last axis, 1 == highest score, ties are ranked by feature order """
+    order = np.argsort(-np.asarray(scores), axis=-1, kind="stable")
+    return np.argsort(order, axis=-1, kind="stable") + 1
+
+
+def aggregate_importances(importances, model_errors, model_names, feature_names, scale_range=(0, 10),
+                          n_bootstrap=1000, ci=0.95, random_state=None):
+    """
+    Ranking of the features by the weighted sum of importances across any number of models,
+    with bootstrap confidence intervals over the samples of the importances (e.g. outer folds, targets and repeats)
+    importances (np.array): shape (n_models, n_features, *samples), all sample axes are pooled
+    model_errors (np.array): shape (n_models,) or (n_models, *samples), errors per sample are resampled with the importances
+    model_names (list): names of the models, used as column prefix
+    feature_names (list): names of the features
+    n_bootstrap (int): number of bootstrap samples, 0 == no confidence intervals
+    ci (float): coverage of the confidence intervals
+    random_state (int or np.random.RandomState): seed
+    return: pd.DataFrame per feature with weighted importance per model, weighted_sum_importances, rank and
+        confidence intervals of both, sorted by rank
+    """
+    n_models, n_features = len(model_names), len(feature_names)
+    samples = np.asarray(importances, dtype=float).reshape(n_models, n_features, -1)
+    errors = np.asarray(model_errors, dtype=float)
+    errors = errors.reshape(n_models, -1) if errors.ndim > 1 else errors[:, None]
+    valid = ~np.isnan(samples)
+    samples = np.where(valid, samples, 0.0)
+
+    ## point estimate from the means over all samples
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weighted, weighted_sum = weighted_importances(samples.sum(-1) / valid.sum(-1), errors.mean(-1), scale_range)
+    df = pd.DataFrame(weighted.T, index=feature_names, columns=[f"{name}_importances_weighted" for name in model_names])
+    df["weighted_sum_importances"] = weighted_sum
+    df["rank"] = rank_features(weighted_sum)
+
+    if n_bootstrap:
+        ## each bootstrap sample as counts of the drawn samples, means of all bootstrap samples by one contraction
+        random_state = check_random_state(random_state)
+        n_samples = samples.shape[-1]
+        counts = random_state.multinomial(n_samples, np.full(n_samples, 1 / n_samples), size=n_bootstrap).astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.einsum("bs,mfs->bmf", counts, samples) / np.einsum("bs,mfs->bmf", counts, valid.astype(float))
+            errors_boot = errors.mean(-1) if errors.shape[-1] == 1 else counts @ errors.T / n_samples
+            _, sums_boot = weighted_importances(means, errors_boot, scale_range)
+        ranks_boot = rank_features(sums_boot)
+
+        alpha = (1 - ci) / 2
+        df["weighted_sum_ci_low"], df["weighted_sum_ci_high"] = np.quantile(sums_boot, [alpha, 1 - alpha], axis=0)
+        df["rank_ci_low"], df["rank_ci_high"] = np.quantile(ranks_boot, [alpha, 1 - alpha], axis=0)
+
+    return df.sort_values("rank")
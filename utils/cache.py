@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content-addressed cache for results of nested cross-validation"""
+
+import os
+import uuid
+from pathlib import Path
+
+import joblib
+
+
+def _class_name(obj):
+    return f"{type(obj).__module__}.{type(obj).__qualname__}"
+
+
+def estimator_fingerprint(estimator):
+    """
+    Get hashable definition of an (unfitted) sklearn estimator or search,
+    without settings which do not change the results such as n_jobs and verbose
+    estimator: sklearn estimator, Pipeline or hyperparameter search
+    return: dict with class names and parameters
+    """
+    params = {}
+    for k, v in estimator.get_params(deep=True).items():
+        if k.split("__")[-1] in ("n_jobs", "verbose", "pre_dispatch"):
+            continue
+        if hasattr(v, "get_params"):  # nested estimators are represented by their class and deep parameters
+            v = _class_name(v)
+        elif k.split("__")[-1] == "steps":
+            v = [(step_name, _class_name(step)) for step_name, step in v]
+        params[k] = v
+    return {"class": _class_name(estimator), "params": params}
+
+
+def hash_key(*parts):
+    """
+    Hash all parts which determine a result, e.g. input data, pipeline, param space, cv settings and seed
+    return: str, hex digest
+    """
+    return joblib.hash(parts)
+
+
+class ResultCache(object):
+    """
+    Cache on disk, each result is stored in one file named by its content hash.
+    The cache size is bounded, least recently used results are evicted first
+    """
+    def __init__(self, cache_dir, max_size_gb=10.0):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes: int = int(max_size_gb * 1024**3)
+
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.joblib"
+
+
+    def get(self, key):
+        """
+        Load cached result
+        key (str): content hash from hash_key()
+        return: cached object or None if not cached
+        """
+        path = self._path(key)
+        try:
+            result = joblib.load(path)
+        except (FileNotFoundError, EOFError):  # not cached or evicted by another process meanwhile
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # evicted by another process after loading, the loaded result is still valid
+            pass
+        return result
+
+
+    def put(self, key, result):
+        """
+        Store result and evict least recently used results if the cache is too large
+        key (str): content hash from hash_key()
+        result: picklable object
+        """
+        path = self._path(key)
+        tmp_path = self.cache_dir / f".{key}.{uuid.uuid4().hex}.tmp"
+        joblib.dump(result, tmp_path)
+        os.replace(tmp_path, path)  # atomic, concurrent jobs never read half written files
+        self.evict(keep=path)
+
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used results until the cache fits into its size limit
+        keep (Path): file which is never evicted, e.g. the result just stored
+        return: list of evicted files
+        """
+        entries = []
+        for path in self.cache_dir.glob("*.joblib"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total_size -= size
+            evicted.append(path)
+        return evicted
@@ -3,22 +3,39 @@
 """Utility functions for model evaluation"""
 
 import sys
+import os
+import time
+import shutil
+import uuid
+from pathlib import Path
+import joblib
 import numpy as np
 import pandas as pd
 import functools
+import itertools
+from collections.abc import Mapping
+from joblib import Parallel, delayed
 
 from sklearn.preprocessing import MinMaxScaler
-from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.pipeline import Pipeline
+from sklearn.base import clone
+from sklearn.metrics import mean_absolute_error, r2_score, get_scorer
 from sklearn.inspection import permutation_importance, partial_dependence
-from sklearn.model_selection import cross_validate, cross_val_predict
 from sklearn.linear_model import LinearRegression
+from sklearn.utils import Bunch, check_random_state
 
 import statsmodels.api as sm
 from scipy import stats
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
 
 import utils.feature_selection as fs
 import utils.training as t
 import utils.evaluation_metrics as em
+import utils.parallel as par
+import utils.preprocessing as pp
+import utils.cache as c
+import utils.profiling as prof
 
 #import rpy2.robjects as robjects
 #from rpy2.robjects import pandas2ri
@@ -38,22 +55,531 @@ import utils.evaluation_metrics as em
 mt = t.ModelFitting  # call Class for model training
 
 
+def fit_and_score_fold(estimator, X, y, train_idx, test_idx, scorers, prediction_method="predict"):
+    """
+    Fit a clone of the estimator (e.g. inner hyperparameter search) on one outer training fold,
+    predict and score it on the respective outer test fold
+    estimator: unfitted sklearn estimator or RandomizedSearchCV
+    X (pd.DataFrame or par.SharedFrame), y (pd.Series or par.SharedFrame): entire dataset
+    train_idx, test_idx (np.array): positional indices of outer fold
+    scorers (dict): metric names and sklearn scorer callables
+    prediction_method (str): "predict" or "predict_proba"
+    return: dict with fitted estimator, predictions of test fold, scores and timings
+    """
+    X, y = par.shared(X), par.shared(y)   # views onto shared memory in worker processes
+    X_train, y_train = X.iloc[train_idx], y.iloc[train_idx]
+    X_test, y_test = X.iloc[test_idx], y.iloc[test_idx]
+
+    start = time.time()
+    fitted_estimator = clone(estimator).fit(X_train, y_train)
+    fit_time = time.time() - start
+
+    start = time.time()
+    y_pred = getattr(fitted_estimator, prediction_method)(X_test)
+    scores = {name: scorer(fitted_estimator, X_test, y_test) for name, scorer in scorers.items()}
+    score_time = time.time() - start
+
+    return {
+        "estimator": fitted_estimator,
+        "test_idx": test_idx,
+        "y_pred": y_pred,
+        "scores": scores,
+        "fit_time": fit_time,
+        "score_time": score_time,
+    }
+
+
+def fit_and_score_fold_checkpointed(fold_idx, checkpoint_dir, *args, **kwargs):
+    """
+    Same as fit_and_score_fold(), but the result of the fold is stored as soon as it is finished
+    and loaded instead of refitted if it already exists (e.g. job was preempted or hit the time limit)
+    fold_idx (int): index of outer fold
+    checkpoint_dir (str): folder for checkpoints of this nested cv, None == without checkpoints
+    return: dict from fit_and_score_fold()
+    """
+    if checkpoint_dir is None:
+        return fit_and_score_fold(*args, **kwargs)
+
+    checkpoint = Path(checkpoint_dir) / f"fold_{fold_idx}.joblib"
+    if checkpoint.exists():
+        print(f"Resuming outer fold {fold_idx} from checkpoint {checkpoint}")
+        return joblib.load(checkpoint)
+
+    fold = fit_and_score_fold(*args, **kwargs)
+    tmp_checkpoint = checkpoint.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    joblib.dump(fold, tmp_checkpoint)
+    os.replace(tmp_checkpoint, checkpoint)  # atomic, a killed job never leaves a half written checkpoint
+    return fold
+
+
+def nested_cv_predict_and_score(estimator, X, y, cv, score_metrics, prediction_method="predict", n_jobs=1, checkpoint_dir=None):
+    """
+    Run the outer loop of the nested cross-validation in one pass: each outer fold is fitted once,
+    the fitted estimators deliver both the out-of-fold predictions and the scores of all metrics
+    estimator: unfitted inner cv (e.g. RandomizedSearchCV from ModelFitting.model_fit_ncv())
+    X (pd.DataFrame), y (pd.Series): entire dataset
+    cv: outer cv splitter, for repeated cv the out-of-fold predictions are averaged across repeats
+    score_metrics (dict): metric names and sklearn scorers or scorer names
+    prediction_method (str): "predict" or "predict_proba"
+    n_jobs (int): number of outer folds fitted in parallel processes
+    checkpoint_dir (str): folder to checkpoint each finished outer fold, finished folds are not refitted. 
+        Needs to be unique for the estimator, data and cv settings. None == without checkpoints
+    return: dict in the same format as sklearn.model_selection.cross_validate(return_estimator=True)
+        plus the out-of-fold predictions under key "y_pred"
+    """
+    scorers = {name: get_scorer(scorer) for name, scorer in score_metrics.items()}
+
+    if checkpoint_dir is not None:
+        Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+
+    ## worker processes get views onto one shared copy of the dataset instead of own pickled copies
+    splits = list(cv.split(X, y))
+    with par.shared_for_workers(n_jobs, X, y) as (X_workers, y_workers):
+        folds = Parallel(n_jobs=n_jobs)(
+            delayed(fit_and_score_fold_checkpointed)(
+                fold_idx, checkpoint_dir, 
+                estimator, X_workers, y_workers, train_idx, test_idx, scorers, prediction_method
+            )
+            for fold_idx, (train_idx, test_idx) in enumerate(splits)
+        )
+    results = {
+        "fit_time": np.array([fold["fit_time"] for fold in folds]),
+        "score_time": np.array([fold["score_time"] for fold in folds]),
+        "estimator": [fold["estimator"] for fold in folds],
+    }
+    for name in scorers:
+        results[f"test_{name}"] = np.array([fold["scores"][name] for fold in folds])
+
+    ## average out-of-fold predictions of samples which occur in multiple outer test folds (repeated cv)
+    y_pred_sum = None
+    counts = np.zeros(len(y))
+    for fold in folds:
+        y_pred_fold = np.asarray(fold["y_pred"], dtype=float)
+        if y_pred_sum is None:
+            y_pred_sum = np.zeros((len(y),) + y_pred_fold.shape[1:])
+        np.add.at(y_pred_sum, fold["test_idx"], y_pred_fold)
+        np.add.at(counts, fold["test_idx"], 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counts = counts.reshape((-1,) + (1,) * (y_pred_sum.ndim - 1))
+        results["y_pred"] = y_pred_sum / counts   # nan for samples never in a test fold
+
+    return results
+
+
+def permutation_indices(n_samples, n_repeats, random_state=None):
+    """
+    Row orders of the permuted column for each repeat, in the same random sequence as 
+    sklearn.inspection.permutation_importance(), which shuffles the already permuted column again in each repeat
+    n_samples (int): number of records
+    n_repeats (int): number of repeats
+    random_state (int): seed
+    return: np.array of shape (n_repeats, n_samples)
+    """
+    random_state = check_random_state(random_state)
+    random_seed = random_state.randint(np.iinfo(np.int32).max + 1)  # each column uses the same fresh RandomState
+    column_random_state = check_random_state(random_seed)
+
+    shuffling_idx = np.arange(n_samples)
+    permutation = np.arange(n_samples)
+    permutations = np.empty((n_repeats, n_samples), dtype=np.intp)
+    for r in range(n_repeats):
+        column_random_state.shuffle(shuffling_idx)
+        permutation = permutation[shuffling_idx]
+        permutations[r] = permutation
+    return permutations
+
+
+def _score_all_metrics(model, X, y, scorers):
+    """ score all metrics from one predict call, scorers without score function on predictions are called directly """
+    y_pred = None
+    scores = {}
+    for name, scorer in scorers.items():
+        if hasattr(scorer, "_score_func") and getattr(scorer, "_response_method", "predict") == "predict":
+            y_pred = model.predict(X) if y_pred is None else y_pred
+            scores[name] = scorer._sign * scorer._score_func(y, y_pred, **scorer._kwargs)
+        else:
+            scores[name] = scorer(model, X, y)
+    return scores
+
+
+def _permuted_scores(model, X_values, columns, y, scorers, tasks, units, permutations):
+    """
+    Score model for a chunk of (unit, repeat) tasks, a unit is one feature or a group of features permuted jointly.
+    The chunk works on one writable copy of X, the permuted columns are written into this buffer and restored afterwards
+    units (list): column indices of each unit
+    permutations (np.array): row orders of shape (n_units or 1, n_repeats, n_samples)
+    return: list of (unit idx, repeat idx, scores)
+    """
+    X_values = par.shared(X_values)   # view onto shared memory in worker processes
+    buffer = np.array(X_values, dtype=float)   # one copy per chunk, X_values can be a readonly memmap
+    X_buffer = pd.DataFrame(buffer, columns=columns, copy=False)
+    results = []
+    for u, r in tasks:
+        cols = units[u]
+        permutation = permutations[u if permutations.shape[0] > 1 else 0, r]
+        buffer[:, cols] = X_values[permutation[:, None], cols]
+        results.append((u, r, _score_all_metrics(model, X_buffer, y, scorers)))
+        buffer[:, cols] = X_values[:, cols]
+    return results
+
+
+def _permutation_importances(model, X, y, units, permutations, score_metrics=None, n_jobs=1):
+    """
+    Permute units (single features or groups of features) with given row orders and derive the decrease in score
+    return: see permutation_importances()
+    """
+    scorers = {name: get_scorer(scorer) for name, scorer in (score_metrics or {"R2": "r2"}).items()}
+    X_values = np.asarray(X, dtype=float)
+    n_units, n_repeats = len(units), permutations.shape[1]
+
+    baseline = _score_all_metrics(model, X, y, scorers)
+
+    tasks = [(u, r) for u in range(n_units) for r in range(n_repeats)]
+    chunks = [chunk for chunk in np.array_split(np.array(tasks), max(1, n_jobs)) if len(chunk)]
+    with par.shared_for_workers(n_jobs, X_values) as (X_workers,):
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_permuted_scores)(model, X_workers, X.columns, y, scorers, chunk, units, permutations) 
+            for chunk in chunks
+        )
+
+    permuted = {name: np.empty((n_units, n_repeats)) for name in scorers}
+    for u, r, scores in itertools.chain.from_iterable(results):
+        for name, score in scores.items():
+            permuted[name][u, r] = score
+
+    importances = {}
+    for name in scorers:
+        importances_metric = baseline[name] - permuted[name]
+        importances[name] = Bunch(
+            importances_mean=np.mean(importances_metric, axis=1),
+            importances_std=np.std(importances_metric, axis=1),
+            importances=importances_metric,
+        )
+    return importances
+
+
+@prof.profiled()
+def permutation_importances(model, X, y, score_metrics=None, n_repeats=5, random_state=None, n_jobs=1):
+    """
+    Permutation feature importance for several metrics in one pass, features x repeats are spread over workers.
+    Same results as sklearn.inspection.permutation_importance() for the same seed
+    model: fitted sklearn estimator or Pipeline
+    X (pd.DataFrame), y (pd.Series): dataset
+    score_metrics (dict): metric names and sklearn scorers or scorer names, None == {"R2": "r2"} (default score of regressors)
+    n_repeats (int): number of permutations per feature
+    random_state (int): seed
+    n_jobs (int): number of worker processes
+    return: dict with metric name and Bunch of importances_mean, importances_std, importances (n_features x n_repeats),
+        the importance is the decrease in score, i.e. the increase of model error
+    """
+    permutations = permutation_indices(X.shape[0], n_repeats, random_state)[None]  # same row orders for all features
+    units = [[j] for j in range(X.shape[1])]
+    return _permutation_importances(model, X, y, units, permutations, score_metrics, n_jobs)
+
+
+_spearman_cache = {}   # content hash of dataset and min_periods -> (rho, p-values), the last few datasets are kept
+
+
+def spearman_correlation(df, min_periods=1, max_cached=8):
+    """
+    Spearman rank correlation matrix and its p-values (t-distribution, as scipy spearmanr) as matrix operations: 
+    each column is ranked once, then the Pearson correlation of the ranks is computed for all pairs of columns 
+    on their pairwise complete records. With missing values the ranks are not recomputed per pair as in pandas,
+    which gives slightly different coefficients. Results are cached per dataset.
+    df (pd.DataFrame): dataset with numeric columns
+    min_periods (int): minimum number of pairwise complete records, otherwise nan
+    max_cached (int): number of datasets kept in the cache
+    return: pd.DataFrame with correlation coefficients and pd.DataFrame with p-values (0 on the diagonal)
+    """
+    key = c.hash_key(df, min_periods)
+    if key in _spearman_cache:
+        return tuple(df_result.copy() for df_result in _spearman_cache[key])
+
+    ranks = df.rank(method="average").to_numpy(dtype=float)
+    valid = ~np.isnan(ranks)
+    ranks = np.where(valid, ranks, 0.0)
+    valid = valid.astype(float)
+
+    ## sums over the records where both columns are valid, [i, j]: sum of column i on records where column j is valid
+    n = valid.T @ valid
+    sums = ranks.T @ valid
+    sums_sq = (ranks ** 2).T @ valid
+    cross = ranks.T @ ranks
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = cross - sums * sums.T / n
+        var = sums_sq - sums ** 2 / n
+        rho = np.clip(cov / np.sqrt(var * var.T), -1.0, 1.0)
+        rho[n < max(min_periods, 2)] = np.nan
+        np.fill_diagonal(rho, np.where(np.diag(n) >= max(min_periods, 2), 1.0, np.nan))
+
+        dof = n - 2
+        t_values = rho * np.sqrt(dof / ((1.0 - rho) * (1.0 + rho)))
+        pvalues = 2 * stats.t.sf(np.abs(t_values), dof)
+    np.fill_diagonal(pvalues, np.where(np.isnan(np.diag(rho)), np.nan, 0.0))
+
+    result = (
+        pd.DataFrame(rho, index=df.columns, columns=df.columns),
+        pd.DataFrame(pvalues, index=df.columns, columns=df.columns),
+    )
+    while len(_spearman_cache) >= max_cached:
+        _spearman_cache.pop(next(iter(_spearman_cache)))
+    _spearman_cache[key] = result
+    return tuple(df_result.copy() for df_result in result)
+
+
+def correlation_clusters(corr, threshold=0.7):
+    """
+    Cluster correlated predictors by hierarchical clustering (average linkage) on the distance 1 - |correlation|
+    corr (pd.DataFrame): correlation matrix, e.g. Spearman rank correlation
+    threshold (float): features within a cluster have an average absolute correlation of at least this value
+    return: list of clusters, each a list of feature names
+    """
+    distance = 1 - np.abs(np.nan_to_num(corr.values, nan=0.0))
+    np.fill_diagonal(distance, 0.0)
+    linkage = hierarchy.linkage(squareform(distance, checks=False), method="average")
+    labels = hierarchy.fcluster(linkage, t=1 - threshold, criterion="distance")
+    return [corr.columns[labels == label].to_list() for label in np.unique(labels)]
+
+
+def conditional_strata(X, feature, conditioning_features, n_bins=4):
+    """
+    Strata for conditional permutation of one feature: records with the same quantile bins of all 
+    conditioning features (e.g. correlated predictors) belong to the same stratum
+    X (pd.DataFrame): dataset
+    feature (str): feature to permute
+    conditioning_features (list): feature names to condition on, empty == one stratum (unconditional)
+    n_bins (int): number of quantile bins per conditioning feature, nan values get an own bin
+    return: np.array with stratum code of each record
+    """
+    codes = np.zeros(X.shape[0], dtype=np.int64)
+    for conditioning_feature in conditioning_features:
+        if conditioning_feature == feature:
+            continue
+        x = X[conditioning_feature].to_numpy(dtype=float)
+        edges = np.unique(np.nanquantile(x, np.linspace(0, 1, n_bins + 1)[1:-1])) if not np.isnan(x).all() else []
+        bins = np.where(np.isnan(x), len(edges) + 1, np.searchsorted(edges, x, side="right"))
+        ## refactorized after each feature, codes stay below the number of records instead of growing geometrically
+        codes = np.unique(codes * (len(edges) + 2) + bins, return_inverse=True)[1].reshape(-1).astype(np.int64)
+    return np.unique(codes, return_inverse=True)[1].reshape(-1)
+
+
+def stratified_permutation_indices(strata, n_repeats, random_state=None):
+    """
+    Row orders which shuffle records only within their stratum, vectorized by sorting on (stratum, random key)
+    strata (np.array): stratum code of each record
+    n_repeats (int): number of repeats
+    random_state (int or np.random.RandomState): seed
+    return: np.array of shape (n_repeats, n_samples)
+    """
+    random_state = check_random_state(random_state)
+    by_stratum = np.argsort(strata, kind="stable")
+    permutations = np.empty((n_repeats, strata.shape[0]), dtype=np.intp)
+    for r in range(n_repeats):
+        shuffled = np.lexsort((random_state.random_sample(strata.shape[0]), strata))
+        permutations[r, by_stratum] = shuffled   # both orders are sorted by stratum, rows only swap within a stratum
+    return permutations
+
+
+def grouped_permutation_importances(model, X, y, groups, score_metrics=None, n_repeats=5, random_state=None, n_jobs=1):
+    """
+    Permutation importance of groups of features, e.g. clusters of correlated predictors from correlation_clusters(),
+    all features of a group are permuted jointly with the same row order, which keeps the correlation within the group
+    groups (list): lists of feature names
+    return: see permutation_importances(), one row per group
+    """
+    permutations = permutation_indices(X.shape[0], n_repeats, random_state)[None]
+    units = [[X.columns.get_loc(feature) for feature in group] for group in groups]
+    return _permutation_importances(model, X, y, units, permutations, score_metrics, n_jobs)
+
+
+@prof.profiled()
+def conditional_permutation_importances(model, X, y, corr=None, threshold=0.5, n_bins=4, max_conditioning=3, score_metrics=None, 
+                                        n_repeats=5, random_state=None, n_jobs=1):
+    """
+    Conditional permutation importance (similar to R permimp): each feature is permuted only within strata of 
+    its correlated predictors, so that the importance of correlated features is not inflated by unrealistic records
+    corr (pd.DataFrame): correlation matrix of X, None == Spearman rank correlation of X
+    threshold (float): features with an absolute correlation of at least this value are conditioned on
+    n_bins (int): number of quantile bins per conditioning feature
+    max_conditioning (int): maximum number of conditioning features per feature, the most correlated ones; 
+        strata of many features hold single records, which are not permuted at all (importance of 0)
+    return: see permutation_importances()
+    """
+    corr = spearman_correlation(X)[0] if corr is None else corr
+    random_state = check_random_state(random_state)
+    conditioning = {}
+    for feature in X.columns:
+        rho = corr[feature].drop(feature).abs()
+        conditioning[feature] = rho[rho >= threshold].sort_values(ascending=False, kind="stable").index[:max_conditioning].to_list()
+    permutations = np.stack([
+        stratified_permutation_indices(conditional_strata(X, feature, conditioning[feature], n_bins), n_repeats, random_state)
+        for feature in X.columns
+    ])
+    units = [[j] for j in range(X.shape[1])]
+    return _permutation_importances(model, X, y, units, permutations, score_metrics, n_jobs)
+
+
+COLUMNWISE_TRANSFORMERS = t.COLUMNWISE_TRANSFORMERS
+
+
+def pdp_grid(x, grid_resolution=50, percentiles=(0.05, 0.95)):
+    """
+    Bounded grid for partial dependence of one feature
+    x (np.array): feature values
+    grid_resolution (int): maximum number of grid points
+    percentiles (tuple): lower and upper quantile of the grid
+    return: np.array with all unique values if there are not more than grid_resolution of them (e.g. categorical features),
+        otherwise the unique values of grid_resolution equally spaced quantiles
+    """
+    x = x[~np.isnan(x)]
+    uniques = np.unique(x)
+    if uniques.shape[0] <= grid_resolution:
+        return uniques
+    return np.unique(np.quantile(x, np.linspace(percentiles[0], percentiles[1], grid_resolution)))
+
+
+def _recursion_estimator(model):
+    """
+    Get final tree estimator if partial dependence can be computed by fast tree recursion, 
+    that is it supports it (e.g. RandomForestRegressor) and all preceding pipeline steps transform column-wise
+    return: (list of preceding steps, estimator) or (None, None)
+    """
+    steps = model.steps if isinstance(model, Pipeline) else [("model", model)]
+    preprocessing, estimator = [step for _, step in steps[:-1]], steps[-1][1]
+    if not hasattr(estimator, "_compute_partial_dependence_recursion"):
+        return None, None
+    if not all(step == "passthrough" or isinstance(step, COLUMNWISE_TRANSFORMERS) for step in preprocessing):
+        return None, None
+    return [step for step in preprocessing if step != "passthrough"], estimator
+
+
+@prof.profiled()
+def partial_dependences(model, X, features=None, grid_resolution=50, percentiles=(0.05, 0.95), method="auto", max_batch_rows=2**20):
+    """
+    Derive partial dependences of many features of one fitted model in one pass.
+    brute: the dataset is replicated for each grid point of all features and the replications are stacked
+        into large prediction batches, instead of one predict call per grid point and feature
+    recursion: fast tree recursion of sklearn for tree models (e.g. Random Forest), averages over the training data
+    model: fitted sklearn estimator or Pipeline
+    X (pd.DataFrame): dataset without nan values
+    features (list): feature names, None == all columns of X
+    grid_resolution (int): maximum number of grid points per feature, see pdp_grid()
+    percentiles (tuple): lower and upper quantile of the grid
+    method (str): "auto" (recursion if supported, else brute), "recursion" or "brute"
+    max_batch_rows (int): upper limit of rows per predict call, bounds the memory
+    return: dict with feature name and pd.DataFrame with 1 column named by feature_name with grid values and 1 column with partial dependences "yhat"
+    """
+    features = X.columns.to_list() if features is None else list(features)
+    X_values = np.asarray(X, dtype=float)
+    n_rows, n_cols = X_values.shape
+    feature_idx = [X.columns.get_loc(feature) for feature in features]
+    grids = [pdp_grid(X_values[:, j], grid_resolution, percentiles) for j in feature_idx]
+    yhat = [np.empty(grid.shape[0]) for grid in grids]
+
+    preprocessing, estimator = _recursion_estimator(model) if method in ("auto", "recursion") else (None, None)
+    if method == "recursion" and estimator is None:
+        raise ValueError(f"Tree recursion is not supported for {model}")
+
+    if estimator is not None:
+        for i, (j, grid) in enumerate(zip(feature_idx, grids)):
+            ## map grid values into the space the tree was trained on, column-wise transforms need only the grid column
+            grid_X = np.tile(X_values[:1], (grid.shape[0], 1))
+            grid_X[:, j] = grid
+            for step in preprocessing:
+                grid_X = step.transform(pd.DataFrame(grid_X, columns=X.columns) if hasattr(step, "feature_names_in_") else grid_X)
+            yhat[i] = estimator._compute_partial_dependence_recursion(np.asarray(grid_X)[:, [j]], [j])
+
+    else:
+        ## all (feature, grid value) pairs, each of them replicates the entire dataset
+        grid_points = [(i, k) for i, grid in enumerate(grids) for k in range(grid.shape[0])]
+        points_per_batch = max(1, max_batch_rows // n_rows)
+        batch = np.empty((min(points_per_batch, len(grid_points)) * n_rows, n_cols))
+
+        for start in range(0, len(grid_points), points_per_batch):
+            batch_points = grid_points[start:start + points_per_batch]
+            for b, (i, k) in enumerate(batch_points):
+                block = batch[b * n_rows:(b + 1) * n_rows]
+                block[:] = X_values
+                block[:, feature_idx[i]] = grids[i][k]
+            X_batch = pd.DataFrame(batch[:len(batch_points) * n_rows], columns=X.columns, copy=False)
+            y_batch = np.asarray(model.predict(X_batch)).reshape(len(batch_points), n_rows).mean(axis=1)
+            for (i, k), y_mean in zip(batch_points, y_batch):
+                yhat[i][k] = y_mean
+
+    return {
+        feature: pd.DataFrame({feature: grid, "yhat": y})
+        for feature, grid, y in zip(features, grids, yhat)
+    }
+
+
+class LazyPartialDependences(Mapping):
+    """
+    Partial dependences of one fitted model, computed only for the features which are requested 
+    (e.g. plotted or exported) and kept for later requests.
+    Behaves like a dict with feature names and pd.DataFrames from partial_dependences()
+    """
+    def __init__(self, model, X, **pdp_kwargs):
+        """
+        model: fitted sklearn estimator or Pipeline
+        X (pd.DataFrame): dataset without nan values
+        pdp_kwargs: further settings of partial_dependences(), e.g. grid_resolution
+        """
+        self.model = model
+        self.X = X
+        self.pdp_kwargs = pdp_kwargs
+        self._computed = {}
+
+    @classmethod
+    def from_file(cls, model_file, X, **pdp_kwargs):
+        """ get partial dependences on demand from a saved final model """
+        return cls(joblib.load(model_file), X, **pdp_kwargs)
+
+    def compute(self, features):
+        """
+        Compute partial dependences of all requested features which are not computed yet, in one pass
+        features (list): feature names
+        return: dict with the requested feature names and their partial dependences
+        """
+        missing = [feature for feature in dict.fromkeys(features) if feature not in self._computed]
+        if missing:
+            self._computed.update(partial_dependences(self.model, self.X, features=missing, **self.pdp_kwargs))
+        return {feature: self._computed[feature] for feature in features}
+
+    def __getitem__(self, feature):
+        if feature not in self.X.columns:
+            raise KeyError(feature)
+        return self.compute([feature])[feature]
+
+    def __iter__(self):
+        return iter(self.X.columns)
+
+    def __len__(self):
+        return self.X.shape[1]
+
+    @property
+    def computed_features(self):
+        return list(self._computed)
+
+
 class ModelEvaluation(object):
     """
     Model evaluation by nested cross-validation
     """        
-    def __init__(self, models_trained_ncv, Xy, target_name, cv, kfolds, score_metrics, seed):
+    def __init__(self, models_trained_ncv, Xy, target_name, cv, kfolds, score_metrics, seed, n_jobs=1, cache=None, checkpoint_dir=None):
         #super(model_fitting, self).__init__()
         self.models_trained_ncv = models_trained_ncv
-        self.X = pd.DataFrame(Xy.drop(target_name, axis=1))
-        self.X = pd.DataFrame(
-                MinMaxScaler().fit_transform(self.X),   
-                columns=self.X.columns) 
-        self.y: pd.DataFrame = Xy[target_name]
+        ## Xy: pp.PreparedDataset, or pd.DataFrame (can be a view onto shared memory, par.SharedFrame)
+        ## no scaling here, the pipelines scale inside each fold
+        data = Xy if isinstance(Xy, pp.PreparedDataset) else pp.PreparedDataset(par.shared(Xy), target_name)
+        self.X: pd.DataFrame = data.X
+        self.y: pd.Series = data.y
         self.outer_cv = cv
         self.k_folds:int = kfolds
         self.score_metrics = score_metrics
         self.seed: int = seed
+        self.n_jobs: int = par.resolve_n_jobs(n_jobs)  # same budget as for ModelFitting, outer folds get their share of it
+        self.cache = cache  # utils.cache.ResultCache, None == always refit
+        self.checkpoint_dir = checkpoint_dir  # folder for checkpoints of finished outer folds, None == without checkpoints
         self.y_pred = None
         self.y_proba = None
         self.residuals = None
@@ -67,19 +593,44 @@ class ModelEvaluation(object):
         # }
 
 
+    @prof.profiled()
     def model_evaluate_ncv(self, prediction_method="predict"):
         """  
         Run and Evaluate sklearn model by nested cross-validation [outer folds]
         prediction_method (str): "predict" or "predict_proba"
         return: predict y and return model generalization perfromance
         """    
-        ## predict y on outer folds of nested cv
-        self.y_pred = cross_val_predict(
-            self.models_trained_ncv,  # estimators from inner cv
-            self.X, self.y,
-            cv=self.k_folds, # KFold without repeats to have for each sample one predicted value 
-            method=prediction_method
+        ## skip training if the same data, pipeline, param space, cv settings and seed were already evaluated
+        model_performance_ncv = None
+        cache_key = c.hash_key(
+            c.estimator_fingerprint(self.models_trained_ncv), 
+            self.X, self.y, self.outer_cv, self.score_metrics, self.seed, prediction_method,
         )
+        if self.cache is not None:
+            model_performance_ncv = self.cache.get(cache_key)
+            if model_performance_ncv is not None:
+                print(f"Loaded outer cv results from cache: {cache_key}")
+
+        ## fit each outer fold once, get predictions on outer folds and generalization performance from the same fits
+        if model_performance_ncv is None:
+            ## checkpoints are unique for data and settings, otherwise folds of a changed setup would be resumed
+            checkpoint_dir = None if self.checkpoint_dir is None else Path(self.checkpoint_dir) / cache_key
+            model_performance_ncv = nested_cv_predict_and_score(
+                self.models_trained_ncv,  # estimators from inner cv
+                self.X, self.y,
+                cv=self.outer_cv,  # for repeated KFold the predictions of each sample are averaged across repeats
+                score_metrics=self.score_metrics,  # Strategies to evaluate the performance of the cross-validated model on the test set.
+                prediction_method=prediction_method,
+                n_jobs=par.split_budget(self.n_jobs, self.outer_cv.get_n_splits()).outer,
+                checkpoint_dir=checkpoint_dir,
+            )
+            if self.cache is not None:
+                self.cache.put(cache_key, model_performance_ncv)
+            if checkpoint_dir is not None:
+                shutil.rmtree(checkpoint_dir, ignore_errors=True)  # all folds finished
+
+        model_performance_ncv = dict(model_performance_ncv)
+        self.y_pred = model_performance_ncv.pop("y_pred")
 
         ## Probability predictions (self.y_pred is 2-dimensional: predicted probabilities and respective predictions)
         if prediction_method == "predict_proba":
@@ -95,15 +646,6 @@ class ModelEvaluation(object):
             )
             self.y_proba = self.y_proba.flatten()
 
-
-        ## get generalization performance on outer folds of nested cv
-        model_performance_ncv = cross_validate(
-            self.models_trained_ncv, 
-            self.X, self.y, 
-            scoring=self.score_metrics,  # Strategies to evaluate the performance of the cross-validated model on the test set.
-            cv=self.outer_cv, 
-            return_estimator=True,
-        )         
         try:
             print(
                 "model performance measured in MAE (std) on outer CV: %.3f (%.3f)"%(
@@ -277,20 +819,51 @@ class ModelEvaluation(object):
 
 
 
-    def permutation_feature_importance(self, final_model, repeats=10):
+    @prof.profiled()
+    def permutation_feature_importance(self, final_model, repeats=10, score_metrics=None):
     #def permutation_feature_importance(model, X_test, y_test, y_pred, criterion= r2_score):
         """
         Calculate permutation based feature importance , the importance scores represents the increase in model error
         final_model : final sklearn model       
-        return: pd DataFrame with averaged importance scores
+        score_metrics (dict): metric names and sklearn scorers, all metrics are derived from the same permutations.
+            None == default score of model (R2)
+        return: averaged importance scores, their standard deviations and importance scores of all repeats,
+            if score_metrics is given a dict with this tuple for each metric
         """
-        permutation_fi = permutation_importance(
+        permutation_fi = permutation_importances(
             final_model, 
             self.X, self.y, 
-            n_repeats=repeats, random_state=self.seed
+            score_metrics=score_metrics,
+            n_repeats=repeats, random_state=self.seed,
+            n_jobs=self.n_jobs,
         )
+        permutation_fi = {
+            name: (fi.importances_mean, fi.importances_std, fi.importances) for name, fi in permutation_fi.items()
+        }
+        return permutation_fi["R2"] if score_metrics is None else permutation_fi
 
-        return permutation_fi.importances_mean, permutation_fi.importances_std, permutation_fi.importances
+
+    @prof.profiled()
+    def conditional_permutation_feature_importance(self, final_model, repeats=10, corr=None, threshold=0.5, score_metrics=None):
+        """
+        Calculate conditional permutation feature importance, each feature is permuted within strata of its correlated predictors
+        final_model : final sklearn model       
+        corr (pd.DataFrame): correlation matrix of predictors, None == Spearman rank correlation
+        threshold (float): minimum absolute correlation of predictors to condition on
+        return: same as permutation_feature_importance()
+        """
+        permutation_fi = conditional_permutation_importances(
+            final_model, 
+            self.X, self.y, 
+            corr=corr, threshold=threshold,
+            score_metrics=score_metrics,
+            n_repeats=repeats, random_state=self.seed,
+            n_jobs=self.n_jobs,
+        )
+        permutation_fi = {
+            name: (fi.importances_mean, fi.importances_std, fi.importances) for name, fi in permutation_fi.items()
+        }
+        return permutation_fi["R2"] if score_metrics is None else permutation_fi
 
 
     # def r_permutation_feature_importance(self, final_model):
@@ -309,7 +882,9 @@ class ModelEvaluation(object):
 
     ## @decorator(model=final_models_trained["crf"], Xy=eval_set_list["crf"]["crf"], target_name=target, feature_name="flowvelocity", scale=True) 
     ## not using decorator @
-    def get_partial_dependence(self, **kwargs):
+    @staticmethod
+    @prof.profiled()
+    def get_partial_dependence(**kwargs):
         """
         Derive partial dependences
         feature_name (str): 
@@ -2,10 +2,11 @@
 # -*- coding: utf-8 -*-
 """Utility functions"""
 
+import numpy as np
 import pandas as pd
 
-from sklearn.preprocessing import MinMaxScaler
-from statsmodels.stats.outliers_influence import variance_inflation_factor
+import utils.aggregation as agg
+import utils.profiling as prof
 
 
 # import rpy2
@@ -23,29 +24,86 @@ from statsmodels.stats.outliers_influence import variance_inflation_factor
 
 
 
+class EqualFrequencyBinning(object):
+    """
+    Equal frequency binning (as pd.qcut) of many variables at once: the quantile edges of all columns are computed
+    in one pass, duplicated edges are dropped (fewer categories for variables with many equal values). 
+    The fitted edges are stored in edges_, so that new data are binned without recomputing them
+    """
+    def __init__(self, cuts:int=3, group_labels:list=None, suffix:str="_c"):
+        """
+        cuts (int): number of categories
+        group_labels (list): labels of the categories, used for variables which keep all categories, 
+            variables with dropped duplicated edges get interval labels (as pd.qcut(duplicates="drop"))
+        suffix (str): suffix of the names of the discretized variables
+        """
+        self.cuts: int = cuts
+        self.group_labels = group_labels
+        self.suffix: str = suffix
+
+
+    def fit(self, df, columns=None):
+        """
+        df (pd.DataFrame): dataset
+        columns (list): variables to discretize, None == all columns
+        """
+        columns = list(df.columns if columns is None else columns)
+        values = df[columns].to_numpy(dtype=float)
+        quantiles = np.nanquantile(values, np.linspace(0, 1, self.cuts + 1), axis=0).reshape(self.cuts + 1, len(columns))
+        self.edges_: dict = {col: np.unique(quantiles[:, j]) for j, col in enumerate(columns)}
+        return self
+
+
+    def categories(self, col:str):
+        """ labels of the categories of one variable """
+        edges = self.edges_[col]
+        if self.group_labels is not None and len(edges) - 1 == len(self.group_labels):
+            return pd.Index(self.group_labels)
+        return pd.IntervalIndex.from_breaks(edges, closed="right")
+
+
+    def transform(self, df):
+        """
+        df (pd.DataFrame): dataset with the fitted variables
+        return: pd.DataFrame with one categorical variable per fitted variable, values outside the fitted edges and nan are nan
+        """
+        binned = {}
+        for col, edges in self.edges_.items():
+            x = df[col].to_numpy(dtype=float)
+            ## right-closed intervals, lowest edge included (as pd.qcut)
+            codes = np.searchsorted(edges[1:-1], x, side="left")
+            codes[np.isnan(x) | (x < edges[0]) | (x > edges[-1])] = -1
+            if len(edges) < 2:   # constant variable, no interval (as pd.qcut(duplicates="drop"))
+                codes[:] = -1
+            binned[col + self.suffix] = pd.Categorical.from_codes(codes, categories=self.categories(col), ordered=True)
+        return pd.DataFrame(binned, index=df.index)
+
+
+    def fit_transform(self, df, columns=None):
+        return self.fit(df, columns).transform(df)
+
+
 def equal_freq_binning(df, variable_name, cuts=3, group_labels=None, drop_old_variable=False):
     """
     Split variable into cateogries, each category with equal number of data points
     df : pandas dataframe
-    variable_name (str): variable name, this variable is discretized
+    variable_name (str or list): variable name(s), these variables are discretized
     cuts (int): number of categories
     group_labels (list): list of length of category number
-    return: Dataframe with new discretized variable based on euqal number of datapoints per category
+    return: Dataframe with new discretized variables based on euqal number of datapoints per category
     """
     if group_labels is None:
         group_labels = ["low", "medium", "high"]
+    variable_names = [variable_name] if isinstance(variable_name, str) else list(variable_name)
     print(df.shape[0], "records are euqally split into categories, so that same number of records is in each class (equal frequency binning) ")
-    print("Group labels and bins :", group_labels, pd.qcut(df[variable_name], q=cuts).value_counts())
 
-    new_variable_name = variable_name + "_c"
-    try:
-        df[new_variable_name] = pd.qcut(df[variable_name], q=cuts, labels=group_labels)
-    except Exception:
-        print("drop dublicates")
-        df[new_variable_name] = pd.qcut(df[variable_name], q=cuts, duplicates="drop")
+    binned = EqualFrequencyBinning(cuts=cuts, group_labels=group_labels).fit_transform(df, variable_names)
+    for col in binned.columns:
+        print("Group labels and bins :", col, binned[col].value_counts(sort=False).to_dict())
+    df = pd.concat([df, binned], axis=1)
 
     if drop_old_variable is True:
-        df = df.drop(variable_name, axis=1)
+        df = df.drop(variable_names, axis=1)
 
     return df
 
@@ -126,19 +184,94 @@ def equal_freq_binning(df, variable_name, cuts=3, group_labels=None, drop_old_va
 #     return pd_dataframe
 
 
-def vif_score(X_scaled_drop_nan):
+def _inverse_gram(X, centered=True, rtol=1e-10):
+    """
+    Inverse of the correlation matrix of X (centered=True) or of the cosine matrix X'X with columns of unit length 
+    (centered=False, regressions without constant), 
+    by an eigendecomposition which stays stable for near-singular matrices
+    X (np.array): 2D array without nan
+    rtol (float): eigenvalues below rtol * largest eigenvalue are treated as zero
+    return: inverse matrix and boolean mask of columns which are (nearly) linear combinations of the others
+    """
+    X = np.asarray(X, dtype=float)
+    if centered:
+        X = X - X.mean(axis=0)
+    norms = np.linalg.norm(X, axis=0)
+    constant = norms == 0
+    X = X[:, ~constant] / norms[~constant]
+
+    eigenvalues, eigenvectors = np.linalg.eigh(X.T @ X)
+    null = eigenvalues <= rtol * max(eigenvalues.max(initial=0.0), 1.0)
+    inverse = (eigenvectors[:, ~null] / eigenvalues[~null]) @ eigenvectors[:, ~null].T
+
+    ## columns with loadings on the null space have no unique inverse, their VIF is infinite
+    collinear = np.zeros(len(norms), dtype=bool)
+    collinear[~constant] = (eigenvectors[:, null] ** 2).sum(axis=1) > rtol ** 0.5
+    inverse_full = np.full((len(norms), len(norms)), np.nan)
+    inverse_full[np.ix_(~constant, ~constant)] = inverse
+    return inverse_full, collinear
+
+
+def vif_values(X, centered=True):
+    """
+    Variance inflation factors of all columns from the diagonal of one inverted matrix instead of one OLS per column
+    X (np.array or pd.DataFrame): predictors without nan
+    centered (bool): True gives the standard VIFs of regressions with intercept (diagonal of the inverse correlation matrix),
+        same as statsmodels variance_inflation_factor on a design with constant,
+        False gives the uncentered VIFs of regressions without constant
+    return: np.array with VIF per column, inf for perfectly collinear and nan for constant (centered) or zero columns
+    """
+    inverse, collinear = _inverse_gram(X, centered=centered)
+    vifs = np.diag(inverse).copy()
+    vifs[collinear] = np.inf
+    return vifs
+
+
+def vif_score(X_scaled_drop_nan, centered=True):
     df_vif = pd.DataFrame()
     df_vif["names"]  = X_scaled_drop_nan.columns
-    df_vif["vif_scores"] = [
-        variance_inflation_factor(X_scaled_drop_nan.values.astype(float), i)
-        for i in range(len(X_scaled_drop_nan.columns))
-    ]
+    df_vif["vif_scores"] = vif_values(X_scaled_drop_nan.values.astype(float), centered=centered)
     df_vif = df_vif.sort_values("vif_scores", ascending=False).reset_index(drop=True)
     print("averaged VIF score is around: ", round(df_vif.vif_scores.mean(),1))
 
     return df_vif
 
 
+def drop_high_vif_features(X, threshold=10, centered=True):
+    """
+    Drop the feature with the highest VIF one after another until all VIFs are below the threshold.
+    After each drop the inverse is updated by a rank-one downdate of the remaining rows and columns 
+    instead of inverting the matrix again, only perfectly collinear features require a new decomposition.
+    X (pd.DataFrame): predictors without nan
+    threshold (float): highest VIF which is kept
+    centered (bool): see vif_values()
+    return: pd.DataFrame of the kept features and pd.DataFrame with the dropped features and their VIF when dropped
+    """
+    values = X.values.astype(float)
+    columns = np.arange(X.shape[1])
+    dropped = []
+    inverse, collinear = _inverse_gram(values, centered=centered)
+    while len(columns) > 0:
+        vifs = np.diag(inverse).copy()
+        vifs[collinear] = np.inf
+        vifs = np.where(np.isnan(vifs), np.inf, vifs)   # constant columns are dropped first
+        worst = int(np.argmax(vifs))
+        if vifs[worst] <= threshold:
+            break
+        dropped.append((X.columns[columns[worst]], vifs[worst]))
+        keep = np.arange(len(columns)) != worst
+        if collinear.any() or np.isnan(inverse).any():
+            inverse, collinear = _inverse_gram(values[:, columns[keep]], centered=centered)
+        else:
+            ## inverse of the submatrix without the dropped column: B[-j, -j] - B[-j, j] B[j, -j] / B[j, j]
+            inverse = inverse[np.ix_(keep, keep)] - np.outer(inverse[keep, worst], inverse[worst, keep]) / inverse[worst, worst]
+            collinear = collinear[keep]
+        columns = columns[keep]
+
+    print(f"dropped {len(dropped)} features with VIF above {threshold}")
+    return X.iloc[:, columns], pd.DataFrame(dropped, columns=["names", "vif_scores"])
+
+
 def normalize_feature_importances(df_feature_importances, scale_range=(0,10)):
     """ 
     Normalize columns of pd.DatFrame to same scale
@@ -148,7 +281,7 @@ def normalize_feature_importances(df_feature_importances, scale_range=(0,10)):
     print(f"Nomralize columns to scale: {scale_range[0]} - {scale_range[1]}")
     ## scale importance scores to  same units (non important feautres were removed before)
     df_feature_importances = pd.DataFrame(
-        MinMaxScaler(feature_range=scale_range).fit_transform(df_feature_importances), 
+        agg.minmax_scale(df_feature_importances.to_numpy(dtype=float).T, scale_range).T,
         index=df_feature_importances.index,
         columns=df_feature_importances.columns
     )
@@ -157,28 +290,27 @@ def normalize_feature_importances(df_feature_importances, scale_range=(0,10)):
 
 def calc_weighted_sum_feature_importances(df_feature_importances, model_weights):
     """ 
-    model_weights (dict) : keys are feature importnace columns, values are the weights 
-    return: pd.DataFrame same as df_feature_importances 
+    model_weights (dict) : keys are feature importnace columns of any number of models, 
+        values are the weights (model errors, e.g. mean MAE, importances of better models are weighted stronger)
+    return: pd.DataFrame same as df_feature_importances (normalized)
     but added column with weighted sum for each feature importance
     """
     ## Normalize feature importnaces to same scale
     df_feature_importances = normalize_feature_importances(df_feature_importances)
 
-    ## assigne weights to importnace scores; weight better models stronger
-    models_fi_list = []
-    for model_fi, weight in model_weights.items(): 
-        model = model_fi.split("_")[0]
-        model_fi_weighted = f"{model_fi}_weighted"
-        df_feature_importances[model_fi_weighted] =  df_feature_importances[model_fi] / weight
-        models_fi_list.append(model_fi_weighted)
-
-    ## derive weighted sum for each feature across all models
-    ## TODO remove hardcode, make flexible to different number of models
-    df_feature_importances["weighted_sum_importances"] = df_feature_importances[models_fi_list].fillna(0).sum(axis=1)
+    ## assigne weights to importnace scores of all models at once; weight better models stronger
+    models_fi = list(model_weights)
+    weighted, weighted_sum = agg.weighted_importances(
+        df_feature_importances[models_fi].to_numpy(dtype=float).T, list(model_weights.values()), scale_range=(0, 10)
+    )
+    df_weighted = pd.DataFrame(weighted.T, index=df_feature_importances.index, columns=[f"{fi}_weighted" for fi in models_fi])
+    df_weighted["weighted_sum_importances"] = weighted_sum
+    df_feature_importances = pd.concat([df_feature_importances, df_weighted], axis=1)
 
     return df_feature_importances.sort_values("weighted_sum_importances", ascending=True)
 
 
+@prof.profiled()
 def save_selected_features(X_train, y_train, selected_feat_cols, filename="fs_model.xlsx"):
     """
     Selects feautres from training set and saves them in excel file
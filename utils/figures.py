@@ -6,18 +6,20 @@ import numpy as np
 import pandas as pd
 import contextlib
 
-from scipy.stats import spearmanr
 from sklearn.metrics import confusion_matrix, PredictionErrorDisplay
 
+import matplotlib.colors as mcolors
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 import utils.evaluation as e
 import utils.evaluation_metrics as em
+import utils.profiling as prof
 
 
 
+@prof.profiled()
 def plot_spearman_rank(df_corr, min_periods=100, signif=True, psig=0.05):
         """
         ## Code snippet modified: https://stackoverflow.com/questions/69900363/colour-statistically-non-significant-values-in-seaborn-heatmap-with-a-different
@@ -29,12 +31,12 @@ def plot_spearman_rank(df_corr, min_periods=100, signif=True, psig=0.05):
         return: Figure for Pearson Correlation 
         """ 
  
-        ## get the p value for pearson coefficient, subtract 1 on the diagonal
-        pvals = df_corr.corr(method=lambda x, y: spearmanr(x, y)[1], min_periods=min_periods) - np.eye(*df_corr.corr(method="spearman", min_periods=min_periods).shape)  # np.eye(): diagonal= ones, elsewere=zeros
+        ## correlation and p values from one ranking of the columns, cached for further use e.g. feature clustering
+        rho, pvals = e.spearman_correlation(df_corr, min_periods=min_periods)
 
         #  main plot
         sns.heatmap(
-            df_corr.corr(method="spearman", min_periods=min_periods), 
+            rho, 
             annot=False, square=True, 
             center=0, cmap="RdBu", 
             fmt=".2f", zorder=1,
@@ -43,7 +45,7 @@ def plot_spearman_rank(df_corr, min_periods=100, signif=True, psig=0.05):
         # signifcance mask
         if signif:
                 ## add another heatmap with colouring the non-significant cells
-                sns.heatmap(df_corr.corr(method="spearman", min_periods=min_periods)[pvals>=psig], 
+                sns.heatmap(rho[pvals>=psig], 
                             annot=False, square=True, cbar=False,
                             ## add-ons
                             cmap=sns.color_palette("Greys", n_colors=1, desat=1),  
@@ -56,6 +58,7 @@ def plot_spearman_rank(df_corr, min_periods=100, signif=True, psig=0.05):
 
 
 
+@prof.profiled()
 def plot_confusion_matrix(y_true, y_pred, outfile):
     """
     Plot confusion matrix
@@ -83,16 +86,16 @@ def plot_confusion_matrix(y_true, y_pred, outfile):
 
 
 
+@prof.profiled()
 def plot_stacked_feature_importances(df_feature_importances, target_name, model_names_plot, outfile):
     """
     Stack feature importances of multiple models into one barchart
-    df_feature_importances : pd.DatFrame with columns which contain feature importances to plot
+    df_feature_importances : pd.DatFrame with columns which contain feature importances to plot, one column per model
+    model_names_plot (list): names of the models shown in the legend, same order as the columns
     """
-    model_name_1, model_name_2 , model_name_3 = model_names_plot
-
-    ## TODO remove hardcode - function is currently limited to three models
-    feature_importance_1, feature_importance_2, feature_importance_3 = df_feature_importances.columns.to_list()
-    color = {feature_importance_1:"darkblue", feature_importance_2:"steelblue", feature_importance_3:"grey"}
+    ## one color per model, further models than the default colors get colors of the tab10 palette
+    colors = ["darkblue", "steelblue", "grey"] + list(mcolors.TABLEAU_COLORS.values())
+    color = dict(zip(df_feature_importances.columns, colors))
 
     ## plot
     plt.figure(figsize=(30, 22))
@@ -106,12 +109,10 @@ def plot_stacked_feature_importances(df_feature_importances, target_name, model_
     plt.title(f"Feature Importances for {target_name.replace('_',' ')}")
 
     ## legend
-    top_bar = mpatches.Patch(color="darkblue", label=model_name_1)
-    middle_bar = mpatches.Patch(color="steelblue", label=model_name_2)
-    bottom_bar = mpatches.Patch(color="grey", label=model_name_3)
+    bars = [mpatches.Patch(color=c, label=name) for c, name in zip(color.values(), model_names_plot)]
     plt.tick_params(axis='x', which='major', labelsize=12)
     plt.tick_params(axis='y', which='major', labelsize=12)
-    plt.legend(handles=[top_bar, middle_bar, bottom_bar], loc="lower right")
+    plt.legend(handles=bars, loc="lower right")
     plt.tight_layout()
     
     fig.get_figure().savefig(outfile, bbox_inches="tight")
@@ -119,6 +120,7 @@ def plot_stacked_feature_importances(df_feature_importances, target_name, model_
 
     
 
+@prof.profiled()
 def plot_partial_dependence(df_pd_feature, feature_name:str, partial_dependence_name:str, categorical:list, outfile, **kwargs):
     """
     Creates plots for partial dependecies for multiple models
@@ -164,6 +166,7 @@ def plot_partial_dependence(df_pd_feature, feature_name:str, partial_dependence_
     plt.savefig(outfile, bbox_inches="tight")
     
    
+@prof.profiled()
 def plot_residuals(residuals, model_names_abbreviation,  model_names_plot, outfile):
     """
     Generate plots of residuals and write residuals to csv file
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parallelism budget for nested cross-validation and data shared with worker processes:
+split of the cores among outer folds, inner searches and estimator threads, and datasets published once
+into memory-mapped files (SharedFrame), so that workers open readonly views instead of receiving copies"""
+
+import os
+import tempfile
+import contextlib
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+N_JOBS_ENV = "FLOOD_LOSS_N_JOBS"  # env variable to set the number of cores used by one run
+
+
+def available_cores():
+    """ number of cores usable by this process (respects SLURM/cgroup cpu affinity) """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+def resolve_n_jobs(n_jobs=None):
+    """
+    Get number of cores for the entire run
+    n_jobs (int): explicit number of cores (e.g. from CLI flag), -1 uses all available cores
+        if None, the env variable FLOOD_LOSS_N_JOBS, then SLURM_CPUS_PER_TASK is used, otherwise 1
+    return: int >= 1
+    """
+    if n_jobs is None:
+        n_jobs = os.environ.get(N_JOBS_ENV, os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = max(1, available_cores() + 1 + n_jobs)  # same convention as joblib: -1 == all cores
+    return max(1, n_jobs)
+
+
+@dataclass(frozen=True)
+class ParallelBudget:
+    """
+    Split of the cores across the nested levels of the nested cross-validation,
+    outer * inner * estimator never exceeds the total budget
+    """
+    outer: int = 1       # outer folds fitted in parallel (processes)
+    inner: int = 1       # fits of the inner hyperparameter search (candidates x inner folds) in parallel
+    estimator: int = 1   # threads of the estimator itself, e.g. trees of RF or XGBoost histogram building
+
+    @property
+    def total(self) -> int:
+        return self.outer * self.inner * self.estimator
+
+
+def split_budget(n_jobs, n_outer_folds, n_inner_fits=None):
+    """
+    Split the cores among outer folds, inner search fits and estimator threads.
+    Coarse-grained levels come first, since they parallelize without communication overhead,
+    the remaining cores go to the estimator threads
+    n_jobs (int): total number of cores
+    n_outer_folds (int): number of outer folds (incl. repeats)
+    n_inner_fits (int): number of fits of the inner search (sampled candidates x inner folds), 
+        None if unknown (e.g. successive halving), then all remaining cores go to the inner search
+    return: ParallelBudget
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+    outer = max(1, min(n_jobs, n_outer_folds))
+    remaining = n_jobs // outer
+    inner = max(1, min(remaining, n_inner_fits or remaining))
+    estimator = max(1, remaining // inner)
+    return ParallelBudget(outer=outer, inner=inner, estimator=estimator)
+
+
+def set_estimator_threads(estimator, n_threads):
+    """
+    Set the number of threads of all (nested) steps of a sklearn estimator or pipeline which support n_jobs,
+    e.g. RandomForestRegressor and XGBRegressor, other estimators are left unchanged
+    estimator: sklearn estimator or Pipeline
+    n_threads (int): number of threads
+    return: estimator with updated n_jobs parameters
+    """
+    n_jobs_params = {k: n_threads for k in estimator.get_params(deep=True) if k == "n_jobs" or k.endswith("__n_jobs")}
+    return estimator.set_params(**n_jobs_params)
+
+
+def shared_memory_folder():
+    """ folder for shared arrays, RAM-backed /dev/shm if available """
+    return os.environ.get("JOBLIB_TEMP_FOLDER", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+
+def backing_memmap(values):
+    """ np.memmap which holds the memory of an array (or of a view onto it), None if the array is not memory-mapped """
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return values
+        values = getattr(values, "base", None)
+    return None
+
+
+def is_readonly_memmap(values):
+    """ array is a view onto a readonly memory-mapped file, e.g. a column store, which joblib already shares with workers """
+    memmap = backing_memmap(values)
+    return memmap is not None and memmap.mode == "r"
+
+
+class SharedFrame(object):
+    """
+    pd.DataFrame, pd.Series or np.array published once into a memory-mapped file (in shared memory if available).
+    Pickling transfers only the file name and the labels, each worker process opens a readonly view onto the same memory, 
+    so memory stays flat when the number of workers grows. Data which is already a view onto a readonly memory-mapped 
+    file is not published again
+    """
+    def __init__(self, data, folder=None):
+        self.kind = "frame" if isinstance(data, pd.DataFrame) else "series" if isinstance(data, pd.Series) else "array"
+        values = np.asarray(data)   # keeps the dtype, e.g. float32 of the column store
+        self.columns = data.columns if self.kind == "frame" else getattr(data, "name", None)
+        self.index = data.index if self.kind != "array" else None
+        self._owner = False  # only the publishing process removes the file
+
+        if is_readonly_memmap(values):
+            ## already in a memory-mapped file (e.g. column store): joblib sends the array by file name, no copy is published
+            self.path = None
+            self._values = values
+            return
+        fd, self.path = tempfile.mkstemp(prefix="shared_frame_", suffix=".npy", dir=folder or shared_memory_folder())
+        os.close(fd)
+        shared = np.lib.format.open_memmap(self.path, mode="w+", dtype=values.dtype, shape=values.shape)
+        shared[:] = values
+        shared.flush()
+        del shared
+        self._owner = True
+        self._values = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_owner=False, _values=None if self.path else self._values)
+        return state
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.load(self.path, mmap_mode="r")
+        return self._values
+
+    def get(self):
+        """ return: view onto the shared memory in the type of the published data """
+        if self.kind == "frame":
+            return pd.DataFrame(self.values, columns=self.columns, index=self.index, copy=False)
+        if self.kind == "series":
+            return pd.Series(self.values, name=self.columns, index=self.index, copy=False)
+        return self.values
+
+    def close(self):
+        if self.path is not None:
+            self._values = None
+        if self._owner and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def shared(data):
+    """ resolve SharedFrame to its view, other data is returned unchanged """
+    return data.get() if isinstance(data, SharedFrame) else data
+
+
+@contextlib.contextmanager
+def shared_for_workers(n_jobs, *data):
+    """
+    Publish data into shared memory if it is used by several worker processes, removed again at exit.
+    Views onto readonly memory-mapped files are not copied (see SharedFrame)
+    n_jobs (int): number of workers, for 1 the data is passed on unchanged
+    return: tuple of SharedFrames or of the unchanged data
+    """
+    if n_jobs == 1:
+        yield data
+        return
+    shared_data = []
+    try:
+        for d in data:
+            shared_data.append(SharedFrame(d))
+        yield tuple(shared_data)
+    finally:
+        for d in shared_data:
+            d.close()
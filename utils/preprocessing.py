@@ -3,12 +3,25 @@
 """Utility functions for preprocessing"""
 
 import os
+import re
+import contextlib
+import shutil
+import uuid
+import functools
+import tempfile
+import joblib
+import warnings
 import numpy as np
 import pandas as pd
 import json
 
 from dataclasses import dataclass
 import difflib
+from collections import Counter
+from joblib import Parallel, delayed
+from scipy import sparse
+
+import utils.parallel as par
 
 
 def load_config(config_file:str):
@@ -24,26 +37,207 @@ def load_config(config_file:str):
         config = json.load(src)
     return config
 
-def drop_object_columns(df):
+def csv_to_column_store(csv_file:str, store_dir:str, categorical:list=None, dtype="float32", chunksize:int=None):
+    """
+    Convert a survey extract from csv to a binary column store, which is parsed only once and 
+    afterwards opened zero-copy by all jobs as memory-mapped array
+    :param csv_file: path to csv file (str)
+    :param store_dir: folder of column store (str), contains values.npy and meta.json
+    :param categorical: names of categorical columns, read as strings and stored as category codes;
+        all other columns are numeric, values which are no numbers (e.g. typos) are stored as nan with a warning.
+        Columns without any number (e.g. text answers) raise a ValueError, they have to be listed as categorical
+    :param dtype: float dtype of all columns, nan marks missing values
+    :param chunksize: number of rows parsed at once, None reads the entire csv into memory. 
+        With chunks the csv is read in several passes (layout, categories, values), memory is bounded by the chunk size
+    :return: path of column store
+    """
+    categorical = list(categorical or [])
+    read_dtype = {col: str for col in categorical}   # same type of categories in all chunks
+    if chunksize is None:
+        df = pd.read_csv(csv_file, dtype=read_dtype)
+        read_chunks = lambda usecols=None: iter([df if usecols is None else df[usecols]])
+    else:
+        read_chunks = lambda usecols=None: pd.read_csv(csv_file, chunksize=chunksize, usecols=usecols, dtype=read_dtype)
+
+    ## layout: number of rows and columns
+    n_rows, columns = 0, None
+    for chunk in read_chunks():
+        n_rows += chunk.shape[0]
+        columns = chunk.columns.to_list()
+
+    ## sorted categories of the entire column, same codes as pd.factorize(<entire column>, sort=True)
+    categories = {}
+    categorical = [col for col in columns if col in categorical]
+    if categorical:
+        uniques = {col: [] for col in categorical}
+        for chunk in read_chunks(categorical):
+            for col in categorical:
+                uniques[col].append(chunk[col].dropna().unique())
+        for col in categorical:
+            categories[col] = pd.factorize(np.concatenate(uniques[col]), sort=True)[1].tolist()
+
+    ## write into temporary folder and rename it, concurrent jobs never open a half written store
+    tmp_dir = f"{store_dir.rstrip(os.sep)}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    values = np.lib.format.open_memmap(   # column-major, each column is contiguous on disk
+        os.path.join(tmp_dir, "values.npy"), mode="w+", dtype=dtype, shape=(n_rows, len(columns)), fortran_order=True
+    )
+    start = 0
+    n_given, n_coerced = Counter(), Counter()   # non-missing values and values which are no numbers per numeric column
+    for chunk in read_chunks():
+        stop = start + chunk.shape[0]
+        for j, col in enumerate(columns):
+            if col in categories:
+                codes = pd.Categorical(chunk[col], categories=categories[col]).codes
+                values[start:stop, j] = np.where(codes == -1, np.nan, codes)
+            else:
+                numeric = pd.to_numeric(chunk[col], errors="coerce")
+                n_given[col] += int(chunk[col].notna().sum())
+                n_coerced[col] += int(numeric.isna().sum() - chunk[col].isna().sum())
+                values[start:stop, j] = numeric.to_numpy(dtype=dtype, na_value=np.nan)
+        start = stop
+    values.flush()
+    del values
+
+    text_columns = [col for col in n_coerced if n_coerced[col] and n_coerced[col] == n_given[col]]
+    if text_columns:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f"{csv_file}: columns without numbers {text_columns}, pass them as categorical or drop them")
+    coerced = {col: n for col, n in n_coerced.items() if n}
+    if coerced:
+        warnings.warn(f"{csv_file}: values which are no numbers are stored as nan (count per column): {coerced}")
+
+    meta = {
+        "columns": columns,
+        "dtype": np.dtype(dtype).name,
+        "categories": categories,
+        "source": os.path.abspath(csv_file),
+        "source_mtime": os.path.getmtime(csv_file),
+    }
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as dst:
+        json.dump(meta, dst, indent=2)
+    ## move an existing store aside before, so that the store folder is missing only between two renames
+    old_dir = f"{store_dir.rstrip(os.sep)}.{uuid.uuid4().hex}.old"
+    with contextlib.suppress(FileNotFoundError):
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return store_dir
+
+
+def column_store_is_current(csv_file:str, store_dir:str):
+    """
+    Check if column store exists and was converted from the current version of the csv file
+    :return: bool
+    """
+    meta_file = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file, "r") as src:
+        meta = json.load(src)
+    return meta["source_mtime"] == os.path.getmtime(csv_file)
+
+
+def load_column_store(store_dir:str, mmap_mode="r", as_categorical=False):
+    """
+    Open column store as pd.DataFrame without copying or parsing, backed by a memory-mapped array shared by all processes
+    :param store_dir: folder of column store (str)
+    :param mmap_mode: "r" (readonly, zero-copy), "c" (copy-on-write) or None (load into memory)
+    :param as_categorical: convert category codes back to pd.Categorical, this copies the categorical columns
+    :return: pd.DataFrame
+    """
+    with open(os.path.join(store_dir, "meta.json"), "r") as src:
+        meta = json.load(src)
+    values = np.load(os.path.join(store_dir, "values.npy"), mmap_mode=mmap_mode)
+    df = pd.DataFrame(values, columns=meta["columns"], copy=False)
+
+    if as_categorical:
+        for col, categories in meta["categories"].items():
+            codes = df[col].fillna(-1).to_numpy(dtype=int)
+            df[col] = pd.Categorical.from_codes(codes, categories=categories)
+    return df
+
+
+class PreparedDataset(object):
+    """
+    Predictors and target of one (year, target) dataset, prepared once and shared by model fitting, evaluation,
+    feature importance and partial dependence. X and y are views onto one float array, no scaling is applied,
+    scaling is only done inside the pipelines (fitted on the training folds)
+    """
+    def __init__(self, Xy, target_name:str, complete_cases=False):
+        """
+        :param Xy: pd.DataFrame with target and predictors, e.g. memory-mapped from a column store
+        :param target_name: name of target column
+        :param complete_cases: keep only records without any nan value (e.g. for Elastic Net and Random Forest),
+            records with nan in target are always dropped
+        """
+        self.target_name: str = target_name
+        self.X_names: list = [col for col in Xy.columns if col != target_name]
+        dtype = np.result_type(*Xy.dtypes) if all(np.issubdtype(d, np.floating) for d in Xy.dtypes) else float
+
+        ## target as first (as in the survey extracts) or last column, so that X and y are views without copying;
+        ## other column orders are reordered once with the target as last column
+        ordered = Xy if target_name in (Xy.columns[0], Xy.columns[-1]) else Xy[self.X_names + [target_name]]
+        self.columns: list = ordered.columns.to_list()
+        self._y_col = 0 if self.columns[0] == target_name else len(self.columns) - 1
+        self._X_cols = slice(1, None) if self._y_col == 0 else slice(None, -1)
+        values = ordered.to_numpy(dtype=dtype, copy=False)
+
+        rows = ~np.isnan(values[:, self._y_col])
+        if complete_cases:
+            rows &= ~np.isnan(values).any(axis=1)
+        self.n_dropped: int = int((~rows).sum())
+        self.values = values if rows.all() else values[rows]   # at most one copy
+        self.index = Xy.index[rows]
+
+    @property
+    def X(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values[:, self._X_cols], columns=self.X_names, index=self.index, copy=False)
+
+    @property
+    def y(self) -> pd.Series:
+        return pd.Series(self.values[:, self._y_col], name=self.target_name, index=self.index, copy=False)
+
+    @property
+    def Xy(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, columns=self.columns, index=self.index, copy=False)
+
+    @property
+    def shape(self) -> tuple:
+        return self.values.shape
+
+
+## columns with free text answers: "do not know" (.88), "no answer" (.99), "please specify" and "others"
+OBJECT_COLUMNS_PATTERN = re.compile(r"(.88)$|(.99)$|(.specify)$|(.Specify)$|(others)")
+
+
+def drop_object_columns(df, pattern=OBJECT_COLUMNS_PATTERN):
     """
     Remove object columns from dataframe
     """
-    df = df.loc[:, ~df.columns.str.contains(
-            r"(.88)$|(.99)$|(.specify)$|(.Specify)$|(others)"
-            )
-        ] 
+    df = df.loc[:, [not pattern.search(str(col)) for col in df.columns]]
     return df
 
 
+def _text_columns(df):
+    return df.select_dtypes(include=["object", "string"]).columns
+
+
+def _repair_typos(column: pd.Series) -> pd.Series:
+    """ empty cells to nan and decimal commas to points (",5" -> "0.5") in the strings of one column, other values are kept """
+    column = column.mask(column.isin([" ", ""]))
+    repaired = column.str.replace(r"^,", "0.", regex=True).str.replace(",", ".", regex=False)
+    return repaired.where(repaired.notna(), column)   # .str gives nan for non-string values
+
+
 def drop_typos(df):
     """
-    Repair typos in numeric columns
+    Repair typos in numeric columns, only columns with strings are touched
     """
-    df = df.replace({
-        " ": np.nan, 
-        "":np.nan
-        }) # fill empty cells, otherwise no cols append possible
-    df = df.replace({"^,":"0.", ",":"."}, regex=True) 
+    df = df.copy()
+    for col in _text_columns(df):
+        df[col] = _repair_typos(df[col])
     return df
 
 
@@ -59,6 +253,199 @@ def check_types(x):
         return float(x)
 
 
+class SurveyCleaning(object):
+    """
+    Cleaning stage of raw survey exports: drops free text columns, repairs typos and converts columns with strings
+    to numbers column-wise with vectorized string operations, numeric columns are not touched.
+    A column is converted if at least min_numeric_share of its non-missing values are numbers, 
+    otherwise it is kept as it is. Per-column conversion stats are collected in stats_
+    """
+    def __init__(self, pattern=OBJECT_COLUMNS_PATTERN, min_numeric_share:float=0.9, dtype="float64"):
+        """
+        :param pattern: compiled regex of column names which are dropped, None keeps all columns
+        :param min_numeric_share: minimum share of non-missing values convertible to numbers to convert a column
+        :param dtype: float dtype of converted columns
+        """
+        self.pattern = pattern
+        self.min_numeric_share: float = min_numeric_share
+        self.dtype = dtype
+        self.numeric_columns: dict = {}   # column -> converted or not, decided on the first (chunk of) data
+        self._stats: dict = {}
+
+
+    def clean(self, df) -> pd.DataFrame:
+        """
+        Clean one DataFrame or chunk, the stats are accumulated over all calls
+        :param df: pd.DataFrame with raw survey answers
+        :return: cleaned pd.DataFrame
+        """
+        if self.pattern is not None:
+            df = drop_object_columns(df, self.pattern)
+        df = df.copy()
+        for col in _text_columns(df):
+            column = df[col]
+            is_string = column.str.len().notna()   # .str gives nan for non-string values
+            n_values = int(column.notna().sum())
+            repaired = _repair_typos(column)
+            numbers = pd.to_numeric(repaired, errors="coerce")
+
+            n_numbers = int(numbers.notna().sum())
+            n_empty = n_values - int(repaired.notna().sum())
+            if col not in self.numeric_columns:
+                self.numeric_columns[col] = n_numbers >= self.min_numeric_share * max(n_values - n_empty, 1)
+            if self.numeric_columns[col]:
+                df[col] = numbers.astype(self.dtype)
+            else:
+                df[col] = repaired
+
+            stats = self._stats.setdefault(col, dict.fromkeys(["n_values", "n_empty", "n_comma_repaired", "n_converted", "n_failed"], 0))
+            stats["n_values"] += n_values
+            stats["n_empty"] += n_empty
+            stats["n_comma_repaired"] += int((is_string & column.str.contains(",", regex=False, na=False)).sum())
+            stats["n_converted"] += int((is_string & numbers.notna()).sum())
+            stats["n_failed"] += n_values - n_empty - n_numbers
+        return df
+
+
+    def clean_csv(self, csv_file:str, chunksize:int=None, **kwargs) -> pd.DataFrame:
+        """
+        Read and clean a raw survey export, with chunksize the csv is parsed in chunks, 
+        so that only one raw chunk and the cleaned (numeric) data are in memory
+        :param csv_file: path to csv file
+        :param chunksize: number of rows parsed at once, None reads the entire csv
+        :param kwargs: further arguments of pd.read_csv
+        :return: cleaned pd.DataFrame
+        """
+        if chunksize is None:
+            return self.clean(pd.read_csv(csv_file, **kwargs))
+        chunks = [self.clean(chunk) for chunk in pd.read_csv(csv_file, chunksize=chunksize, **kwargs)]
+        return pd.concat(chunks)
+
+
+    @property
+    def stats_(self) -> pd.DataFrame:
+        """ per column: non-missing values, empty cells, repaired decimal commas, strings converted to numbers, values not convertible and if the column was converted """
+        stats = pd.DataFrame.from_dict(self._stats, orient="index")
+        stats["converted"] = pd.Series(self.numeric_columns)
+        return stats
+
+
+def _bigram_features(text:str):
+    """
+    Bigrams of a string, each occurrence as own feature (bigram, n-th occurrence), 
+    so that the dot product of two binary feature vectors is the size of the multiset intersection of their bigrams
+    """
+    counts = Counter(text[i:i + 2] for i in range(len(text) - 1))
+    return [(bigram, k) for bigram, count in counts.items() for k in range(count)]
+
+
+class BigramIndex(object):
+    """
+    Bigram index over the unique strings of one column for fuzzy matching with difflib ratio and a cutoff.
+    Candidates are prefiltered without false negatives: the matching blocks of difflib.SequenceMatcher 
+    with M matched characters in K blocks share at least M - K bigrams, K - 1 is at most the number of 
+    unmatched characters T - 2M (T: length of both strings), and ratio = 2M / T >= cutoff gives
+    shared bigrams >= T * (1.5 * cutoff - 1) - 1. Additionally the length ratio 2 * min(la, lb) / T must reach the cutoff.
+    Only the candidates are scored by difflib.get_close_matches, so that the matches are the same as without index
+    """
+    def __init__(self, values, cutoff=0.9):
+        """
+        values (iterable): strings to match against, non-string values are ignored
+        cutoff (float): minimum difflib ratio of a match
+        """
+        self.cutoff: float = cutoff
+        self.values = np.array(sorted({v for v in values if isinstance(v, str)}, key=len), dtype=object)  # sorted by length
+        self.lengths = np.array([len(v) for v in self.values], dtype=np.int64)
+        self.exact: set = set(self.values)
+
+        self.vocabulary: dict = {}
+        rows, cols = [], []
+        for i, v in enumerate(self.values):
+            for feature in _bigram_features(v):
+                rows.append(i)
+                cols.append(self.vocabulary.setdefault(feature, len(self.vocabulary)))
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(self.values), len(self.vocabulary))
+        )
+        self.postings = self.matrix.tocsc()   # strings of each bigram, sorted by index == by length
+        self.postings.sort_indices()
+        self.doc_freq = np.diff(self.postings.indptr)
+
+
+    def _min_shared(self, la, lb):
+        """ lower bound of shared bigrams of strings with length la and lb which reach the cutoff """
+        return (la + lb) * (1.5 * self.cutoff - 1) - 1 - 1e-9
+
+
+    def candidates(self, query:str):
+        """
+        Indices of strings which can reach the cutoff. Strings with a positive bound of shared bigrams are 
+        found by prefix filtering: a string sharing at least t of the f bigrams of the query shares one of
+        its f - t + 1 rarest bigrams, then the shared bigrams of these strings are counted
+        query (str): string to match
+        return: np.array of indices into self.values
+        """
+        la, lengths = len(query), self.lengths
+        ## length filter (difflib real_quick_ratio), contiguous range since values are sorted by length
+        lo = np.searchsorted(lengths, np.ceil(la * self.cutoff / (2 - self.cutoff) - 1e-9), side="left")
+        hi = np.searchsorted(lengths, np.floor(la * (2 - self.cutoff) / self.cutoff + 1e-9), side="right")
+        if self.cutoff <= 2 / 3:
+            return np.arange(lo, hi)
+
+        ## lengths for which the bound is not positive: all strings are candidates
+        hi_zero = max(lo, min(hi, np.searchsorted(lengths, np.floor(1 / (1.5 * self.cutoff - 1) - la + 1e-9), side="right")))
+        selected = np.arange(lo, hi_zero)
+        if hi_zero == hi:
+            return selected
+
+        features = [self.vocabulary.get(feature, -1) for feature in _bigram_features(query)]
+        n_prefix = len(features) - int(np.ceil(self._min_shared(la, lengths[hi_zero]))) + 1
+        prefix = sorted(features, key=lambda j: self.doc_freq[j] if j >= 0 else 0)[:max(n_prefix, 0)]
+        postings = []
+        for j in prefix:
+            if j < 0:   # bigram of no string
+                continue
+            indices = self.postings.indices[self.postings.indptr[j]:self.postings.indptr[j + 1]]
+            postings.append(indices[np.searchsorted(indices, hi_zero):np.searchsorted(indices, hi)])
+        if not postings:
+            return selected
+
+        marked = np.zeros(hi - hi_zero, dtype=bool)
+        marked[np.concatenate(postings) - hi_zero] = True
+        filtered = hi_zero + np.flatnonzero(marked)
+        query_vector = np.bincount([j for j in features if j >= 0], minlength=len(self.vocabulary))
+        shared = self.matrix[filtered] @ query_vector
+        return np.concatenate([selected, filtered[shared >= self._min_shared(la, lengths[filtered])]])
+
+
+    def match(self, queries, n=1):
+        """
+        Best matches of each query, same as difflib.get_close_matches(query, values, n, cutoff)
+        queries (list): strings to match
+        n (int): maximum number of matches per query
+        return: list with a list of matches per query
+        """
+        matches = []
+        for query in queries:
+            if n == 1 and query in self.exact:   # ratio 1.0, no other string can reach it
+                matches.append([query])
+                continue
+            candidates = self.candidates(query)
+            matches.append(difflib.get_close_matches(query, self.values[candidates].tolist(), n=n, cutoff=self.cutoff))
+        return matches
+
+
+@functools.lru_cache(maxsize=1)
+def _load_bigram_index(path:str):
+    """ BigramIndex loaded once per worker process, its arrays are readonly views onto the memory-mapped file """
+    return joblib.load(path, mmap_mode="r")
+
+
+def _match_batch(index_file:str, queries, n=1):
+    """ BigramIndex.match() in a worker process, the index is passed by file name instead of pickled per batch """
+    return _load_bigram_index(index_file).match(queries, n)
+
+
 @dataclass()
 class FuzzyMerge:
     """
@@ -72,20 +459,47 @@ class FuzzyMerge:
     how: str = "left" # "inner"  
     n: int = 1  # match with best one
     cutoff: float = 0.9
-    # higher cutoff == more strict in matching, TODO make cutoff as variable,
+    # higher cutoff == more strict in matching
+    indexed: bool = True  # prefilter candidates by a bigram index, same matches as comparing against all values
+    n_jobs: int = 1  # processes for batches of queries (indexed only)
+    batch_size: int = 2000  # queries per batch (indexed only)
 
     def main(self) -> pd.DataFrame:
         df = self.right.copy()
-        df[self.left_on] = [
-            self.get_closest_match(x, self.left[self.left_on]) 
-            for x in df[self.right_on]
-        ]
+        if self.indexed:
+            df[self.left_on] = self.get_closest_matches(df[self.right_on])
+        else:
+            df[self.left_on] = [
+                self.get_closest_match(x, self.left[self.left_on]) 
+                for x in df[self.right_on]
+            ]
 
         return self.left.merge(df, on=self.left_on, how=self.how) # noqa: E501
 
-    def get_closest_match(self, left: pd.Series, right: pd.Series, cutoff=0.9) -> str or None:  # noqa: E501
-        #matches = difflib.get_close_matches(left, right, n=self.n, cutoff=self.cutoff)
-        matches = difflib.get_close_matches(left, right, n=self.n, cutoff=cutoff)
+    def get_closest_match(self, left: pd.Series, right: pd.Series, cutoff=None) -> str or None:  # noqa: E501
+        matches = difflib.get_close_matches(left, right, n=self.n, cutoff=self.cutoff if cutoff is None else cutoff)
 
         return matches[0] if matches else None
-        
+
+    def get_closest_matches(self, queries: pd.Series) -> list:
+        """
+        Closest match of each query via BigramIndex over left_on, each unique query is matched once,
+        batches of queries run in parallel processes. The index is dumped once into shared memory and 
+        each worker loads it once, instead of pickling it for each batch
+        """
+        index = BigramIndex(self.left[self.left_on], cutoff=self.cutoff)
+        unique_queries = [q for q in pd.unique(queries) if isinstance(q, str)]
+        batches = [unique_queries[i:i + self.batch_size] for i in range(0, len(unique_queries), self.batch_size)]
+        if self.n_jobs == 1 or len(batches) <= 1:
+            results = [index.match(batch, self.n) for batch in batches]
+        else:
+            fd, index_file = tempfile.mkstemp(prefix="bigram_index_", suffix=".joblib", dir=par.shared_memory_folder())
+            os.close(fd)
+            try:
+                joblib.dump(index, index_file)
+                results = Parallel(n_jobs=self.n_jobs)(delayed(_match_batch)(index_file, batch, self.n) for batch in batches)
+            finally:
+                os.unlink(index_file)
+
+        best = {q: m[0] if m else None for batch, batch_matches in zip(batches, results) for q, m in zip(batch, batch_matches)}
+        return [best.get(q) if isinstance(q, str) else None for q in queries]
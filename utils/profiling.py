@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Wall time, CPU time and peak memory of the pipeline stages"""
+
+import os
+import sys
+import json
+import time
+import resource
+import datetime
+import functools
+import contextlib
+
+import pandas as pd
+
+
+def _cpu_time():
+    """ user and system CPU time of this process (all threads) and of its terminated child processes """
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    """ peak resident memory of this process since start or since the last _reset_peak_rss() """
+    try:
+        with open("/proc/self/status", "r") as src:
+            for line in src:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, kB on Linux
+
+
+def _reset_peak_rss():
+    """ reset peak resident memory of this process (Linux only) return: bool, False if not supported """
+    try:
+        with open("/proc/self/clear_refs", "w") as dst:
+            dst.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Profiler(object):
+    """
+    Records wall time, CPU time and peak resident memory of each stage together with labels such as model and target.
+    Stages can be nested, the peak memory of a stage includes the peaks of its nested stages.
+    Work done in worker processes which are still alive (e.g. reused joblib workers) is not part of the CPU time
+    """
+    def __init__(self):
+        self.records: list = []
+        self._labels: dict = {}
+        self._running: list = []  # [stage name, peak memory so far] of the running (nested) stages
+
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        """ add labels, e.g. model and target, to all stages recorded inside this context """
+        previous = self._labels
+        self._labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._labels = previous
+
+
+    @contextlib.contextmanager
+    def stage(self, name:str, **labels):
+        """
+        Profile the code inside this context
+        :param name: name of stage, e.g. function name
+        :param labels: further labels of this stage only
+        :yield: dict, record of the stage which is completed when the stage finished
+        """
+        if self._running:
+            self._running[-1][1] = max(self._running[-1][1], _peak_rss_mb())  # keep peak of the enclosing stage
+        per_stage = _reset_peak_rss()
+        record = {
+            "stage": name,
+            "parent": self._running[-1][0] if self._running else None,
+            **self._labels,
+            **labels,
+            "started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+        }
+        self._running.append([name, 0.0])
+        wall_start, cpu_start = time.perf_counter(), _cpu_time()
+        try:
+            yield record
+        finally:
+            peak = max(self._running.pop()[1], _peak_rss_mb())
+            if self._running:
+                self._running[-1][1] = max(self._running[-1][1], peak)
+            record.update(
+                wall_time_s=round(time.perf_counter() - wall_start, 3),
+                cpu_time_s=round(_cpu_time() - cpu_start, 3),
+                peak_rss_mb=round(peak, 1),
+                peak_rss_scope="stage" if per_stage else "process",  # without reset the peak since process start
+            )
+            self.records.append(record)
+
+
+    def profiled(self, name:str=None):
+        """ decorator, profiles each call of the function as one stage named by the function """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__qualname__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def dump(self, outfile:str, clear=True):
+        """
+        Store recorded stages as json, e.g. one file per job
+        :param clear: remove stored records, so that the next job of this process starts with an empty profile
+        :return: path of json file
+        """
+        os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
+        with open(outfile, "w") as dst:
+            json.dump(self.records, dst, indent=2, default=str)
+        if clear:
+            self.records = []
+        return outfile
+
+
+def merge_profiles(infiles:list, outfile:str):
+    """
+    Merge profiles of several jobs into one run profile, written as json and csv (same name)
+    :param infiles: json files from Profiler.dump()
+    :param outfile: path of json file, the csv file is stored next to it
+    :return: pd.DataFrame with one row per stage
+    """
+    records = []
+    for infile in sorted(infiles):
+        with open(infile, "r") as src:
+            records.extend(json.load(src))
+    with open(outfile, "w") as dst:
+        json.dump(records, dst, indent=2, default=str)
+    df_profile = pd.DataFrame(records)
+    df_profile.to_csv(f"{os.path.splitext(outfile)[0]}.csv", index=False)
+    return df_profile
+
+
+## profiler of this process, used by the decorated stages of all modules
+PROFILER = Profiler()
+stage = PROFILER.stage
+labels = PROFILER.labels
+profiled = PROFILER.profiled
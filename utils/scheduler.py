@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Task scheduler for the aoi x year x target x pipeline grid"""
+
+import os
+import itertools
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+@dataclass(frozen=True)
+class Job:
+    """
+    One independent model job: fit, evaluate and derive importances of one pipeline
+    for one target variable of one dataset (aoi and flood type, year)
+    """
+    aoi_and_floodtype: str
+    year: str
+    target: str
+    pipe_name: str
+
+    @property
+    def model_name(self) -> str:
+        return self.pipe_name.split("_")[1]
+
+    @property
+    def group(self) -> tuple:
+        """ key of the reduction step, all pipelines of one target belong to the same group """
+        return (self.aoi_and_floodtype, self.year, self.target)
+
+
+def expand_jobs(aois, years, targets, pipelines):
+    """
+    Expand every (aoi, year, target, pipeline) combination into an independent job
+    aois, years, targets, pipelines (list): settings of the grid
+    return: list of Jobs, ordered in the same way as the nested loops of the driver script
+    """
+    return [Job(*combi) for combi in itertools.product(aois, years, targets, pipelines)]
+
+
+def group_jobs(jobs):
+    """
+    Group jobs by their reduction key (aoi, year, target)
+    return: dict with reduction key and list of jobs belonging to it, insertion ordered
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.group, []).append(job)
+    return groups
+
+
+def slurm_array_task_id():
+    """
+    Get index of the current task inside a SLURM job array
+    return: int or None if not running as SLURM job array
+    """
+    task_id = os.environ.get("SLURM_ARRAY_TASK_ID")
+    return int(task_id) if task_id is not None else None
+
+
+def run_jobs(jobs, fit_func, reduce_func=None, n_workers=1):
+    """
+    Run all jobs on a process pool and reduce each group as soon as all its jobs are done
+    jobs (list): Jobs from expand_jobs()
+    fit_func (callable): called with one Job, runs in a worker process
+    reduce_func (callable): called with the reduction key (aoi, year, target) in the main process,
+        after all jobs of this key finished. Skipped if None
+    n_workers (int): number of worker processes, 1 runs all jobs sequentially in the current process
+    return: dict with results of fit_func per Job
+    """
+    groups = group_jobs(jobs)
+    pending = {key: len(group) for key, group in groups.items()}
+    results = {}
+
+    def _job_done(job, result):
+        results[job] = result
+        pending[job.group] -= 1
+        if pending[job.group] == 0 and reduce_func is not None:
+            reduce_func(*job.group)
+
+    if n_workers == 1:
+        for job in jobs:
+            _job_done(job, fit_func(job))
+        return results
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(fit_func, job): job for job in jobs}
+        for future in as_completed(futures):
+            _job_done(futures[future], future.result())   # re-raises errors from worker
+
+    return results
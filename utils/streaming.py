@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Out-of-core nested cross-validation for loss datasets which do not fit into memory.
+The dataset is read chunk-wise from its column store, models are trained incrementally
+and evaluated on streamed out-of-fold chunks, memory is bounded by the chunk size"""
+
+import os
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from xgboost import XGBRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.linear_model import SGDRegressor
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import ParameterSampler
+from sklearn.utils import Bunch
+
+import utils.profiling as prof
+
+
+METRICS = ("MAE", "RMSE", "MBE", "R2", "SMAPE")
+GREATER_IS_BETTER = {"MAE": False, "RMSE": False, "MBE": False, "R2": True, "SMAPE": False}
+STREAMING_MODELS = ("en", "rf", "xgb")
+
+
+class ChunkedDataset(object):
+    """
+    Column store (pp.csv_to_column_store) read in chunks of records, only one chunk is held in memory at once
+    """
+    def __init__(self, store_dir:str, target_name:str, chunk_size:int=100_000, complete_cases=False):
+        """
+        :param store_dir: folder of column store
+        :param target_name: name of target column
+        :param chunk_size: number of records per chunk
+        :param complete_cases: skip records with any nan value (e.g. for Elastic Net and Random Forest),
+            records with nan in target are always skipped
+        """
+        with open(os.path.join(store_dir, "meta.json"), "r") as src:
+            meta = json.load(src)
+        self.values = np.load(os.path.join(store_dir, "values.npy"), mmap_mode="r")
+        self.target_name: str = target_name
+        self.X_names: list = [col for col in meta["columns"] if col != target_name]
+        self._X_idx = [j for j, col in enumerate(meta["columns"]) if col != target_name]
+        self._y_idx = meta["columns"].index(target_name)
+        self.chunk_size: int = chunk_size
+        self.complete_cases = complete_cases
+
+    @property
+    def n_rows(self) -> int:
+        return self.values.shape[0]
+
+    @property
+    def n_chunks(self) -> int:
+        return -(-self.n_rows // self.chunk_size)
+
+    def _valid(self, X, y):
+        valid = ~np.isnan(y)
+        if self.complete_cases:
+            valid &= ~np.isnan(X).any(axis=1)
+        return valid
+
+    def chunks(self, mask=None):
+        """
+        Read the dataset chunk by chunk
+        :param mask: callable, selects records of a chunk by their row numbers, e.g. the test records of one outer fold
+        :yield: row numbers, X (pd.DataFrame) and y (np.array) of the selected valid records of each chunk
+        """
+        for start in range(0, self.n_rows, self.chunk_size):
+            block = np.asarray(self.values[start:start + self.chunk_size])   # reads one chunk from disk
+            rows = np.arange(start, start + block.shape[0])
+            X, y = block[:, self._X_idx], block[:, self._y_idx]
+            selected = self._valid(X, y)
+            if mask is not None:
+                selected &= mask(rows)
+            if selected.any():
+                yield rows[selected], pd.DataFrame(X[selected], columns=self.X_names, copy=False), y[selected]
+
+    def stream(self, mask=None):
+        """ :return: callable which starts a new pass over X and y of the selected records, e.g. for each epoch """
+        return lambda: ((X, y) for _, X, y in self.chunks(mask))
+
+    def sample(self, n_samples:int, seed:int=None):
+        """
+        Random sample of valid records, e.g. for partial dependence and residual plots
+        :return: pd.DataFrame with predictors and target as last column, indexed by row numbers
+        """
+        rows = np.sort(np.random.default_rng(seed).choice(self.n_rows, size=min(n_samples, self.n_rows), replace=False))
+        block = np.asarray(self.values[rows])
+        X, y = block[:, self._X_idx], block[:, self._y_idx]
+        valid = self._valid(X, y)
+        return pd.DataFrame(
+            np.column_stack([X[valid], y[valid]]), columns=self.X_names + [self.target_name], index=rows[valid]
+        )
+
+
+def _splitmix64(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def fold_ids(rows, n_splits:int, *salt):
+    """
+    Assign records to folds by hashing their row numbers, so that each pass over the data reproduces
+    the same folds independent of the chunk size and without storing a fold index for the entire dataset
+    :param rows: np.array with row numbers
+    :param n_splits: number of folds
+    :param salt: ints, e.g. seed and repeat, each combination gives an independent random split
+    :return: np.array with fold number of each record
+    """
+    h = np.asarray(rows, dtype=np.uint64)
+    for s in salt:
+        h = _splitmix64(h ^ _splitmix64(np.full(1, s, dtype=np.uint64)))
+    return (_splitmix64(h) % np.uint64(n_splits)).astype(np.int64)
+
+
+class StreamingScores(object):
+    """
+    Evaluation metrics (same definitions as utils.evaluation_metrics) accumulated chunk by chunk
+    """
+    def __init__(self):
+        self.n = 0
+        self.sums = np.zeros(6)  # error, absolute error, squared error, y, y², SMAPE terms
+
+    def update(self, y_true, y_pred):
+        y_true, y_pred = np.asarray(y_true, dtype=float), np.asarray(y_pred, dtype=float)
+        error = y_true - y_pred
+        self.n += len(y_true)
+        self.sums += [
+            error.sum(), np.abs(error).sum(), (error**2).sum(), y_true.sum(), (y_true**2).sum(),
+            (2 * np.abs(error) / (np.abs(y_true) + np.abs(y_pred)) * 100).sum(),
+        ]
+        return self
+
+    def scores(self):
+        """ :return: dict with metrics, signed like sklearn scorers (errors are negative, greater is always better) """
+        error, abs_error, sq_error, y, y2, smape = self.sums / self.n
+        values = {
+            "MAE": abs_error,
+            "RMSE": np.sqrt(sq_error),
+            "MBE": error,
+            "R2": 1 - sq_error / (y2 - y**2),
+            "SMAPE": smape,
+        }
+        return {m: v if GREATER_IS_BETTER[m] else -v for m, v in values.items()}
+
+
+class ChunkIterator(xgb.DataIter):
+    """ feeds chunks into XGBoost, which builds its quantized external memory pages on disk """
+    def __init__(self, stream, cache_prefix):
+        self.stream = stream
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._chunks is None:
+            self._chunks = self.stream()
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        input_data(data=chunk[0], label=chunk[1])
+        return True
+
+    def reset(self):
+        self._chunks = None
+
+
+def fit_incremental(model_name:str, params:dict, stream, n_epochs:int=5, seed:int=None, n_jobs:int=1, tmp_dir:str=None):
+    """
+    Fit a model without loading its training data at once
+        en: Elastic Net penalized linear model trained by SGD, MinMax scaler fitted in a first pass
+        rf: Random Forest grown chunk by chunk (warm start), each chunk with training records adds its share of the trees
+            (with more chunks than trees, the trees are spread evenly and the other chunks are skipped)
+        xgb: XGBoost on an external memory quantile matrix
+    :param model_name: "en", "rf" or "xgb"
+    :param params: hyperparameters with or without pipeline prefix "model__"
+    :param stream: callable which starts a new pass over (X, y) chunks of the training records
+    :param n_epochs: passes of SGD over the training data
+    :param tmp_dir: folder for the external memory pages of XGBoost, defaults to system tmp folder
+    :return: fitted sklearn Pipeline, usable like the pipelines fitted in memory
+    """
+    params = {k.split("__")[-1]: v for k, v in params.items()}
+
+    if model_name == "en":
+        ## ElasticNet and SGDRegressor share the definition of alpha and l1_ratio, solver settings are not transferable
+        model = SGDRegressor(
+            penalty="elasticnet", random_state=seed,
+            **{k: v for k, v in params.items() if k in ("alpha", "l1_ratio", "fit_intercept")}
+        )
+        scaler = MinMaxScaler()
+        for X, _ in stream():
+            scaler.partial_fit(X)
+        for _ in range(n_epochs):
+            for X, y in stream():
+                model.partial_fit(scaler.transform(X), y)
+        return Pipeline([("scaler", scaler), ("model", model)])
+
+    if model_name == "rf":
+        n_trees = params.pop("n_estimators", 100)
+        ## trees per chunk which holds training records (counted in a first pass), differing by at most one
+        n_chunks = sum(1 for _ in stream())
+        trees_per_chunk = np.bincount(np.arange(n_trees) * n_chunks // n_trees, minlength=n_chunks)
+        model = RandomForestRegressor(random_state=seed, n_jobs=n_jobs, warm_start=True, **params)
+        for (X, y), n_new in zip(stream(), trees_per_chunk):
+            if n_new:
+                model.set_params(n_estimators=len(getattr(model, "estimators_", [])) + n_new).fit(X, y)
+        return Pipeline([("model", model)])
+
+    if model_name == "xgb":
+        n_rounds = params.pop("n_estimators", 100)
+        for k in ("random_state", "n_jobs", "early_stopping_rounds"):
+            params.pop(k, None)
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as cache_dir:
+            dtrain = xgb.ExtMemQuantileDMatrix(ChunkIterator(stream, os.path.join(cache_dir, "cache")), nthread=n_jobs)
+            booster = xgb.train({"tree_method": "hist", "seed": seed, "nthread": n_jobs, **params}, dtrain, num_boost_round=n_rounds)
+            del dtrain   # releases the external memory pages before their folder is removed
+        model = XGBRegressor(n_estimators=n_rounds, random_state=seed, n_jobs=n_jobs, **params)
+        model.load_model(bytearray(booster.save_raw(raw_format="ubj")))
+        return Pipeline([("model", model)])
+
+    raise ValueError(f"model {model_name} can not be trained incrementally, use one of {STREAMING_MODELS}")
+
+
+def score_streamed(model, dataset:ChunkedDataset, mask, predictions=None, weight=1.0):
+    """
+    Evaluate model on the selected records, chunk by chunk
+    :param predictions: np.array or memory-mapped array of length dataset.n_rows, predictions (times weight) are added to it
+    :return: dict with metrics (see StreamingScores.scores)
+    """
+    scores = StreamingScores()
+    for rows, X, y in dataset.chunks(mask):
+        y_pred = model.predict(X)
+        scores.update(y, y_pred)
+        if predictions is not None:
+            predictions[rows] = np.nan_to_num(predictions[rows]) + weight * y_pred
+    return scores.scores()
+
+
+def streaming_search(model_name:str, dataset:ChunkedDataset, param_space:dict, train_mask, n_iter:int=5,
+                     inner_splits:int=2, tuning_score:str="MAE", salt=(), **fit_kwargs):
+    """
+    Inner random search on the training records of one outer fold, each candidate is fitted incrementally
+    on each inner training split and scored on the streamed inner validation split
+    :param train_mask: callable, selects the training records of the outer fold by their row numbers
+    :param salt: ints which make the inner split independent of the outer split, e.g. (seed, repeat, fold)
+    :return: best parameters and mean inner score of each candidate
+    """
+    candidates = list(ParameterSampler(param_space, n_iter, random_state=fit_kwargs.get("seed"))) if param_space else [{}]
+    scores = np.zeros(len(candidates))
+    for i, params in enumerate(candidates):
+        for k in range(inner_splits):
+            inner_train = lambda rows, k=k: train_mask(rows) & (fold_ids(rows, inner_splits, *salt) != k)
+            inner_test = lambda rows, k=k: train_mask(rows) & (fold_ids(rows, inner_splits, *salt) == k)
+            model = fit_incremental(model_name, params, dataset.stream(inner_train), **fit_kwargs)
+            scores[i] += score_streamed(model, dataset, inner_test)[tuning_score] / inner_splits
+    return candidates[int(np.argmax(scores))], scores
+
+
+@prof.profiled()
+def streaming_nested_cv(model_name:str, dataset:ChunkedDataset, param_space:dict, kfolds_and_repeats=(2, 2),
+                        n_iter:int=5, tuning_score:str="MAE", seed:int=None, predictions_file:str=None, **fit_kwargs):
+    """
+    Nested cross-validation on a dataset which is only read chunk-wise. Folds are assigned by hashing the row numbers 
+    (fold_ids), so they are random splits like RepeatedKFold with shuffling, but not the same folds and of only approximately equal size.
+    Outer models are ordered like RepeatedKFold: all folds of the first repeat, then of the next repeat
+    :param kfolds_and_repeats: (k, repeats) of the outer cv, the inner search uses k splits
+    :param predictions_file: path of .npy file for the out-of-fold predictions, averaged across repeats
+        (nan for skipped records). Written as memory-mapped array, None == predictions are not kept
+    :param fit_kwargs: n_epochs, n_jobs and tmp_dir passed to fit_incremental()
+    :return: dict with fitted outer "estimator"s, their "best_params" and "test_<metric>" scores of each outer fold
+    """
+    n_splits, n_repeats = kfolds_and_repeats
+    results = {"estimator": [], "best_params": [], **{f"test_{m}": [] for m in METRICS}}
+    predictions = None
+    if predictions_file is not None:
+        predictions = np.lib.format.open_memmap(predictions_file, mode="w+", dtype="float32", shape=(dataset.n_rows,))
+        predictions[:] = np.nan
+
+    for repeat in range(n_repeats):
+        for fold in range(n_splits):
+            test = lambda rows, repeat=repeat, fold=fold: fold_ids(rows, n_splits, seed, repeat) == fold
+            train = lambda rows, test=test: ~test(rows)
+
+            params, _ = streaming_search(
+                model_name, dataset, param_space, train, n_iter=n_iter, inner_splits=n_splits,
+                tuning_score=tuning_score, salt=(seed, repeat, fold, n_splits), seed=seed, **fit_kwargs
+            )
+            model = fit_incremental(model_name, params, dataset.stream(train), seed=seed, **fit_kwargs)
+            scores = score_streamed(model, dataset, test, predictions=predictions, weight=1 / n_repeats)
+
+            results["estimator"].append(model)
+            results["best_params"].append(params)
+            for m in METRICS:
+                results[f"test_{m}"].append(scores[m])
+
+    if predictions is not None:
+        predictions.flush()
+    return {k: np.array(v) if k.startswith("test_") else v for k, v in results.items()}
+
+
+@prof.profiled()
+def streaming_permutation_importances(estimators:list, dataset:ChunkedDataset, kfolds_and_repeats=(2, 2),
+                                      metrics=("R2", "MAE"), n_repeats:int=5, seed:int=None):
+    """
+    Permutation feature importance of the outer models on their streamed out-of-fold records.
+    Feature values are permuted within each chunk, chunks should therefore hold records in random order
+    (exact permutation importance if one chunk contains the entire test fold)
+    :param estimators: fitted outer models from streaming_nested_cv(), in the same fold order
+    :param metrics: names of metrics, see StreamingScores
+    :param n_repeats: number of permutations per feature
+    :return: dict with Bunch per metric, like e.permutation_importances(); importances of the outer folds are averaged
+    """
+    n_splits = kfolds_and_repeats[0]
+    n_features = len(dataset.X_names)
+    importances = {m: np.zeros((len(estimators), n_features, n_repeats)) for m in metrics}
+
+    for i, model in enumerate(estimators):
+        repeat, fold = divmod(i, n_splits)
+        test = lambda rows: fold_ids(rows, n_splits, seed, repeat) == fold
+        rng = np.random.default_rng([seed or 0, i])
+        baseline = StreamingScores()
+        permuted = [[StreamingScores() for _ in range(n_repeats)] for _ in range(n_features)]
+
+        for _, X, y in dataset.chunks(test):
+            baseline.update(y, model.predict(X))
+            X_permuted = np.tile(X.to_numpy(), (n_repeats, 1))   # all permutations of one feature in one predict call
+            for j in range(n_features):
+                column = X_permuted[:len(y), j].copy()
+                X_permuted[:, j] = np.concatenate([column[rng.permutation(len(y))] for _ in range(n_repeats)])
+                y_pred = model.predict(pd.DataFrame(X_permuted, columns=dataset.X_names, copy=False))
+                for n in range(n_repeats):
+                    permuted[j][n].update(y, y_pred[n * len(y):(n + 1) * len(y)])
+                X_permuted[:, j] = np.tile(column, n_repeats)
+
+        baseline_scores = baseline.scores()
+        for j in range(n_features):
+            for n in range(n_repeats):
+                permuted_scores = permuted[j][n].scores()
+                for m in metrics:
+                    importances[m][i, j, n] = baseline_scores[m] - permuted_scores[m]
+
+    return {
+        m: Bunch(
+            importances_mean=imp.mean(axis=(0, 2)),
+            importances_std=imp.mean(axis=0).std(axis=1),
+            importances=imp.mean(axis=0),
+        )
+        for m, imp in importances.items()
+    }
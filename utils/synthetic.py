@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic survey-like flood-loss datasets, e.g. for benchmarks and tests"""
+
+import numpy as np
+import pandas as pd
+
+
+def make_flood_loss_data(n_rows:int=500, n_features:int=20, nan_rate:float=0.05, zero_loss_fraction:float=0.3,
+                         correlation:float=0.5, group_size:int=4, n_informative:int=5, ordinal_fraction:float=0.5,
+                         target_name:str="rloss_b", seed:int=None):
+    """
+    Generate a dataset which resembles the survey extracts: relative loss as target in the first column,
+    groups of correlated predictors, ordinal survey answers, missing answers and many zero-loss records
+    :param n_rows: number of records
+    :param n_features: number of predictors
+    :param nan_rate: share of missing predictor values (missing completely at random), target is complete
+    :param zero_loss_fraction: share of records without loss, records with the lowest loss potential
+    :param correlation: pairwise correlation of predictors within one group
+    :param group_size: number of predictors sharing one latent factor
+    :param n_informative: number of predictors which drive the loss, the others are noise
+    :param ordinal_fraction: share of predictors which are ordinal answers (1 to 5), e.g. precaution or building quality
+    :param seed: seed of random generator
+    :return: pd.DataFrame with target and predictors f0, f1, ..
+    """
+    rng = np.random.default_rng(seed)
+
+    ## predictors: each group shares a latent factor, so that features of the same group are correlated
+    n_groups = -(-n_features // group_size)
+    latent = rng.standard_normal((n_rows, n_groups))
+    X = np.sqrt(correlation) * latent[:, np.arange(n_features) // group_size] \
+        + np.sqrt(1 - correlation) * rng.standard_normal((n_rows, n_features))
+
+    ## relative loss: linear and non-linear effects of the informative predictors
+    n_informative = min(n_informative, n_features)
+    weights = rng.uniform(0.5, 1.5, n_informative) * rng.choice([-1, 1], n_informative)
+    loss_potential = X[:, :n_informative] @ weights + 0.5 * X[:, 0]**2 + 0.5 * rng.standard_normal(n_rows)
+    y = 1 / (1 + np.exp(-loss_potential))
+    y[loss_potential <= np.quantile(loss_potential, zero_loss_fraction)] = 0.0
+
+    ## ordinal answers from the last predictors, binned by quantiles into 1 to 5
+    n_ordinal = int(round(ordinal_fraction * n_features))
+    for j in range(n_features - n_ordinal, n_features):
+        X[:, j] = 1 + np.searchsorted(np.quantile(X[:, j], [0.2, 0.4, 0.6, 0.8]), X[:, j])
+
+    X[rng.random(X.shape) < nan_rate] = np.nan
+
+    df = pd.DataFrame(X, columns=[f"f{j}" for j in range(n_features)])
+    df.insert(0, target_name, y)
+    return df
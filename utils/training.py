@@ -2,11 +2,26 @@
 # -*- coding: utf-8 -*-
 """Utility functions for model fitting"""
 
+import time
+
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import RandomizedSearchCV
+from joblib import Parallel, delayed
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401, enables HalvingRandomSearchCV
+from sklearn.model_selection import RandomizedSearchCV, HalvingRandomSearchCV, ParameterGrid, ParameterSampler, train_test_split
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import ElasticNet, enet_path
+from sklearn.metrics import get_scorer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler, StandardScaler, MaxAbsScaler, RobustScaler
+from sklearn.utils import check_random_state
+import xgboost as xgb
+from xgboost import XGBRegressor
 
 import utils.feature_selection as fs
+import utils.parallel as par
+import utils.preprocessing as pp
 #from utils.evaluation import ModelEvaluation
 import utils.settings as s
 s.init()
@@ -25,22 +40,437 @@ seed = s.seed
 
 
 
+SEARCH_METHODS = ["random", "halving", "path", "quantile", "oob"]
+
+## scalers which transform each column by x * scale + offset
+COLUMNWISE_TRANSFORMERS = (MinMaxScaler, StandardScaler, MaxAbsScaler, RobustScaler)
+
+
+class EarlyStoppingXGBRegressor(XGBRegressor):
+    """
+    XGBRegressor with early stopping inside sklearn pipelines and hyperparameter searches:
+    a fraction of the training data of each (inner) fold is held out as validation set, 
+    n_estimators is the upper limit of boosting rounds
+    """
+    def __init__(self, *, validation_fraction=0.2, **kwargs):
+        super().__init__(**kwargs)
+        self.validation_fraction = validation_fraction
+
+    def get_xgb_params(self):
+        params = super().get_xgb_params()
+        params.pop("validation_fraction", None)   # sklearn-side parameter, not passed to the booster
+        return params
+
+    def fit(self, X, y, **fit_params):
+        if self.early_stopping_rounds is None or "eval_set" in fit_params:
+            return super().fit(X, y, **fit_params)
+
+        X_train, X_val, y_train, y_val = train_test_split(
+            X, y, test_size=self.validation_fraction, random_state=self.random_state
+        )
+        fit_params.setdefault("verbose", False)
+        return super().fit(X_train, y_train, eval_set=[(X_val, y_val)], **fit_params)
+
+
+def with_early_stopping(model, early_stopping_rounds, validation_fraction=0.2):
+    """
+    Replace XGBRegressor in pipeline by EarlyStoppingXGBRegressor, other models are returned unchanged
+    model: sklearn Pipeline with step "model"
+    early_stopping_rounds (int): stop boosting if validation error did not improve for this number of rounds
+    validation_fraction (float): share of the training data of each fold used for early stopping
+    return: Pipeline
+    """
+    model = clone(model)
+    xgb = model.named_steps.get("model")
+    if not isinstance(xgb, XGBRegressor):
+        return model
+    xgb_early_stopping = EarlyStoppingXGBRegressor(
+        validation_fraction=validation_fraction, 
+        **dict(xgb.get_params(), early_stopping_rounds=early_stopping_rounds)
+    )
+    return model.set_params(model=xgb_early_stopping)
+
+
+class _FixedPrediction(RegressorMixin, BaseEstimator):
+    """ precomputed predictions of one candidate (e.g. one point of the regularization path), scored by sklearn scorers like a fitted estimator """
+    def __init__(self, y_pred):
+        self.y_pred = y_pred
+
+    def predict(self, X):
+        return self.y_pred
+
+
+def _set_search_results(search, params, fold_scores):
+    """
+    Set cv_results_, best_index_, best_score_, best_params_ and n_splits_ in the same layout as the sklearn searches
+    params (list): parameters of each candidate
+    fold_scores (list): scores of all candidates for each inner fold
+    """
+    fold_scores = np.array(fold_scores)   # folds x candidates
+    mean_scores = fold_scores.mean(axis=0)
+    search.cv_results_ = {
+        "params": params,
+        "mean_test_score": mean_scores,
+        "std_test_score": fold_scores.std(axis=0),
+        "rank_test_score": (len(mean_scores) - np.argsort(np.argsort(mean_scores, kind="stable"), kind="stable")).astype(np.int32),
+        **{f"split{k}_test_score": scores for k, scores in enumerate(fold_scores)},
+    }
+    search.best_index_ = int(np.argmax(mean_scores))
+    search.best_score_ = mean_scores[search.best_index_]
+    search.best_params_ = params[search.best_index_]
+    search.n_splits_ = len(fold_scores)
+
+
+class ElasticNetPathSearchCV(BaseEstimator):
+    """
+    Inner hyperparameter search for Pipeline(<scalers>, ElasticNet): for each l1_ratio the entire alpha path
+    is fitted in one warm-started coordinate descent sweep on a precomputed Gram matrix, instead of refitting 
+    ElasticNet for each sampled (alpha, l1_ratio). The Gram matrix of each inner training fold is derived from
+    moments of the entire training set and of the small held-out fold, so X^T X is computed once for all folds.
+    Same interface as RandomizedSearchCV (best_params_, best_estimator_, best_score_, cv_results_)
+    """
+    def __init__(self, estimator, param_distributions, cv=5, scoring=None, refit=True, n_iter=10, random_state=None, n_jobs=None):
+        """
+        estimator: sklearn Pipeline with ElasticNet as last step, optional column-wise scalers before
+        param_distributions (dict): alpha and l1_ratio (lists or scipy distributions from which n_iter values are drawn), 
+            lists of further ElasticNet parameters are searched as grid
+        n_jobs (int): number of threads, the coordinate descent runs without the GIL
+        """
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.cv = cv
+        self.scoring = scoring
+        self.refit = refit
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+
+    def _candidates(self, prefix):
+        """ return: alphas (descending), l1_ratios and grid of further parameters """
+        rng = check_random_state(self.random_state)
+        space = dict(self.param_distributions)
+        values = {}
+        for name in ("alpha", "l1_ratio"):
+            v = space.pop(f"{prefix}{name}", [self.estimator.get_params()[f"{prefix}{name}"]])
+            values[name] = list(v) if isinstance(v, (list, tuple, np.ndarray)) else list(v.rvs(size=self.n_iter, random_state=rng))
+        return sorted(set(values["alpha"]), reverse=True), list(dict.fromkeys(values["l1_ratio"])), list(ParameterGrid(space))
+
+
+    @staticmethod
+    def _fold_gram(preprocessing, X, y, train, test, moments, fit_intercept=True):
+        """
+        Centered Gram matrix and X^T y of the scaled training records of one fold
+        moments: (X^T X, X^T y, column sums, sum y) of all records, centered by their column means, or None
+        fit_intercept (bool): center X and y, without intercept the Gram matrix of the uncentered records is used
+        return: Gram, Xy, centered y, mean of scaled X and mean of y of the training records (0 without intercept), scaled test records
+        """
+        preprocessing = clone(preprocessing).fit(X[train])
+        X_test = preprocessing.transform(X[test])
+        y_train = y[train]
+        y_mean = y_train.mean() if fit_intercept else 0.0
+
+        if moments is None:   # no column-wise scaler or no intercept, Gram of the transformed training records
+            X_train = preprocessing.transform(X[train])
+            X_mean = X_train.mean(axis=0) if fit_intercept else np.zeros(X.shape[1])
+            X_train = X_train - X_mean
+            return np.ascontiguousarray(X_train.T @ X_train), X_train.T @ (y_train - y_mean), y_train - y_mean, X_mean, y_mean, X_test
+
+        ## training moments = moments of all records - moments of test records, scaled: x * scale + offset
+        XtX, Xty, X_sum, y_sum, shift = moments
+        X_te = X[test] - shift
+        n_train = len(train)
+        X_mean = (X_sum - X_te.sum(axis=0)) / n_train
+        gram = (XtX - X_te.T @ X_te) - n_train * np.outer(X_mean, X_mean)
+        Xy = (Xty - X_te.T @ y[test]) - n_train * X_mean * y_mean
+        offset = preprocessing.transform(np.zeros((1, X.shape[1])))[0]
+        scale = preprocessing.transform(np.ones((1, X.shape[1])))[0] - offset
+        return (
+            np.ascontiguousarray(scale[:, None] * gram * scale[None, :]), scale * Xy, y_train - y_mean, 
+            offset + scale * (X_mean + shift), y_mean, X_test,
+        )
+
+
+    def _score_fold(self, preprocessing, enet, X, y, train, test, moments, alphas, l1_ratios, grid, scorer):
+        """ return: scores of all candidates on one inner fold, ordered like the candidates of cv_results_ """
+        folds = {}   # Gram matrices of the fold with and without intercept, fit_intercept can be part of the grid
+        dummy_X = np.broadcast_to(np.zeros(1), (len(train), X.shape[1]))  # only the shape is used with a Gram matrix
+        scores = []
+        for params in grid:
+            enet_params = clone(enet).set_params(**params).get_params()
+            fit_intercept = enet_params["fit_intercept"]
+            if fit_intercept not in folds:
+                folds[fit_intercept] = self._fold_gram(preprocessing, X, y, train, test, moments if fit_intercept else None, fit_intercept)
+            gram, Xy, y_centered, X_mean, y_mean, X_test = folds[fit_intercept]
+            for l1_ratio in l1_ratios:
+                _, coefs, _ = enet_path(
+                    dummy_X, y_centered, l1_ratio=l1_ratio, alphas=alphas, precompute=gram, Xy=Xy, check_input=False,
+                    max_iter=enet_params["max_iter"], tol=enet_params["tol"], positive=enet_params["positive"],
+                    selection=enet_params["selection"], random_state=enet_params["random_state"],
+                )
+                y_pred = X_test @ coefs + (y_mean - X_mean @ coefs)
+                scores.extend(scorer(_FixedPrediction(y_pred[:, i]), X_test, y[test]) for i in range(len(alphas)))
+        return scores
+
+
+    def fit(self, X, y):
+        columns = getattr(X, "columns", None)
+        X_values, y_values = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+        model_name, enet = self.estimator.steps[-1]
+        assert isinstance(enet, ElasticNet), "ElasticNetPathSearchCV requires ElasticNet as last step of the pipeline"
+        preprocessing = Pipeline(self.estimator.steps[:-1]) if len(self.estimator.steps) > 1 else Pipeline([("identity", "passthrough")])
+        alphas, l1_ratios, grid = self._candidates(f"{model_name}__")
+        scorer = get_scorer(self.scoring) if self.scoring is not None else get_scorer("r2")
+
+        ## moments of all records, shared by all folds; centered first for numerical stability
+        moments = None
+        if enet.fit_intercept and all(step == "passthrough" or isinstance(step, COLUMNWISE_TRANSFORMERS) for _, step in preprocessing.steps):
+            shift = X_values.mean(axis=0)
+            X_shifted = X_values - shift
+            moments = (X_shifted.T @ X_shifted, X_shifted.T @ y_values, X_shifted.sum(axis=0), y_values.sum(), shift)
+
+        splits = list(self.cv.split(X_values, y_values))
+        fold_scores = Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(self._score_fold)(preprocessing, enet, X_values, y_values, train, test, moments, alphas, l1_ratios, grid, scorer)
+            for train, test in splits
+        )
+
+        params = [
+            {**{f"{model_name}__{k}": v for k, v in other.items()}, f"{model_name}__l1_ratio": l1_ratio, f"{model_name}__alpha": alpha}
+            for other in grid for l1_ratio in l1_ratios for alpha in alphas
+        ]
+        _set_search_results(self, params, fold_scores)
+
+        if self.refit:
+            refit_start = time.time()
+            X_refit = pd.DataFrame(X_values, columns=columns, copy=False) if columns is not None else X_values
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(X_refit, y_values)
+            self.refit_time_ = time.time() - refit_start
+        return self
+
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+    def score(self, X, y):
+        return get_scorer(self.scoring or "r2")(self.best_estimator_, X, y)
+
+
+class XGBoostQuantileSearchCV(BaseEstimator):
+    """
+    Inner hyperparameter search for Pipeline(<scalers>, XGBRegressor) on quantized data: the training set is sketched
+    into histogram bins once (xgb.QuantileDMatrix), each inner training fold is binned with these cuts and shared by all
+    candidates, instead of rebuilding the histograms for each candidate and fold. Scalers are skipped, trees are invariant 
+    to monotonic transformations. Candidates which only differ in n_estimators are scored from one booster by truncating
+    its boosting rounds. Candidates are sampled like RandomizedSearchCV, same interface (best_params_, best_estimator_, ..)
+    """
+    def __init__(self, estimator, param_distributions, cv=5, scoring=None, refit=True, n_iter=10, random_state=None, n_jobs=None):
+        """
+        estimator: sklearn Pipeline with XGBRegressor (without early stopping) as last step, optional scalers before
+        param_distributions (dict): hyperparameters of the XGBRegressor step (lists or scipy distributions), max_bin is not searched
+        n_jobs (int): number of inner folds fitted in parallel threads, each booster uses the n_jobs of the XGBRegressor step
+        """
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.cv = cv
+        self.scoring = scoring
+        self.refit = refit
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+
+    @staticmethod
+    def _train(regressor, dtrain):
+        """ return: booster trained with the hist method and the parameters of the XGBRegressor """
+        params = dict(regressor.get_xgb_params(), tree_method="hist")
+        return xgb.train(params, dtrain, num_boost_round=regressor.get_num_boosting_rounds())
+
+
+    def _score_fold(self, regressors, groups, X, y, train, test, reference, scorer):
+        """ return: scores of all candidates on one inner fold """
+        dtrain = xgb.QuantileDMatrix(X[train], y[train], ref=reference, feature_names=reference.feature_names)
+        X_test = X[test]
+        scores = np.empty(len(regressors))
+        for candidates in groups:
+            booster = self._train(regressors[candidates[-1]], dtrain)   # most boosting rounds of the group
+            for i in candidates:
+                y_pred = booster.inplace_predict(X_test, iteration_range=(0, regressors[i].get_num_boosting_rounds()))
+                scores[i] = scorer(_FixedPrediction(y_pred), X_test, y[test])
+        return scores
+
+
+    def fit(self, X, y):
+        columns = getattr(X, "columns", None)
+        X_values, y_values = np.asarray(X, dtype=np.float32), np.asarray(y, dtype=float)
+        model_name, regressor = self.estimator.steps[-1]
+        assert isinstance(regressor, XGBRegressor), "XGBoostQuantileSearchCV requires XGBRegressor as last step of the pipeline"
+        assert regressor.early_stopping_rounds is None, "XGBoostQuantileSearchCV does not support early stopping"
+        assert f"{model_name}__max_bin" not in self.param_distributions, "max_bin is fixed by the quantized training set"
+        scorer = get_scorer(self.scoring) if self.scoring is not None else get_scorer("r2")
+
+        ## candidates like RandomizedSearchCV, grouped by all parameters except the number of boosting rounds
+        params = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+        regressors = [clone(self.estimator).set_params(**p).steps[-1][1] for p in params]
+        groups = {}
+        for i, reg in enumerate(regressors):
+            key = repr(sorted((k, v) for k, v in reg.get_params().items() if k != "n_estimators"))
+            groups.setdefault(key, []).append(i)
+        groups = [sorted(g, key=lambda i: regressors[i].get_num_boosting_rounds()) for g in groups.values()]
+
+        ## quantile cuts of the entire training set, reused by all inner folds and the refit
+        feature_names = [str(c) for c in columns] if columns is not None else None
+        dtrain = xgb.QuantileDMatrix(
+            X_values, y_values, feature_names=feature_names, max_bin=regressor.max_bin or 256, nthread=regressor.n_jobs
+        )
+
+        splits = list(self.cv.split(X_values, y_values))
+        fold_scores = Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(self._score_fold)(regressors, groups, X_values, y_values, train, test, dtrain, scorer)
+            for train, test in splits
+        )
+        _set_search_results(self, params, fold_scores)
+
+        if self.refit:
+            refit_start = time.time()
+            best_regressor = regressors[self.best_index_]
+            booster = self._train(best_regressor, dtrain)
+            best_regressor.load_model(bytearray(booster.save_raw(raw_format="ubj")))
+            self.best_estimator_ = Pipeline([(model_name, best_regressor)])
+            self.refit_time_ = time.time() - refit_start
+        return self
+
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+    def score(self, X, y):
+        return get_scorer(self.scoring or "r2")(self.best_estimator_, X, y)
+
+
+def oob_mask(forest, n_samples):
+    """
+    Records which are out-of-bag for at least one tree of a fitted forest (bootstrap=True). Records which are 
+    in the bootstrap samples of all trees get an oob_prediction_ of 0 (not nan) from sklearn and must not be scored
+    forest: fitted RandomForestRegressor
+    n_samples (int): number of training records
+    return: boolean np.array
+    """
+    in_all_samples = np.ones(n_samples, dtype=bool)
+    for drawn in forest.estimators_samples_:
+        in_all_samples &= np.bincount(drawn, minlength=n_samples) > 0
+    return ~in_all_samples
+
+
+class RandomForestOOBSearchCV(BaseEstimator):
+    """
+    Hyperparameter search for Pipeline(<scalers>, RandomForestRegressor) by out-of-bag predictions: each candidate is 
+    fitted once on the entire training set and scored on the records which were not drawn into the bootstrap samples
+    of the trees, instead of refitting it on each inner fold. Candidates which only differ in n_estimators grow one 
+    warm-started forest, which gives the same trees as fitting each of them. The fitted best candidate is the refitted 
+    model. Candidates are sampled like RandomizedSearchCV, same interface (best_params_, best_estimator_, ..)
+    """
+    def __init__(self, estimator, param_distributions, cv=None, scoring=None, refit=True, n_iter=10, random_state=None, n_jobs=None):
+        """
+        estimator: sklearn Pipeline with RandomForestRegressor (bootstrap=True) as last step
+        param_distributions (dict): hyperparameters of the pipeline (lists or scipy distributions)
+        cv: not used, the out-of-bag records replace the inner folds
+        n_jobs (int): number of candidates fitted in parallel threads
+        """
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.cv = cv
+        self.scoring = scoring
+        self.refit = refit
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+
+    @staticmethod
+    def _fit_group(pipelines, X, y, scorer):
+        """
+        Fit candidates of one group by growing the forest with increasing n_estimators
+        return: scores of the candidates, index of the best one within the group and its fitted pipeline
+        """
+        pipe = pipelines[0]
+        forest = pipe.steps[-1][1]
+        warm_start = forest.warm_start
+        scores, best = [], None
+        for i, candidate in enumerate(pipelines):
+            forest.set_params(n_estimators=candidate.steps[-1][1].n_estimators, warm_start=i > 0)
+            pipe.fit(X, y)
+            oob = oob_mask(forest, len(y))   # records which were in the bootstrap sample of all trees are not scored
+            scores.append(scorer(_FixedPrediction(forest.oob_prediction_[oob]), X, y[oob]))
+            if best is None or scores[-1] > scores[best]:
+                best, n_estimators, oob_prediction, oob_score = i, forest.n_estimators, forest.oob_prediction_, forest.oob_score_
+
+        ## forest of the best candidate: its first trees
+        forest.estimators_ = forest.estimators_[:n_estimators]
+        forest.set_params(n_estimators=n_estimators, warm_start=warm_start)
+        forest.oob_prediction_, forest.oob_score_ = oob_prediction, oob_score
+        return scores, best, pipe
+
+
+    def fit(self, X, y):
+        forest = self.estimator.steps[-1][1]
+        assert isinstance(forest, RandomForestRegressor), "RandomForestOOBSearchCV requires RandomForestRegressor as last step of the pipeline"
+        assert forest.bootstrap, "out-of-bag scores require bootstrap=True"
+        X_values, y_values = pd.DataFrame(X, copy=False), np.asarray(y, dtype=float)
+        scorer = get_scorer(self.scoring) if self.scoring is not None else get_scorer("r2")
+
+        ## candidates like RandomizedSearchCV, grouped by all parameters except n_estimators
+        params = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+        pipelines = [clone(self.estimator).set_params(**p, **{f"{self.estimator.steps[-1][0]}__oob_score": True}) for p in params]
+        groups = {}
+        for i, pipe in enumerate(pipelines):
+            key = repr(sorted((k, v) for k, v in pipe.get_params().items() if not k.endswith("n_estimators") and "__" in k))
+            groups.setdefault(key, []).append(i)
+        groups = [sorted(g, key=lambda i: pipelines[i].steps[-1][1].n_estimators) for g in groups.values()]
+
+        ## keep only the fitted pipeline of the best candidate
+        scores = np.empty(len(params))
+        best_score, self.best_estimator_ = -np.inf, None
+        results = Parallel(n_jobs=self.n_jobs, prefer="threads", return_as="generator")(
+            delayed(self._fit_group)([pipelines[i] for i in group], X_values, y_values, scorer) for group in groups
+        )
+        for group, (group_scores, best, pipe) in zip(groups, results):
+            scores[group] = group_scores
+            if group_scores[best] > best_score:
+                best_score, self.best_estimator_ = group_scores[best], pipe
+        _set_search_results(self, params, [scores])
+        if not self.refit:
+            del self.best_estimator_
+        return self
+
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+    def score(self, X, y):
+        return get_scorer(self.scoring or "r2")(self.best_estimator_, X, y)
+
+
 class ModelFitting(object):
     """
     sklearn models and R model training by nested cross-validation
     """
-    def __init__(self, model, Xy, target_name, param_space, tuning_score, cv, kfolds_and_repeats:tuple, seed):
+    def __init__(self, model, Xy, target_name, param_space, tuning_score, cv, kfolds_and_repeats:tuple, seed, n_jobs=1,
+                 search_method="random", halving_resource="n_samples", early_stopping_rounds=None):
         #super(model_fitting, self).__init__()  # super() == to call parent class
         
         ## properties
         self.model = model   # algorithm for sklearn model
         self.final_model = None
         self.r_algorithm_name: str = str(model) # name of algorithm for R model  ## TODO move non-global properies to methods()
-        self.X = pd.DataFrame(Xy.drop(target_name, axis=1))
-        self.X = pd.DataFrame(
-                MinMaxScaler().fit_transform(self.X),   
-                columns=self.X.columns) 
-        self.y: pd.DataFrame = Xy[target_name]
+        ## Xy: pp.PreparedDataset, or pd.DataFrame (can be a view onto shared memory, par.SharedFrame)
+        ## no scaling here, the pipelines scale inside each fold
+        data = Xy if isinstance(Xy, pp.PreparedDataset) else pp.PreparedDataset(par.shared(Xy), target_name)
+        self.X: pd.DataFrame = data.X
+        self.y: pd.Series = data.y
         self.target_name: str = target_name
         self.param_space: dict = param_space
         self.tuning_score: str = tuning_score
@@ -48,6 +478,15 @@ class ModelFitting(object):
         self.inner_cv = cv
         self.outer_cv = cv
         self.seed: int = seed
+        self.n_jobs: int = par.resolve_n_jobs(n_jobs)  # cores for entire nested cv, split across outer folds, inner fits and estimator threads
+        self.budget = None
+        ## "random": RandomizedSearchCV, "halving": successive halving, "path": Elastic Net path, "quantile": XGBoost on quantized data,
+        ## "oob": Random Forest scored out-of-bag,
+        ## several methods: the first one which applies to the model is used, random search for the other models
+        self.search_method: list = [search_method] if isinstance(search_method, str) else list(search_method)
+        assert set(self.search_method) <= set(SEARCH_METHODS), f"search_method must be one of {SEARCH_METHODS}"
+        self.halving_resource: str = halving_resource  # "n_samples" or e.g. "model__n_estimators" 
+        self.early_stopping_rounds = early_stopping_rounds  # XGBoost only, None == without early stopping
 
 
     # def r_tunegrid(self, mtry_min, mtry_max, mtry_seq):
@@ -67,19 +506,96 @@ class ModelFitting(object):
     def model_fit_ncv(self):
         """
         Optimazation of sklearn model by nested cross-validation [inner folds]
+        Only sets up the search, the fits run in ModelEvaluation.model_evaluate_ncv() and are profiled there
         return: k-best models of inner folds
         """
+        model = clone(self.model)
+        if self.early_stopping_rounds is not None:
+            model = with_early_stopping(model, self.early_stopping_rounds)
+
         ## define inner cv, model training with hyperparameter tuning
-        models_trained_ncv = RandomizedSearchCV(
-            estimator=self.model ,
+        models_trained_ncv = self.inner_search(model)
+
+        ## split cores among outer folds (ModelEvaluation), inner fits and estimator threads without oversubscription,
+        ## path and quantile searches fit the inner folds in parallel and the candidates of each fold one after another,
+        ## out-of-bag search fits each candidate once
+        n_inner_fits = getattr(models_trained_ncv, "n_iter", None) and models_trained_ncv.n_iter * self.inner_cv.get_n_splits()
+        if isinstance(models_trained_ncv, (ElasticNetPathSearchCV, XGBoostQuantileSearchCV)):
+            n_inner_fits = self.inner_cv.get_n_splits()
+        elif isinstance(models_trained_ncv, RandomForestOOBSearchCV):
+            n_inner_fits = models_trained_ncv.n_iter
+        self.budget = par.split_budget(self.n_jobs, n_outer_folds=self.outer_cv.get_n_splits(), n_inner_fits=n_inner_fits)
+        par.set_estimator_threads(models_trained_ncv.estimator, self.budget.estimator)
+        models_trained_ncv.set_params(n_jobs=self.budget.inner)
+
+        return models_trained_ncv
+        #return super().model_fit_ncv(**kwargs)
+
+
+    def inner_search(self, model):
+        """
+        Inner hyperparameter search of the first search method which applies to the model
+        model: sklearn Pipeline
+        return: unfitted search, RandomizedSearchCV if no other method applies
+        """
+        estimator = model.steps[-1][1]
+        for method in self.search_method:
+            if method == "halving":
+                return self.halving_search(model)
+            if method == "path" and isinstance(estimator, ElasticNet):
+                search = ElasticNetPathSearchCV
+            elif method == "quantile" and isinstance(estimator, XGBRegressor) and estimator.early_stopping_rounds is None:
+                search = XGBoostQuantileSearchCV
+            elif method == "oob" and isinstance(estimator, RandomForestRegressor) and estimator.bootstrap:
+                search = RandomForestOOBSearchCV
+            elif method == "random":
+                search = RandomizedSearchCV
+            else:
+                continue
+            break
+        else:
+            search = RandomizedSearchCV
+
+        return search(
+            estimator=model,
             param_distributions=self.param_space,
             cv=self.inner_cv, 
             scoring=self.tuning_score,
             refit=True,   
             random_state=self.seed,
         )
-        return models_trained_ncv
-        #return super().model_fit_ncv(**kwargs)
+
+
+    def halving_search(self, model):
+        """
+        Successive halving: all sampled candidates start with a small resource (n_samples or n_estimators), 
+        only the best 1/factor of them continue with factor times more resources
+        model: sklearn Pipeline
+        return: unfitted HalvingRandomSearchCV with same best_params_ / best_estimator_ interface as RandomizedSearchCV
+        """
+        param_space = dict(self.param_space)
+        resource = self.halving_resource
+        max_resources = "auto"
+
+        ## models without the resource (e.g. n_estimators for Elastic Net) are halved over the samples
+        if resource != "n_samples" and resource not in model.get_params():
+            resource = "n_samples"
+        ## the resource itself is not tuned, its largest value in the hyperparameter set is the maximum resource
+        if resource != "n_samples":
+            resource_values = param_space.pop(resource, [model.get_params()[resource]])
+            max_resources = int(max(resource_values)) if isinstance(resource_values, list) else "auto"
+
+        return HalvingRandomSearchCV(
+            estimator=model,
+            param_distributions=param_space,
+            resource=resource,
+            max_resources=max_resources,
+            factor=3,
+            cv=self.inner_cv, 
+            scoring=self.tuning_score,
+            refit=True,   
+            random_state=self.seed,
+        )
     
     # def r_model_fit_ncv(self):
     #     """